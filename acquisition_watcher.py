@@ -0,0 +1,121 @@
+"""
+Event driven acquisition updates for MinKNOW flow cell positions.
+
+Instead of sleeping and re-polling, each watched position gets a thread that
+follows MinKNOW's watch_current_acquisition_run() stream. The callback sees
+every AcquisitionRunInfo update as soon as MinKNOW sends it, so a stop
+decision can be made seconds after the target is crossed, and no RPCs are
+made while nothing is changing.
+
+Example usage might be:
+
+    def on_update(pos, connection, acquisition_info):
+        if acquisition_info.yield_summary.estimated_selected_bases > target:
+            connection.protocol.stop_protocol()
+            return True  # stop watching this position
+        return False
+
+    watcher = AcquisitionWatcher(on_update)
+    for pos in manager.flow_cell_positions():
+        watcher.watch(pos)
+    watcher.wait()
+"""
+
+import threading
+
+
+class AcquisitionWatcher(object):
+    def __init__(self, on_update, connection_cache=None):
+        """
+        Args:
+            on_update: called as on_update(pos, connection, acquisition_info) from
+                the watching thread for every streamed update. Returning True stops
+                watching that position.
+            connection_cache: optional PositionConnectionCache to connect through.
+        """
+        self.on_update = on_update
+        self.connection_cache = connection_cache
+        self.updates = 0
+        # set whenever any position sends an update, cleared by the consumer
+        self.changed = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._streams = {}
+        self._cancelled = set()
+
+    def watch(self, pos):
+        """Start following the acquisition stream of pos, unless already watching it."""
+        with self._lock:
+            thread = self._threads.get(pos.name)
+            if thread is not None and thread.is_alive():
+                return
+            self._cancelled.discard(pos.name)
+            thread = threading.Thread(target=self._follow, args=(pos,), name="watch-%s" % pos.name, daemon=True)
+            self._threads[pos.name] = thread
+        thread.start()
+
+    def watching(self, name):
+        with self._lock:
+            thread = self._threads.get(name)
+        return thread is not None and thread.is_alive()
+
+    def active(self):
+        """Names of positions that are still being watched."""
+        with self._lock:
+            return [name for name, thread in self._threads.items() if thread.is_alive()]
+
+    def cancel(self, name):
+        """Stop watching a position and close its stream."""
+        with self._lock:
+            self._cancelled.add(name)
+            stream = self._streams.get(name)
+        if stream is not None:
+            stream.cancel()
+
+    def cancel_all(self):
+        with self._lock:
+            names = list(self._threads)
+        for name in names:
+            self.cancel(name)
+
+    def wait(self, timeout=None):
+        """Block until every watched position has finished or been cancelled."""
+        for thread in list(self._threads.values()):
+            thread.join(timeout)
+
+    def _connect(self, pos):
+        if self.connection_cache is not None:
+            return self.connection_cache.connect(pos)
+        return pos.connect()
+
+    def _follow(self, pos):
+        try:
+            connection = self._connect(pos)
+            stream = connection.acquisition.watch_current_acquisition_run()
+            with self._lock:
+                # cancel() may have run while the stream was being opened, before it could be found here
+                cancelled = pos.name in self._cancelled
+                if not cancelled:
+                    self._streams[pos.name] = stream
+            if cancelled:
+                stream.cancel()
+                return
+            for acquisition_info in stream:
+                with self._lock:
+                    self.updates += 1
+                self.changed.set()
+                if self.on_update(pos, connection, acquisition_info):
+                    break
+        except Exception as e:
+            with self._lock:
+                cancelled = pos.name in self._cancelled
+            if not cancelled:
+                print("Lost acquisition stream for position %s: %s" % (pos.name, e))
+                if self.connection_cache is not None:
+                    self.connection_cache.invalidate(pos.name)
+        finally:
+            with self._lock:
+                stream = self._streams.pop(pos.name, None)
+            if stream is not None:
+                stream.cancel()
+            self.changed.set()
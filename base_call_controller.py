@@ -1,10 +1,12 @@
 import argparse
 from collections import defaultdict
-import multiprocessing
 import sys
 import os
-import glob
 import time
+from fast5_watcher import Fast5Watcher
+from job_ledger import JobLedger, QUEUED, RUNNING, DONE, FAILED
+from gpu_scheduler import DeviceLeaseScheduler, run_jobs
+from job_runner import run_command, format_result, GuppyProgress, DEFAULT_STALL_TIMEOUT
 
 def parse_args():
     """Build and execute a command line argument for basecalling
@@ -35,87 +37,196 @@ def parse_args():
         default=2,
         help="Number of CUDA gpu decies on machine. (Prom_beta has 2, p48 has 4) [Defaults to 2] "
     )
+    parser.add_argument(
+        "--ledger",
+        help="SQLite job ledger of the guppy jobs started [Defaults to <experiment_dir>/basecall_ledger.sqlite]"
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        default=3,
+        help="failed guppy jobs are retried until they have been attempted this many times [Defaults to 3]"
+    )
+    parser.add_argument(
+        "--job_timeout_hours",
+        type=float,
+        default=0,
+        help="kill a guppy job that runs longer than this, 0 for no limit [Defaults to 0]"
+    )
+    parser.add_argument(
+        "--stall_minutes",
+        type=float,
+        default=DEFAULT_STALL_TIMEOUT / 60,
+        help="kill a guppy job that shows no progress for this long, 0 for no limit [Defaults to %.0f]" % (DEFAULT_STALL_TIMEOUT / 60)
+    )
     args = parser.parse_args()
     return args
 
+def find_fast5_dirs(sample_path):
+    """Paths of the fast5* directories below a sample, without descending into them."""
+    fast5_dirs = []
+    for dirpath, dirnames, filenames in os.walk(sample_path):
+        matches = [d for d in dirnames if d.startswith('fast5')]
+        fast5_dirs.extend(os.path.join(dirpath, d) for d in matches)
+        # fast5 directories hold tens of thousands of files and never contain further run dirs
+        dirnames[:] = [d for d in dirnames if not d.startswith('fast5')]
+    return fast5_dirs
+
 def get_sample_basecall_dirs(experiment_dir, num_basecall):
     basecall_dirs = set()
+    # samples already basecalled by minknow (have fast5_pass), never need another look
+    minknow_basecalled = set()
     while True:
-        samples = os.listdir(experiment_dir)
-        fast5_dirs = [ glob.glob(experiment_dir + '/' + sample + '/**/fast5*') for sample in samples ]
+        samples = [ sample for sample in os.listdir(experiment_dir) if sample not in minknow_basecalled ]
+        fast5_dirs = [ find_fast5_dirs(experiment_dir + '/' + sample) for sample in samples ]
         for sample,fast5_list in zip(samples, fast5_dirs):
-            if len(fast5_list) == 0 or any([ os.path.basename(x) == "fast5_pass" for x in fast5_list]): continue 
+            if any([ os.path.basename(x) == "fast5_pass" for x in fast5_list]):
+                minknow_basecalled.add(sample)
+                continue
+            if len(fast5_list) == 0: continue
             elif any([os.path.basename(x) == "fast5" for x in fast5_list]): 
                 basecall_dirs.add(os.path.dirname(fast5_list[0]))
 
             if len(basecall_dirs) >= num_basecall: return basecall_dirs
         time.sleep(120) #wait 2 minutes for data generation to begin and then check fast5 files again
 
-def run_job(job_command):
-    process_id = multiprocessing.Process()._identity[1]
-    #ensure the parallel jobs are using different gpu devices
-    job_command += " --device CUDA:{}".format(process_id - 1)
-    os.system(job_command)
+def run_job(job, device, wall_timeout=None, stall_timeout=DEFAULT_STALL_TIMEOUT):
+    job_id, job_command = job
+    #the leased device keeps parallel jobs on different gpus
+    job_command = job_command + ["--device", device]
+    print(" ".join(job_command))
+    result = run_command(
+        job_command,
+        log_path=job_id + ".log",
+        progress=GuppyProgress(),
+        wall_timeout=wall_timeout,
+        stall_timeout=stall_timeout,
+    )
+    print(format_result(job_id, result, device))
+    return result
+
+def guppy_command(fast5_dir, input_list, save_dir):
+    return ["guppy_basecaller", "--disable_pings",
+            "--input_path", fast5_dir, "--input_file_list", input_list,
+            "--save_path", save_dir, "--min_qscore", "7",
+            "-c", "dna_r9.4.1_450bps_hac_prom.cfg",
+            "--compress_fastq", "-q", "50000"]
 
-def update_job_list(basecall_dirs, fast5s_called_dict, job_number_dict):
+def update_job_list(basecall_dirs, watcher, job_number_dict, ledger):
     job_list = []
+    new_fast5_dict = watcher.poll()
     for sample_dir in basecall_dirs:
         fast5_dir = sample_dir + '/fast5'
-        current_fast5_files =  set(os.listdir(fast5_dir))
-        new_fast5s = current_fast5_files.difference(fast5s_called_dict[sample_dir])
+        new_fast5s = new_fast5_dict.get(fast5_dir, [])
         if len(new_fast5s) > 0:
             input_list = sample_dir + '/fastq/tmp/fast5_list_%d.txt' % job_number_dict[sample_dir]
             with open(input_list, 'w') as input_file:
-                print('\n'.join(list(new_fast5s), file = input_file))
+                print('\n'.join(new_fast5s), file = input_file)
             save_dir = sample_dir + '/fastq/' + 'guppy_job_%d' % job_number_dict[sample_dir]
-            command = ("guppy_basecaller --disable_pings" 
-                        "--input_path {} --input_file_list {}"
-                        "--save_path {} --min_qscore 7 "
-                        "-c dna_r9.4.1_450bps_hac_prom.cfg " 
-                        "--compress_fastq -q 50000 ").format(fast5_dir, input_list, save_dir)
-            job_list.append(command)
+            ledger.add(save_dir, input_list, save_dir, parent=sample_dir)
+            job_list.append((save_dir, guppy_command(fast5_dir, input_list, save_dir)))
             job_number_dict[sample_dir] += 1
-            fast5s_called_dict[sample_dir] = current_fast5_files
+            watcher.mark_dispatched(fast5_dir, new_fast5s)
     return job_list
 
-def initialize_fast5_dir(basecall_dirs, fast5s_called_dict, job_number_dict):
-    for sample_dir in basecall_dirs:
-        if not os.path.exists(sample_dir + '/fastq/tmp'):
-            return
+def retry_or_give_up(record, max_attempts):
+    """True if a failed job should run again, otherwise says which fast5s are left unbasecalled."""
+    if record.attempts < max_attempts:
+        return True
+    # its fast5s are in the dispatch index, so the watcher will not hand them out again
+    print("guppy job {} failed {} times, not retrying, the fast5s in {} are not basecalled".format(
+        record.job_id, record.attempts, record.input_path))
+    return False
 
-        fast5_file_lists = os.listdir(sample_dir + '/fastq/tmp'):
-        for fast5_file_list in fast5_file_lists:
-            with open(fast5_file_list, 'r') as f_in:
-                for line in f_in:
-                    fast5s_called_dict[sample_dir].add(line.strip())
-            job_num_dict[sample_dir] += 1
+def run_job_list(scheduler, job_list, ledger, wall_timeout=None, stall_timeout=DEFAULT_STALL_TIMEOUT, max_attempts=3):
+    """
+    Returns:
+        The failed jobs to run again.
+    """
+    def run_one(job, device):
+        ledger.start(job[0])
+        result = run_job(job, device, wall_timeout, stall_timeout)
+        ledger.finish(job[0], result.exit_status)
+        return result
+
+    retry = []
+    for job, device, result, seconds in run_jobs(job_list, scheduler, run_one):
+        if result.exit_status != 0:
+            print("guppy job {} failed ({}), see {}".format(
+                job[0], result.killed or "exit status {}".format(result.exit_status), result.log_path))
+            if retry_or_give_up(ledger.get(job[0]), max_attempts):
+                retry.append(job)
+    return retry
+
+def dispatch_index_path(sample_dir):
+    return sample_dir + '/fastq/tmp/dispatched_fast5s.txt'
+
+def initialize_fast5_dir(basecall_dirs, job_number_dict, ledger, max_attempts=3):
+    """Set up job numbers from the ledger and return the jobs a previous controller left unfinished or failed."""
+    job_list = []
+    for sample_dir in basecall_dirs:
+        tmp_dir = sample_dir + '/fastq/tmp'
+        if ledger.count(sample_dir) == 0 and os.path.exists(tmp_dir):
+            # first start with a ledger, record the job lists older controllers already sent to guppy
+            fast5_file_lists = sorted(f for f in os.listdir(tmp_dir) if f.startswith('fast5_list_'))
+            for fast5_file_list in fast5_file_lists:
+                job_number = int(fast5_file_list[len('fast5_list_'):-len('.txt')])
+                save_dir = sample_dir + '/fastq/' + 'guppy_job_%d' % job_number
+                ledger.add(save_dir, tmp_dir + '/' + fast5_file_list, save_dir, parent=sample_dir, state=DONE)
+            if not os.path.exists(dispatch_index_path(sample_dir)):
+                with open(dispatch_index_path(sample_dir), 'w') as out:
+                    for fast5_file_list in fast5_file_lists:
+                        with open(tmp_dir + '/' + fast5_file_list, 'r') as f_in:
+                            for line in f_in:
+                                if line.strip(): out.write(line.strip() + '\n')
+        job_number_dict[sample_dir] = ledger.count(sample_dir)
+        for record in ledger.jobs(states=(QUEUED, RUNNING, FAILED), parent=sample_dir):
+            if record.state == FAILED and not retry_or_give_up(record, max_attempts):
+                continue
+            job_list.append((record.job_id, guppy_command(sample_dir + '/fast5', record.input_path, record.output_path)))
+    return job_list
 
 
 def main():
     args = parse_args()
     basecall_dirs = get_sample_basecall_dirs(args.experiment_dir, args.num_basecall_samples)
-    fast5s_called_dict = defaultdict(set)
     job_number_dict = defaultdict(int)
-    fast5s_called_dict = initialize_fast5_dir(basecall_dirs, fast5s_called_dict, job_number_dict)
     for basecall_dir in basecall_dirs:
         if not os.path.exists(basecall_dir + '/fastq'):
             os.mkdir(basecall_dir + '/fastq')
         if not os.path.exists(basecall_dir + '/fastq/tmp'):
             os.mkdir(basecall_dir + '/fastq/tmp')
+    ledger = JobLedger(args.ledger or args.experiment_dir + '/basecall_ledger.sqlite')
+    unfinished_jobs = initialize_fast5_dir(basecall_dirs, job_number_dict, ledger, args.max_attempts)
+    watcher = Fast5Watcher(
+        dict((basecall_dir + '/fast5', dispatch_index_path(basecall_dir)) for basecall_dir in basecall_dirs),
+        suffixes=('.fast5',),
+    )
+    print("watching for new fast5 files with {}".format(watcher.backend))
 
-    job_list = []
+    job_list = unfinished_jobs
     while len(job_list) < args.num_basecall_samples:
-        job_list = update_job_list(basecall_dirs, fast5s_called_dict, job_number_dict)
+        job_list += update_job_list(basecall_dirs, watcher, job_number_dict, ledger)
         time.sleep(200) #wait about 3 minutes for more fast5s to be written
 
     # now jobs are in queue
-    pool = multiprocessing.Pool(processes = args.num_gpus)
+    scheduler = DeviceLeaseScheduler(["cuda:{}".format(i) for i in range(args.num_gpus)])
+    wall_timeout = args.job_timeout_hours * 3600 or None
+    stall_timeout = args.stall_minutes * 60 or None
     while len(job_list) > 0:
         while len(job_list) > 0:
-            pool.map(run_job, job_list)
-            job_list = update_job_list(basecall_dirs, fast5s_called_dict, job_number_dict)
+            retry = run_job_list(scheduler, job_list, ledger, wall_timeout, stall_timeout, args.max_attempts)
+            job_list = retry + update_job_list(basecall_dirs, watcher, job_number_dict, ledger)
 
         time.sleep(600) #wait 10 minutes to see if any more fast5s are written
-        job_list = update_job_list(basecall_dirs, fast5s_called_dict, job_number_dict)
-    print("completed all basecalling job. Quitting now".
+        job_list = update_job_list(basecall_dirs, watcher, job_number_dict, ledger)
+    watcher.close()
+    ledger.close()
+    for device, seconds in sorted(scheduler.utilisation().items()):
+        print("{} busy for {:.1f} minutes".format(device, seconds / 60))
+    print("completed all basecalling job. Quitting now.")
     print("Have a wonderful day UwU")
+
+
+if __name__ == "__main__":
+    main()
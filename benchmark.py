@@ -0,0 +1,238 @@
+"""
+Benchmark the run until and protocol start logic against a fake MinKNOW.
+
+Each scenario runs the repo's own code against a FakeManager (see
+fake_minknow.py) with injected RPC latency and synthetic yield and pore
+curves, on a simulated clock so whole runs finish in seconds:
+
+    run_until   per position targets through run_until_scheduler.run_until
+    rapid       aggregate target through run_until_rapid.run_until_rapid
+    start       protocol lookup and start from start_protocol.py (needs minknow_api for ProtocolRunUserInfo)
+    policy      one stop_policy.py evaluation of every rule over the whole fleet per cycle
+
+For every fleet size it reports RPC counts, sweep latency (real time),
+stop latency (simulated time from a target being crossed to the run being
+stopped) and overshoot (bases sequenced past the target).
+
+Example usage might be:
+
+    python benchmark.py --positions 12,48,500 --latency_ms 10 --jitter_ms 5
+    python benchmark.py --scenario run_until --positions 48
+"""
+
+import argparse
+import contextlib
+import io
+import random
+import time
+from types import SimpleNamespace
+
+import run_until_scheduler
+from connection_cache import PositionConnectionCache
+from fake_minknow import FakeManager, LatencyModel, SimClock
+from position_poller import poll_positions, DEFAULT_MAX_CONCURRENCY
+from run_until_scheduler import run_until
+
+SCENARIOS = ("run_until", "rapid", "start", "policy")
+
+
+@contextlib.contextmanager
+def patched(module, **attributes):
+    """Temporarily replace module attributes, e.g. its time module with a SimClock."""
+    saved = dict((name, getattr(module, name)) for name in attributes)
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+class SweepTimer(object):
+    """poll_positions wrapper recording the real time each sweep took."""
+
+    def __init__(self):
+        self.sweeps = []
+
+    def __call__(self, positions, *args, **kwargs):
+        start = time.time()
+        results = poll_positions(positions, *args, **kwargs)
+        if results:
+            self.sweeps.append(time.time() - start)
+        return results
+
+
+def report(name, n, manager, clock_start, clock, wall, sweeps, stop_latencies, overshoots, note=""):
+    counts = manager.rpc_counts()
+    print("%s  positions=%d  wall %.1f s  simulated %.1f h%s" % (
+        name, n, wall, (clock.time() - clock_start) / 3600, note))
+    print("    rpcs: %d total (%s)" % (
+        sum(counts.values()), ", ".join("%s %d" % x for x in sorted(counts.items(), key=lambda x: -x[1]))))
+    if sweeps:
+        print("    sweeps: %d, latency p50 %.0f ms, p95 %.0f ms, max %.0f ms" % (
+            len(sweeps), percentile(sweeps, 50) * 1e3, percentile(sweeps, 95) * 1e3, max(sweeps) * 1e3))
+    if stop_latencies:
+        print("    stop latency: p50 %.1f min, p95 %.1f min, max %.1f min over %d stops" % (
+            percentile(stop_latencies, 50) / 60, percentile(stop_latencies, 95) / 60,
+            max(stop_latencies) / 60, len(stop_latencies)))
+        print("    overshoot: mean %.1f Mb, max %.1f Mb" % (
+            sum(overshoots) / len(overshoots) / 1e6, max(overshoots) / 1e6))
+
+
+def bench_run_until(n, latency, args):
+    clock = SimClock()
+    manager = FakeManager.with_positions(n, clock, latency, seed=args.seed)
+    rng = random.Random(args.seed)
+    target_yields = dict((pos.name, pos.run.max_yield * rng.uniform(0.55, 0.8)) for pos in manager.positions)
+    timer = SweepTimer()
+    clock_start = clock.time()
+    start = time.time()
+    with patched(run_until_scheduler, time=clock, poll_positions=timer), contextlib.redirect_stdout(io.StringIO()):
+        run_until(manager, target_yields, args.max_concurrency, PositionConnectionCache(),
+                  pore_threshold=args.pore_threshold, wait_for_start=True)
+    wall = time.time() - start
+
+    stop_latencies = []
+    overshoots = []
+    exhausted = 0
+    for pos in manager.positions:
+        if pos.stopped_at is None:
+            exhausted += 1
+            continue
+        crossed_at = pos.started_at + pos.run.time_to_yield(target_yields[pos.name])
+        stop_latencies.append(pos.stopped_at - crossed_at)
+        overshoots.append(pos.yield_at(pos.stopped_at) - target_yields[pos.name])
+    report("run_until", n, manager, clock_start, clock, wall, timer.sweeps, stop_latencies, overshoots,
+           "  (%d runs left to sequence to exhaustion)" % exhausted if exhausted else "")
+
+
+def bench_rapid(n, latency, args):
+    """run_until_rapid.run_until_rapid without the plots: one aggregate target over every position."""
+    import run_until_rapid
+    from stop_policy import StopPolicy, AggregateTargetRule
+
+    clock = SimClock()
+    manager = FakeManager.with_positions(n, clock, latency, seed=args.seed)
+    target_yield = sum(pos.run.max_yield for pos in manager.positions) * 0.6
+    timer = SweepTimer()
+    clock_start = clock.time()
+    start = time.time()
+    with patched(run_until_rapid, time=clock, poll_positions=timer), contextlib.redirect_stdout(io.StringIO()):
+        run_until_rapid.run_until_rapid(manager, StopPolicy([AggregateTargetRule(target_yield / 1e9)]), target_yield,
+                                        PositionConnectionCache(), max_concurrency=args.max_concurrency)
+    wall = time.time() - start
+
+    # the moment the fleet total crossed target, by bisection on the synthetic curves
+    def total_at(t):
+        return sum(pos.run.yield_at(t - pos.started_at) for pos in manager.positions)
+    low, high = clock_start, clock.time()
+    for _ in range(60):
+        mid = (low + high) / 2
+        if total_at(mid) < target_yield: low = mid
+        else: high = mid
+    stopped_at = max(pos.stopped_at for pos in manager.positions)
+    overshoot = sum(pos.yield_at(pos.stopped_at) for pos in manager.positions) - target_yield
+    report("rapid", n, manager, clock_start, clock, wall, timer.sweeps, [stopped_at - high], [overshoot])
+
+
+def bench_start(n, latency, args):
+    try:
+        import start_protocol
+        import minknow_api.protocol_pb2
+    except ImportError as e:
+        print("start  positions=%d  skipped, start_protocol.py needs %s" % (n, e.name))
+        return
+    from protocol_start import ProtocolResolver, RateLimiter, run_per_position
+    from sample_sheet import SampleSheet, SampleSheetEntry
+
+    clock = SimClock()
+    manager = FakeManager.with_positions(n, clock, latency, seed=args.seed, started=False)
+    start_args = SimpleNamespace(
+        kit="SQK-LSK110", start_concurrency=args.start_concurrency, experiment_duration=72,
+        fast5_reads_per_file=10000, fastq_reads_per_file=10000, mux_scan_period=1.5, min_qscore=7)
+    sheet = SampleSheet(SampleSheetEntry(pos.name, "sample_%d" % i, "benchmark")
+                        for i, pos in enumerate(manager.flow_cell_positions()))
+    specs = [start_protocol.ExperimentSpec(entry) for entry in sheet]
+    start_protocol.add_position_info(specs, manager)
+    for i, spec in enumerate(specs):
+        spec.basecalling = i < 12
+    connection_cache = PositionConnectionCache()
+    resolver = ProtocolResolver()
+    rate_limiter = RateLimiter(args.start_rate)
+
+    clock_start = clock.time()
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        lookup = run_per_position(specs, lambda spec: start_protocol.add_protocol_id(spec, start_args, connection_cache, resolver),
+                                  max_concurrency=args.start_concurrency)
+        lookup_wall = time.time() - start
+        starts = run_per_position(specs, lambda spec: start_protocol.start_experiment(spec, start_args, connection_cache, rate_limiter),
+                                  max_concurrency=args.start_concurrency)
+    wall = time.time() - start
+    report("start", n, manager, clock_start, clock, wall, [], [], [],
+           "  (lookup %.2f s, start %.2f s, slowest position %.2f s, %d protocol searches)" % (
+               lookup_wall, wall - lookup_wall, max(x[2] for x in lookup + starts), resolver.misses))
+
+
+def bench_policy(n, latency, args, cycles=200):
+    """Real time per cycle of a StopPolicy with every rule, on synthetic yields, pores and rates."""
+    import numpy as np
+    from stop_policy import build_policy
+
+    policy = build_policy({"rules": [
+        {"rule": "target"},
+        {"rule": "aggregate_target", "gigabases": 1e6},
+        {"rule": "pore_floor", "pores": args.pore_threshold},
+        {"rule": "rate_decay", "fraction": 0.15, "min_hours": 24},
+        {"rule": "max_runtime", "hours": 72},
+    ]})
+    rng = np.random.default_rng(args.seed)
+    names = ["%d%s" % (i // 8 + 1, "ABCDEFGH"[i % 8]) for i in range(n)]
+    rates = rng.uniform(0.5e6, 2e6, n)
+    targets = rng.uniform(100e9, 160e9, n)
+    started_at = -rng.uniform(0, 3600, n)
+    timings = []
+    decided = 0
+    for cycle in range(cycles):
+        now = cycle * 600.0
+        yields = rates * (now - started_at)
+        pores = np.maximum(0, 8000 - (now - started_at) / 30 + rng.normal(0, 100, n))
+        start = time.perf_counter()
+        result = policy.evaluate(now, names, yields, targets, pores, None, started_at)
+        decided += sum(1 for x in result.fired())
+        timings.append(time.perf_counter() - start)
+    print("policy  positions=%d  %d cycles, %d rules" % (n, cycles, len(policy.rules)))
+    print("    evaluate: p50 %.3f ms, p95 %.3f ms per cycle (%.2f us per position), %d decisions explained" % (
+        percentile(timings, 50) * 1e3, percentile(timings, 95) * 1e3, percentile(timings, 50) / n * 1e6, decided))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark run until and protocol start logic against a fake MinKNOW.")
+    parser.add_argument("--positions", default="12,48,500", help="comma separated fleet sizes [default 12,48,500]")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="scenario to run, may be repeated [default all]")
+    parser.add_argument("--latency_ms", type=float, default=10, help="mean RPC latency in milliseconds [default 10]")
+    parser.add_argument("--jitter_ms", type=float, default=5, help="mean exponential jitter added to each RPC in milliseconds [default 5]")
+    parser.add_argument("--max_concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="positions polled in parallel [default %d]" % DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--pore_threshold", type=int, default=1500, help="pores needed to stop a run at target [default 1500]")
+    parser.add_argument("--start_concurrency", type=int, default=8, help="positions started in parallel [default 8]")
+    parser.add_argument("--start_rate", type=float, default=0, help="max start_protocol calls per second, 0 for no limit [default 0]")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic runs [default 0]")
+    args = parser.parse_args()
+
+    benches = {"run_until": bench_run_until, "rapid": bench_rapid, "start": bench_start, "policy": bench_policy}
+    for scenario in args.scenario or SCENARIOS:
+        for n in [int(x) for x in args.positions.split(",")]:
+            latency = LatencyModel(args.latency_ms / 1e3, args.jitter_ms / 1e3, seed=args.seed)
+            benches[scenario](n, latency, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+File digests for verifying transfers.
+
+Files are hashed through a memory map in chunk_size pieces, so a multi-GB pod5
+or BAM is never copied into Python memory whole. Many files are hashed in
+parallel on threads (hashlib releases the GIL while it hashes). Digests use
+the standard algorithms, so a remote copy can be checked with the matching
+coreutils tool (sha256sum, md5sum, b2sum) over ssh, without reading it back
+across the network. copy_file_digest() hashes a file while copying it, so a
+local transfer reads the source only once.
+
+Example usage might be:
+
+    digests, seconds = digest_files(paths, workers=8)
+    remote = remote_digests("user@host", "/oak/.../RUSHAD_P12", relpaths)
+
+    python checksum.py run1/pod5/*.pod5 --workers 8
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_ALGORITHM = "sha256"
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_WORKERS = 4
+# coreutils tool printing the same digest as each hashlib algorithm
+SUM_TOOLS = {"sha256": "sha256sum", "sha1": "sha1sum", "md5": "md5sum", "blake2b": "b2sum", "sha512": "sha512sum"}
+
+
+def file_digest(path, algorithm=DEFAULT_ALGORITHM, chunk_size=DEFAULT_CHUNK_SIZE):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f_in:
+        size = os.fstat(f_in.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                for offset in range(0, size, chunk_size):
+                    digest.update(view[offset:offset + chunk_size])
+    return digest.hexdigest()
+
+
+def copy_file_digest(source, dest, algorithm=DEFAULT_ALGORITHM, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Copy source to dest in chunk_size pieces, hashing each piece as it is read.
+
+    The copy is written to a hidden temporary file next to dest and renamed into
+    place with the source's mode and mtime, so a partial copy is never mistaken
+    for a finished one.
+
+    Returns:
+        Hex digest of the bytes read from source.
+    """
+    digest = hashlib.new(algorithm)
+    directory, name = os.path.split(dest)
+    with open(source, 'rb') as f_in:
+        stat = os.fstat(f_in.fileno())
+        with tempfile.NamedTemporaryFile('wb', dir=directory or '.', prefix='.%s.' % name, delete=False) as out:
+            try:
+                buffer = bytearray(min(chunk_size, max(1, stat.st_size)))
+                with memoryview(buffer) as view:
+                    while True:
+                        read = f_in.readinto(buffer)
+                        if not read:
+                            break
+                        digest.update(view[:read])
+                        out.write(view[:read])
+                out.flush()
+                os.fchmod(out.fileno(), stat.st_mode & 0o7777)
+            except BaseException:
+                os.remove(out.name)
+                raise
+    os.utime(out.name, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(out.name, dest)
+    return digest.hexdigest()
+
+
+def digest_files(paths, algorithm=DEFAULT_ALGORITHM, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns:
+        ({path: hex digest}, seconds taken). Files that cannot be read are left out.
+    """
+    paths = list(paths)
+    start = time.time()
+
+    def one(path):
+        try:
+            return path, file_digest(path, algorithm, chunk_size)
+        except OSError as e:
+            print("Could not hash %s: %s" % (path, e))
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths) or 1))) as pool:
+        digests = dict((path, digest) for path, digest in pool.map(one, paths) if digest is not None)
+    return digests, time.time() - start
+
+
+def split_remote(dest):
+    """(host, path) for an rsync style host:path destination, (None, dest) for a local one."""
+    host, sep, path = dest.partition(':')
+    if sep and '/' not in host:
+        return host, path
+    return None, dest
+
+
+def remote_digests(host, directory, relpaths, algorithm=DEFAULT_ALGORITHM, ssh="ssh"):
+    """Digests of directory/relpath on host, computed there with the coreutils sum tool.
+
+    Returns:
+        {relpath: hex digest} for every file the remote tool could read.
+    """
+    if algorithm not in SUM_TOOLS:
+        raise ValueError("no coreutils tool for %s, use one of %s" % (algorithm, ", ".join(sorted(SUM_TOOLS))))
+    command = "cd %s && xargs -0 %s --" % (_shell_quote(directory), SUM_TOOLS[algorithm])
+    process = subprocess.run([ssh, host, command], input='\0'.join(relpaths), stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    digests = {}
+    for line in process.stdout.splitlines():
+        digest, sep, relpath = line.partition('  ')
+        if sep:
+            digests[relpath] = digest
+    return digests
+
+
+def _shell_quote(text):
+    return "'" + text.replace("'", "'\"'\"'") + "'"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hash files in parallel, output matches sha256sum.")
+    parser.add_argument("files", nargs="+", help="files to hash")
+    parser.add_argument("--algorithm", default=DEFAULT_ALGORITHM, help="hashlib algorithm [default %s]" % DEFAULT_ALGORITHM)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="files hashed in parallel [default %d]" % DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    digests, seconds = digest_files(args.files, args.algorithm, args.workers)
+    for path in args.files:
+        if path in digests:
+            print("%s  %s" % (digests[path], path))
+    total = sum(os.path.getsize(path) for path in digests)
+    print("hashed %.2f GB in %.1f s (%.2f GB/s)" % (total / 1e9, seconds, total / 1e9 / max(seconds, 1e-9)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
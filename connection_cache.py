@@ -0,0 +1,91 @@
+"""
+Cache of open MinKNOW position connections keyed by position name.
+
+pos.connect() sets up a fresh gRPC channel every time it is called. The run
+until loops and start_protocol scripts connect to the same positions over and
+over, so the cache keeps one connection per position open across cycles and
+only reconnects when the position looks different from the one it connected
+to (restarted on new rpc ports, stopped, or a call on it failed).
+
+Example usage might be:
+
+    cache = PositionConnectionCache()
+    connection = cache.connect(pos)
+    ...
+    print(cache.stats_summary())
+"""
+
+import threading
+import time
+
+
+def position_fingerprint(pos):
+    """Identify a running instance of a position.
+
+    A restarted position comes back with new rpc ports, so the ports and the
+    running state together tell us whether a cached channel is still pointing
+    at the same MinKNOW instance.
+    """
+    description = getattr(pos, "description", None)
+    rpc_ports = getattr(description, "rpc_ports", None)
+    ports = None
+    if rpc_ports is not None:
+        ports = (getattr(rpc_ports, "secure", None), getattr(rpc_ports, "insecure", None))
+    return (ports, getattr(pos, "running", True))
+
+
+class PositionConnectionCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.connect_seconds = 0.0
+
+    def connect(self, pos):
+        """Return an open connection to pos, reusing a cached one when possible."""
+        fingerprint = position_fingerprint(pos)
+        with self._lock:
+            entry = self._entries.get(pos.name)
+            if entry is not None and entry[0] == fingerprint:
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                # position restarted or stopped since we last connected
+                self.invalidations += 1
+                del self._entries[pos.name]
+
+        start = time.time()
+        connection = pos.connect()
+        elapsed = time.time() - start
+
+        with self._lock:
+            self.misses += 1
+            self.connect_seconds += elapsed
+            self._entries[pos.name] = (fingerprint, connection)
+        return connection
+
+    def invalidate(self, name):
+        """Drop the cached connection for a position so the next connect() redials."""
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                self.invalidations += 1
+
+    def prune(self, positions):
+        """Forget positions that are no longer reported by the manager."""
+        names = set(pos.name for pos in positions)
+        with self._lock:
+            for name in list(self._entries):
+                if name not in names:
+                    del self._entries[name]
+                    self.invalidations += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats_summary(self):
+        """One line summary of hit/miss counts and the handshake time saved."""
+        mean_connect = self.connect_seconds / self.misses if self.misses else 0.0
+        return "Connection cache: %d hits, %d misses, %d reconnects, ~%.1f s of connection setup saved" % (
+            self.hits, self.misses, self.invalidations, self.hits * mean_connect)
@@ -0,0 +1,444 @@
+"""
+Live terminal dashboard of every flow cell position.
+
+A background poller sweeps MinKNOW every poll_interval seconds and folds
+the results into a FleetView, which publishes an immutable
+DashboardSnapshot (one row per position: status, yield, single pores,
+smoothed rate, time to target and a sparkline of recent rate). A render
+thread reads the latest snapshot every refresh_interval seconds and hands
+the frame to a Screen, which repaints only the cells that changed since
+the last frame. A slow RPC therefore never freezes the display, and a slow
+terminal never delays a poll; the two rates are set independently.
+
+run_until_rapid.py --dashboard feeds its own poll results into a FleetView
+instead of redrawing plotext plots on its polling thread.
+
+Example usage might be:
+
+    python dashboard.py --host localhost --target sample_sheet.tsv --poll_interval 30 --refresh_interval 1
+    python dashboard.py --fake_positions 48 --poll_interval 2
+
+    view = FleetView(target_yields)
+    render = RenderThread(view, Screen(), refresh_interval=1)
+    render.start()
+    for result in poll_positions(positions):
+        view.record_result(time.time(), result)
+    view.publish(time.time())
+"""
+
+import argparse
+import shutil
+import sys
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from position_poller import poll_positions, DEFAULT_MAX_CONCURRENCY
+from connection_cache import PositionConnectionCache
+from fleet_snapshot import SnapshotSource
+from telemetry_log import single_pores
+from yield_forecast import YieldForecaster
+from sample_sheet import parse_target, SampleSheetError, DEFAULT_TARGET_GB
+
+DEFAULT_POLL_INTERVAL = 30
+DEFAULT_REFRESH_INTERVAL = 1
+DEFAULT_SPARK_WIDTH = 24
+SPARK_CHARS = u"▁▂▃▄▅▆▇█"
+# MinknowStatus enum codes returned by acquisition.current_status()
+STATUS_NAMES = {0: "error", 1: "ready", 2: "starting", 3: "running", 4: "finishing"}
+TOTAL = "total"
+
+
+class DashboardRow(NamedTuple):
+    position: str
+    status: str
+    yield_bases: Optional[float]
+    pores: Optional[int]
+    # bases per second
+    rate: Optional[float]
+    # seconds to target from the last sample, None when unknown or already reached
+    eta: Optional[float]
+    target: Optional[float]
+    sparkline: str
+
+
+class DashboardSnapshot(NamedTuple):
+    taken_at: float
+    rows: tuple
+    total: DashboardRow
+    sweeps: int
+    sweep_seconds: Optional[float]
+    errors: int
+    # (position, decision, time) of every run until stop decision, e.g. "stopped"
+    decisions: tuple = ()
+
+
+def sparkline(values, width=DEFAULT_SPARK_WIDTH):
+    """Last width values as unicode block characters scaled to the largest of them."""
+    import numpy as np
+
+    values = np.asarray(values, dtype=float)[-width:]
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return ""
+    high = values.max()
+    if high <= 0:
+        return SPARK_CHARS[0] * len(values)
+    levels = np.clip(values / high * (len(SPARK_CHARS) - 1), 0, len(SPARK_CHARS) - 1).round().astype(int)
+    return "".join(SPARK_CHARS[level] for level in levels)
+
+
+def recent_rates(series, width):
+    """Yield rate between consecutive samples of a TimeSeriesBuffer, bases per second."""
+    import numpy as np
+
+    view = series.view()[-(width + 1):]
+    if len(view) < 2:
+        return np.empty(0)
+    dt = np.diff(view[:, 0])
+    dy = np.diff(view[:, 3])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(dt > 0, dy / dt, np.nan)
+
+
+class FleetView(object):
+    """Per position yield history and forecasts, published as DashboardSnapshots."""
+
+    def __init__(self, target_yields=None, total_target=None, spark_width=DEFAULT_SPARK_WIDTH):
+        """
+        Args:
+            target_yields: position name to target in bases (e.g. from sample_sheet.parse_target), None for no targets.
+            total_target: target in bases for the summed yield of all positions, shown on the total row.
+        """
+        # imported here so --help and the controllers that only read DEFAULT_REFRESH_INTERVAL start without numpy
+        from timeseries_buffer import TimeSeriesStore
+
+        self.target_yields = target_yields
+        self.total_target = total_target
+        self.spark_width = spark_width
+        self._lock = threading.Lock()
+        self._history = TimeSeriesStore(capacity=max(64, spark_width * 2))
+        self._forecasters = {}
+        self._current = {}
+        self._errors = 0
+        self._decisions = {}
+        self.sweeps = 0
+        self.sweep_seconds = None
+        # replaced, never mutated, so readers need no lock
+        self.snapshot = DashboardSnapshot(time.time(), (), self._row(TOTAL, "", None, None, None), 0, None, 0)
+
+    def record(self, now, name, status, yield_bases, pores):
+        """Record one position's state, yield_bases None if it is not sequencing."""
+        with self._lock:
+            previous = self._current.get(name, (None, None, None))
+            if yield_bases is not None:
+                self._history.append(name, now, yield_bases)
+                self._forecasters.setdefault(name, YieldForecaster()).add(now, yield_bases)
+            # keep the last known yield and pores of a position that stopped sequencing
+            self._current[name] = (status,
+                                   yield_bases if yield_bases is not None else previous[1],
+                                   pores if pores is not None else previous[2])
+
+    def decide(self, now, name, decision):
+        """Record a controller decision about a position, shown as its status from then on."""
+        with self._lock:
+            self._decisions[name] = (decision, now)
+
+    def record_result(self, now, result):
+        """Record a position_poller.PositionStatus."""
+        if result.error is not None:
+            with self._lock:
+                self._errors += 1
+            self.record(now, result.name, "error", None, None)
+            return
+        status = STATUS_NAMES.get(result.status, "none" if result.status is None else str(result.status))
+        if not result.has_flow_cell:
+            status = "no cell"
+        if result.is_processing:
+            self.record(now, result.name, status, result.acquisition_info.yield_summary.estimated_selected_bases,
+                        single_pores(result.acquisition_info))
+        else:
+            self.record(now, result.name, status, None, None)
+
+    def _target(self, name):
+        if self.target_yields is None:
+            return None
+        return self.target_yields[name]
+
+    def _row(self, name, status, yield_bases, pores, forecaster, target=None, spark=""):
+        rate = eta = None
+        if forecaster is not None:
+            rate = forecaster.rate
+            if target is not None and yield_bases is not None and yield_bases < target:
+                forecast = forecaster.predict_crossing(target)
+                eta = forecast.seconds if forecast is not None else None
+        return DashboardRow(name, status, yield_bases, pores, rate, eta, target, spark)
+
+    def publish(self, now, sweep_seconds=None):
+        """Build a new snapshot from everything recorded so far.
+
+        Returns:
+            DashboardSnapshot, also stored on self.snapshot.
+        """
+        with self._lock:
+            if sweep_seconds is not None:
+                self.sweeps += 1
+                self.sweep_seconds = sweep_seconds
+            rows = []
+            total_yield = 0.0
+            total_rate = 0.0
+            for name in sorted(self._current):
+                status, yield_bases, pores = self._current[name]
+                if name in self._decisions:
+                    status = self._decisions[name][0]
+                spark = sparkline(recent_rates(self._history[name], self.spark_width), self.spark_width) if name in self._history else ""
+                row = self._row(name, status, yield_bases, pores, self._forecasters.get(name), self._target(name), spark)
+                rows.append(row)
+                total_yield += yield_bases or 0.0
+                if status == "running" and row.rate is not None:
+                    total_rate += row.rate
+            total_eta = None
+            if self.total_target is not None and total_yield < self.total_target and total_rate > 0:
+                total_eta = (self.total_target - total_yield) / total_rate
+            total = DashboardRow(TOTAL, "%d running" % sum(1 for row in rows if row.status == "running"),
+                                 total_yield, sum(row.pores or 0 for row in rows), total_rate, total_eta,
+                                 self.total_target, "")
+            decisions = tuple((name, decision, when) for name, (decision, when) in sorted(self._decisions.items()))
+            self.snapshot = DashboardSnapshot(now, tuple(rows), total, self.sweeps, self.sweep_seconds, self._errors, decisions)
+            return self.snapshot
+
+
+class BackgroundPoller(threading.Thread):
+    """Polls every poll_interval seconds into a FleetView on its own thread."""
+
+    def __init__(self, manager, view, poll_interval=DEFAULT_POLL_INTERVAL, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 connection_cache=None, position_filter=None, clock=time):
+        super().__init__(daemon=True)
+        self.manager = manager
+        self.view = view
+        self.poll_interval = poll_interval
+        self.max_concurrency = max_concurrency
+        self.connection_cache = connection_cache if connection_cache is not None else PositionConnectionCache()
+        self.snapshots = SnapshotSource(manager, self.connection_cache)
+        self.position_filter = position_filter
+        self.clock = clock
+        self.stopped = threading.Event()
+
+    def poll_once(self):
+        start = time.time()
+        snapshot = self.snapshots.next_cycle()
+        positions = snapshot.positions()
+        snapshot.prune(positions)
+        if self.position_filter is not None:
+            positions = [pos for pos in positions if self.position_filter(pos.name)]
+        results = poll_positions(positions, self.max_concurrency, connection_cache=snapshot, report_errors=False)
+        now = self.clock.time()
+        for result in results:
+            self.view.record_result(now, result)
+        return self.view.publish(now, time.time() - start)
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.time()
+            try:
+                self.poll_once()
+            except Exception as e:
+                # the manager itself is unreachable, show the last snapshot and try again next interval
+                print("Poll failed: %s" % e, file=sys.stderr)
+            self.stopped.wait(max(0.0, self.poll_interval - (time.time() - start)))
+
+    def stop(self):
+        self.stopped.set()
+
+
+def format_gb(bases):
+    return "" if bases is None else "%.2f" % (bases / 1e9)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return ""
+    if seconds == float("inf"):
+        return "never"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+
+# (heading, width, cell of a DashboardRow)
+COLUMNS = [
+    ("position", 9, lambda row: row.position),
+    ("status", 10, lambda row: row.status),
+    ("yield Gb", 9, lambda row: format_gb(row.yield_bases)),
+    ("target", 7, lambda row: "" if row.target is None else "%.0f" % (row.target / 1e9)),
+    ("pores", 6, lambda row: "" if row.pores is None else "%d" % row.pores),
+    ("Gb/h", 7, lambda row: "" if row.rate is None else "%.2f" % (row.rate * 3600 / 1e9)),
+    ("eta", 8, lambda row: format_duration(row.eta)),
+    ("rate", DEFAULT_SPARK_WIDTH, lambda row: row.sparkline),
+]
+
+
+def build_frame(snapshot, now, height=None, title="MinKNOW dashboard"):
+    """Frame for a snapshot as a list of lines, each a list of cells.
+
+    Rows past the terminal height are summarized in one line.
+    """
+    def cells(values):
+        return [value[:width].rjust(width) if i not in (0, 1, len(COLUMNS) - 1) else value[:width].ljust(width)
+                for i, ((heading, width, get), value) in enumerate(zip(COLUMNS, values))]
+
+    age = now - snapshot.taken_at if snapshot.sweeps else None
+    status = "polled %s ago" % format_duration(age) if age is not None else "waiting for the first poll"
+    if snapshot.sweep_seconds is not None:
+        status += ", sweep %.1f s, %d sweeps, %d errors" % (snapshot.sweep_seconds, snapshot.sweeps, snapshot.errors)
+    frame = [[title], [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)) + "  " + status],
+             cells([heading for heading, width, get in COLUMNS])]
+    rows = list(snapshot.rows)
+    if height is not None and len(rows) > max(1, height - 5):
+        shown = max(1, height - 6)
+        hidden = len(rows) - shown
+        rows = rows[:shown]
+    else:
+        hidden = 0
+    frame.extend(cells([get(row) for heading, width, get in COLUMNS]) for row in rows)
+    if hidden:
+        frame.append(["... %d more positions" % hidden])
+    frame.append(cells([get(snapshot.total) for heading, width, get in COLUMNS]))
+    return frame
+
+
+class Screen(object):
+    """Draws frames with ANSI escapes, writing only the cells that changed since the last frame."""
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self._previous = None
+        self._size = None
+        self.cells_written = 0
+        self.cells_skipped = 0
+
+    def draw(self, frame):
+        size = shutil.get_terminal_size()
+        out = []
+        if self._previous is None or size != self._size:
+            # first frame or the terminal was resized, repaint everything
+            out.append("\x1b[?25l\x1b[2J")
+            self._previous = []
+            self._size = size
+        for i, line in enumerate(frame):
+            previous = self._previous[i] if i < len(self._previous) else None
+            if previous is not None and len(previous) != len(line):
+                out.append("\x1b[%d;1H\x1b[2K" % (i + 1))
+                previous = None
+            column = 1
+            for j, cell in enumerate(line):
+                if previous is not None and previous[j] == cell:
+                    self.cells_skipped += 1
+                else:
+                    # pad over whatever was there when a cell got shorter
+                    width = max(len(cell), len(previous[j])) if previous is not None else len(cell)
+                    out.append("\x1b[%d;%dH%s" % (i + 1, column, cell.ljust(width)))
+                    self.cells_written += 1
+                column += len(cell) + 1
+        for i in range(len(frame), len(self._previous)):
+            out.append("\x1b[%d;1H\x1b[2K" % (i + 1))
+        out.append("\x1b[%d;1H" % (len(frame) + 1))
+        self._previous = frame
+        self.stream.write("".join(out))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write("\x1b[?25h\n")
+        self.stream.flush()
+
+
+def print_frame(frame, stream=None):
+    """Plain text frame, for --once and output that is not a terminal."""
+    stream = stream if stream is not None else sys.stdout
+    for line in frame:
+        stream.write(" ".join(line).rstrip() + "\n")
+    stream.flush()
+
+
+class RenderThread(threading.Thread):
+    """Draws the view's latest snapshot every refresh_interval seconds."""
+
+    def __init__(self, view, screen, refresh_interval=DEFAULT_REFRESH_INTERVAL, clock=time, title="MinKNOW dashboard"):
+        super().__init__(daemon=True)
+        self.view = view
+        self.screen = screen
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.title = title
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            height = shutil.get_terminal_size().lines
+            self.screen.draw(build_frame(self.view.snapshot, self.clock.time(), height, self.title))
+            self.stopped.wait(self.refresh_interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.screen.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live per position yield, pores, rate and time to target.")
+    parser.add_argument("--host", default="localhost", help="Specify which host to connect to.")
+    parser.add_argument("--port", default=None, help="Specify which port to connect to.")
+    parser.add_argument("--target", default=str(DEFAULT_TARGET_GB), help="Gigabase yield target, or a sample sheet with a target column, used for the eta column. [default %d]" % DEFAULT_TARGET_GB)
+    parser.add_argument("--flowcell_positions", default=None, help="Comma-seperated list of flowcell positions to show [defaults to all]")
+    parser.add_argument("--poll_interval", type=float, default=DEFAULT_POLL_INTERVAL, help="Seconds between polls of MinKNOW. [default %d]" % DEFAULT_POLL_INTERVAL)
+    parser.add_argument("--refresh_interval", type=float, default=DEFAULT_REFRESH_INTERVAL, help="Seconds between screen refreshes. [default %d]" % DEFAULT_REFRESH_INTERVAL)
+    parser.add_argument("--max_concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Max number of positions polled in parallel. [default %d]" % DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--metrics_port", type=int, default=0, help="Also serve the polled snapshot as Prometheus metrics on this port. [default 0, off]")
+    parser.add_argument("--once", default=False, action="store_true", help="Poll once, print a plain table and exit.")
+    parser.add_argument("--fake_positions", type=int, default=0, help="Show N simulated positions from fake_minknow.py instead of connecting to MinKNOW.")
+    args = parser.parse_args()
+
+    try:
+        target_yields = parse_target(args.target)
+    except (OSError, SampleSheetError) as e:
+        parser.error(str(e))
+    target_positions = None
+    if args.flowcell_positions is not None:
+        target_positions = set(args.flowcell_positions.strip().split(','))
+
+    clock = time
+    if args.fake_positions:
+        from fake_minknow import FakeManager, SimClock
+        clock = SimClock()
+        manager = FakeManager.with_positions(args.fake_positions, clock, start_spread=0)
+    else:
+        # imported here so --help starts without loading grpc
+        from minknow_api.manager import Manager
+        manager = Manager(host=args.host, port=args.port)
+
+    view = FleetView(target_yields)
+    poller = BackgroundPoller(manager, view, args.poll_interval, args.max_concurrency, clock=clock,
+                              position_filter=None if target_positions is None else lambda name: name in target_positions)
+    if args.metrics_port:
+        from metrics_exporter import MetricsExporter
+        MetricsExporter(view, port=args.metrics_port).start()
+    if args.once or not sys.stdout.isatty():
+        print_frame(build_frame(poller.poll_once(), clock.time()))
+        return
+
+    poller.start()
+    render = RenderThread(view, Screen(), args.refresh_interval, clock)
+    render.start()
+    try:
+        while render.is_alive():
+            render.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.stop()
+        render.stop()
+
+
+if __name__ == "__main__":
+    main()
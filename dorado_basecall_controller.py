@@ -1,10 +1,16 @@
 import argparse
 from collections import defaultdict
-import multiprocessing
 import sys
 import os
 import glob
+import shutil
+import subprocess
 import time
+from typing import NamedTuple
+from gpu_scheduler import DeviceLeaseScheduler, run_jobs
+from job_planner import pod5_files, plan_shards, longest_first, predict_makespan
+from job_ledger import JobLedger, RUNNING, CHECKPOINTED, DONE
+from job_runner import run_command, format_result, DoradoProgress, DEFAULT_STALL_TIMEOUT
 
 """
 python dorado_basecall_controller.py --pod5_list /samples_to_basecall.pod5_list.txt --num_gpus 4
@@ -31,7 +37,18 @@ def parse_args():
         "--num_gpus",
         type=int,
         default=4,
-        help="Number of CUDA gpu decies on machine. (Prom_beta has 2, p48 has 4) [Defaults to 2] "
+        help="Number of CUDA gpu decies on machine. (Prom_beta has 2, p48 has 4) [Defaults to 4] "
+    )
+    parser.add_argument(
+        "--jobs_per_gpu",
+        type=int,
+        default=1,
+        help="Number of dorado jobs allowed to share one gpu at a time [Defaults to 1]"
+    )
+    parser.add_argument(
+        "--dorado",
+        default="/data/tanner_scripts/dorado-0.6.1-linux-x64/bin/dorado",
+        help="Path to the dorado executable"
     )
     parser.add_argument(
         "--flowcell_pore",
@@ -39,57 +56,275 @@ def parse_args():
         help="flowcell R9 or R10 to be used to select which dorado model to run",
         default="r10"
     )
+    parser.add_argument(
+        "--max_shard_gb",
+        type=float,
+        default=250,
+        help="pod5 directories larger than this are split into shards basecalled as separate jobs, 0 to never split [Defaults to 250]"
+    )
+    parser.add_argument(
+        "--gb_per_hour",
+        type=float,
+        default=40,
+        help="pod5 gigabytes one job basecalls per hour, only used for the predicted makespan [Defaults to 40]"
+    )
+    parser.add_argument(
+        "--samtools",
+        default="samtools",
+        help="Path to the samtools executable used to merge shard bams [Defaults to samtools on PATH]"
+    )
+    parser.add_argument(
+        "--ledger",
+        help="SQLite job ledger tracking which directories are basecalled [Defaults to <pod5_list>.ledger.sqlite]"
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        default=3,
+        help="failed jobs are retried on the next start until they have been attempted this many times [Defaults to 3]"
+    )
+    parser.add_argument(
+        "--job_timeout_hours",
+        type=float,
+        default=0,
+        help="kill a dorado job that runs longer than this, 0 for no limit [Defaults to 0]"
+    )
+    parser.add_argument(
+        "--stall_minutes",
+        type=float,
+        default=DEFAULT_STALL_TIMEOUT / 60,
+        help="kill a dorado job that writes no output or progress for this long, 0 for no limit [Defaults to %.0f]" % (DEFAULT_STALL_TIMEOUT / 60)
+    )
     args = parser.parse_args()
     return args
 
 
-def run_job(job_command):
-    process_id = multiprocessing.Process()._identity[0]
-    #ensure the parallel jobs are using different gpu devices
-    dorado_end_idx = job_command.find('>')
-    #job_command = job_command[:dorado_end_idx] + " --device cuda:{} ".format(process_id - 1)  + job_command[dorado_end_idx:]
-    job_command = job_command[:dorado_end_idx] + " --device cuda:all " + job_command[dorado_end_idx:]
-    print(job_command)
-    os.system(job_command)
+BasecallJob = NamedTuple(
+    "BasecallJob",
+    [
+        ("job_id", str),
+        ("command", list),
+        ("output_path", str),
+        ("size_bytes", int),
+    ]
+)
 
-def initialize_jobs_from_list(pod5_list_file, flowcell_pore):
-    job_list = []
-    pod5_dirs = [ line.strip() for line in open(pod5_list_file, 'r') ] 
-    #model = {"r10":"/data/tanner_scripts/DORADO/dorado-0.3.4-linux-x64/bin/dna_r10.4.1_e8.2_400bps_sup@v4.2.0",
-    #        "r9":"/data/tanner_scripts/DORADO/dorado-0.3.4-linux-x64/bin/dna_r9.4.1_e8_sup@v3.3"}
-    #model = {"r10":"/data/tanner_scripts/dorado-0.5.2-linux-x64/bin/dna_r10.4.1_e8.2_400bps_sup@v4.3.0_5mCG_5hmCG@v1"}
-    model = {"r10":"sup,5mCG_5hmCG"}
+MODEL = {"r10":"sup,5mCG_5hmCG"}
+#MODEL = {"r10":"/data/tanner_scripts/DORADO/dorado-0.3.4-linux-x64/bin/dna_r10.4.1_e8.2_400bps_sup@v4.2.0",
+#        "r9":"/data/tanner_scripts/DORADO/dorado-0.3.4-linux-x64/bin/dna_r9.4.1_e8_sup@v3.3"}
+#MODEL = {"r10":"/data/tanner_scripts/dorado-0.5.2-linux-x64/bin/dna_r10.4.1_e8.2_400bps_sup@v4.3.0_5mCG_5hmCG@v1"}
+
+def output_bam(pod5_path):
+    return os.path.dirname(pod5_path) + "/" + os.path.basename(pod5_path) + ".bam"
+
+def checkpoint_bam_path(out_bam):
+    # drop the .bam suffix (str.strip would eat any of the characters '.', 'b', 'a', 'm' from both ends)
+    if out_bam.endswith(".bam"):
+        out_bam = out_bam[:-len(".bam")]
+    return out_bam + ".checkpoint.bam"
+
+def save_partial_output(ledger, job_id, exit_status=None):
+    """Keep whatever a stopped dorado run wrote as a checkpoint to resume from.
+
+    exit_status is the failed run's status, or None for a run interrupted with the controller.
+    """
+    record = ledger.get(job_id)
+    checkpoint_bam = record.checkpoint_path
+    if os.path.isfile(record.output_path) and os.path.getsize(record.output_path) > 0:
+        # a resumed run copies the reads of its checkpoint, so the newer output replaces it
+        checkpoint_bam = checkpoint_bam_path(record.output_path)
+        os.replace(record.output_path, checkpoint_bam)
+    if checkpoint_bam:
+        ledger.checkpoint(job_id, checkpoint_bam, exit_status)
+    elif exit_status is None:
+        ledger.requeue(job_id)
+    else:
+        ledger.finish(job_id, exit_status)
+
+def run_job(job, device, ledger, wall_timeout=None, stall_timeout=DEFAULT_STALL_TIMEOUT):
+    """Run one dorado job on device and record the outcome in the ledger.
+
+    Returns:
+        JobResult, or None if the job was already claimed.
+    """
+    if not ledger.start(job.job_id):
+        print("{} already running or done, skipping".format(job.job_id))
+        return None
+    # the leased device goes in place of the {device} placeholder left in the dorado command
+    job_command = [device if arg == "{device}" else arg for arg in job.command]
+    print(" ".join(job_command) + " > " + job.output_path)
+    result = run_command(
+        job_command,
+        log_path=job.output_path + ".log",
+        stdout_path=job.output_path,
+        progress=DoradoProgress(),
+        wall_timeout=wall_timeout,
+        stall_timeout=stall_timeout,
+    )
+    if result.exit_status == 0:
+        checkpoint_bam = ledger.get(job.job_id).checkpoint_path
+        ledger.finish(job.job_id, 0)
+        if checkpoint_bam and os.path.isfile(checkpoint_bam):
+            os.remove(checkpoint_bam)
+    else:
+        save_partial_output(ledger, job.job_id, result.exit_status)
+    print(format_result(job.job_id, result, device))
+    return result
+
+def basecall_command(dorado, model, record):
+    command = [dorado, "basecaller", "-r", model, record.input_path]
+    if record.checkpoint_path:
+        command += ["--resume-from", record.checkpoint_path]
+    return command + ["--device", "{device}"]
+
+def shard_dirs(pod5_dir, max_shard_bytes):
+    """Shard directories of symlinks splitting pod5_dir's files, reusing the shards of an earlier run."""
+    shard_root = pod5_dir + ".shards"
+    if os.path.isdir(shard_root):
+        return sorted(os.path.join(shard_root, name) for name in os.listdir(shard_root)
+                      if os.path.isdir(os.path.join(shard_root, name)))
+    shards = plan_shards(pod5_files(pod5_dir), max_shard_bytes)
+    if len(shards) == 1:
+        return []
+    dirs = []
+    for i, files in enumerate(shards):
+        shard_dir = os.path.join(shard_root, "shard_{:03d}".format(i))
+        os.makedirs(shard_dir)
+        for j, pod5_file in enumerate(files):
+            # files from different subdirectories can share a name
+            os.symlink(os.path.abspath(pod5_file), os.path.join(shard_dir, "{}_{}".format(j, os.path.basename(pod5_file))))
+        dirs.append(shard_dir)
+    return dirs
+
+def register_jobs(pod5_list_file, ledger, max_shard_bytes=0):
+    """Add the pod5 directories of pod5_list_file that are not in the ledger yet.
+
+    Only new directories are looked at on disk. Directories finished or checkpointed by
+    runs from before the ledger existed are picked up from their marker file or bam.
+
+    Returns:
+        Number of directories added.
+    """
+    known = ledger.job_ids()
+    added = 0
+    pod5_dirs = [ line.strip() for line in open(pod5_list_file, 'r') if line.strip() ]
     for pod5_dir in pod5_dirs:
-        out_bam = os.path.dirname(pod5_dir) + "/" + os.path.basename(pod5_dir) + ".bam"
+        if pod5_dir in known: continue
+        added += 1
+        out_bam = output_bam(pod5_dir)
         out_message = os.path.dirname(pod5_dir) + "/" + os.path.basename(pod5_dir) + ".BASECALLING_COMPLETE"
-        checkpoint_bam = out_bam.strip('.bam') + ".checkpoint.bam"
-        command = ("/data/tanner_scripts/dorado-0.6.1-linux-x64/bin/dorado basecaller -r " +
-            " {} "
-            " {} "
-            " > {} "
-            " && touch {} ").format(model[flowcell_pore],pod5_dir, out_bam, out_message)
-        if os.path.isfile(out_message): continue
+        checkpoint_bam = checkpoint_bam_path(out_bam)
+        if os.path.isfile(out_message):
+            ledger.add(pod5_dir, pod5_dir, out_bam, state=DONE)
+            continue
         if os.path.isfile(out_bam) and os.path.getsize(out_bam) > 0:
-            os.rename(out_bam, checkpoint_bam) 
+            os.rename(out_bam, checkpoint_bam)
         if os.path.isfile(checkpoint_bam) and os.path.getsize(checkpoint_bam) > 0:
-            command = ("/data/tanner_scripts/dorado-0.6.1-linux-x64/bin/dorado basecaller -r " +
-                " {} "
-                " {} "
-                " --resume-from {} "
-                " > {} "
-                " && touch {} "
-                " && rm {} ").format(model[flowcell_pore],pod5_dir,checkpoint_bam,out_bam,out_message,checkpoint_bam)
-        job_list.append(command)
-    return job_list
+            # a partial run can only be resumed as a whole, so it is never split into shards
+            ledger.add(pod5_dir, pod5_dir, out_bam, size_bytes=sum(size for path, size in pod5_files(pod5_dir)),
+                       state=CHECKPOINTED, checkpoint_path=checkpoint_bam)
+            continue
+        shards = shard_dirs(pod5_dir, max_shard_bytes) if max_shard_bytes else []
+        shard_sizes = [sum(size for path, size in pod5_files(shard)) for shard in shards]
+        for shard, size in zip(shards, shard_sizes):
+            ledger.add(shard, shard, output_bam(shard), size_bytes=size, parent=pod5_dir)
+        ledger.add(pod5_dir, pod5_dir, out_bam,
+                   size_bytes=sum(shard_sizes) if shards else sum(size for path, size in pod5_files(pod5_dir)))
+    return added
+
+def initialize_jobs(ledger, flowcell_pore, dorado, max_attempts):
+    """
+    Returns:
+        List of BasecallJob still to run, ordered longest first.
+    """
+    records = ledger.jobs()
+    parents = set(record.parent for record in records if record.parent is not None)
+    job_list = []
+    for record in records:
+        # sharded directories are basecalled through their shards and finished by merge_shards
+        if record.job_id in parents or record.state == DONE:
+            continue
+        # interrupted runs leave no exit status and are always resumed
+        if record.exit_status and record.attempts >= max_attempts:
+            print("{} failed {} times, not retrying".format(record.job_id, record.attempts))
+            continue
+        job_list.append(BasecallJob(
+            job_id=record.job_id,
+            command=basecall_command(dorado, MODEL[flowcell_pore], record),
+            output_path=record.output_path,
+            size_bytes=record.size_bytes or 0,
+        ))
+    # free workers take the next job off the queue, so handing out the biggest jobs
+    # first keeps a large flow cell from starting last and running on alone
+    return longest_first(job_list, key=lambda job: job.size_bytes)
+
+def merge_shards(ledger, samtools):
+    """Merge the shard bams of every fully basecalled sharded directory into the directory's bam.
+
+    Returns:
+        List of pod5 directories that could not be merged yet.
+    """
+    unmerged = []
+    parents = set(record.parent for record in ledger.jobs() if record.parent is not None)
+    for pod5_dir in sorted(parents):
+        record = ledger.get(pod5_dir)
+        if record.state == DONE:
+            continue
+        shards = ledger.jobs(parent=pod5_dir)
+        if not all(shard.state == DONE for shard in shards) or not ledger.start(pod5_dir):
+            unmerged.append(pod5_dir)
+            continue
+        command = [samtools, "merge", "-f", record.output_path] + [shard.output_path for shard in shards]
+        print(" ".join(command))
+        exit_status = subprocess.call(command)
+        ledger.finish(pod5_dir, exit_status)
+        if exit_status == 0:
+            shutil.rmtree(pod5_dir + ".shards")
+        else:
+            unmerged.append(pod5_dir)
+    return unmerged
     
 def main():
     args = parse_args()
     if args.flowcell_pore != "r10" and args.flowcell_pore != "r9": 
         print("flowcell_pore must be either r10 or r9. quiting.")
         return()
-    job_list = initialize_jobs_from_list(args.pod5_list, args.flowcell_pore)
-    pool = multiprocessing.Pool(processes = args.num_gpus)
-    pool.map(run_job, job_list)
+    ledger = JobLedger(args.ledger or args.pod5_list + ".ledger.sqlite")
+    # jobs still marked running were cut off with the last controller
+    for record in ledger.jobs(states=(RUNNING,)):
+        save_partial_output(ledger, record.job_id)
+    added = register_jobs(args.pod5_list, ledger, int(args.max_shard_gb * 1e9))
+    job_list = initialize_jobs(ledger, args.flowcell_pore, args.dorado, args.max_attempts)
+    scheduler = DeviceLeaseScheduler(["cuda:{}".format(i) for i in range(args.num_gpus)], args.jobs_per_gpu)
+    sizes = [job.size_bytes for job in job_list]
+    predicted = predict_makespan(sizes, scheduler.slots, args.gb_per_hour * 1e9 / 3600)
+    print("{} new directories, {} jobs to run, {:.1f} GB of pod5, predicted makespan {:.1f} hours".format(
+        added, len(job_list), sum(sizes) / 1e9, predicted / 3600))
+    start_time = time.time()
+    wall_timeout = args.job_timeout_hours * 3600 or None
+    stall_timeout = args.stall_minutes * 60 or None
+    results = run_jobs(job_list, scheduler, lambda job, device: run_job(job, device, ledger, wall_timeout, stall_timeout))
+    makespan = time.time() - start_time
+    results = [(job, device, result, seconds) for job, device, result, seconds in results if result is not None]
+    failed = [(job, result) for job, device, result, seconds in results if result.exit_status != 0]
+    unmerged = merge_shards(ledger, args.samtools)
+    for device, seconds in sorted(scheduler.utilisation().items()):
+        print("{} busy for {:.1f} minutes".format(device, seconds / 60))
+    job_seconds = sum(seconds for job, device, result, seconds in results)
+    if job_seconds > 0:
+        print("makespan {:.1f} hours (predicted {:.1f}), {:.1f} GB per job hour".format(
+            makespan / 3600, predicted / 3600, sum(sizes) / 1e9 / (job_seconds / 3600)))
+    print("Slowest jobs:")
+    for job, device, result, seconds in sorted(results, key=lambda x: -x[3])[:10]:
+        print("    " + format_result(job.job_id, result, device))
+    if failed:
+        print("{} basecalling jobs failed:".format(len(failed)))
+        for job, result in failed: print("    {} ({}, see {})".format(job.job_id, result.killed or "exit status {}".format(result.exit_status), result.log_path))
+    if unmerged:
+        print("{} sharded directories were not merged:".format(len(unmerged)))
+        for pod5_dir in unmerged: print("    " + pod5_dir)
+    print(", ".join("{} {}".format(state, n) for state, n in sorted(ledger.state_counts().items())))
+    ledger.close()
     print("completed all basecalling jobs. Quitting now.")
     print("Have a wonderful day")
 
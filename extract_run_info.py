@@ -1,24 +1,245 @@
-import sys
+"""
+Summarise MinKNOW run report JSONs: sample, position, flow cell, yield (Gb), single pores left and N50 (kb).
+
+Reports can be given as files, directories (searched recursively for
+report*.json) or glob patterns. Only the handful of fields needed are pulled
+out. With the optional ijson package installed the reports are streamed
+instead of being loaded whole, and many reports are read in parallel on a
+process pool. Results are cached by file mtime and size when --cache is
+given, so rerunning over a project only reads new or changed reports.
+
+Example usage might be:
+
+    python extract_run_info.py report_PAK12345.json
+    python extract_run_info.py /data/RUSHAD_P12 "/data/other/*/report*.json" --output runs.tsv --cache runs.cache.json
+    python extract_run_info.py /data/RUSHAD_P12 --output runs.parquet
+"""
+
+import argparse
+import fnmatch
+import glob
 import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+COLUMNS = ("sample_id", "position", "flow_cell_id", "yield_gb", "single_pores", "n50_kb")
+# the histogram N50 is taken from, MinKNOW reports one per read length type (MinknowEvents, EstimatedBases, BasecalledBases)
+DEFAULT_N50_TYPE = "EstimatedBases"
+# bucket_value_type of the read length histogram, each type also has a read count (ReadCounts) one
+READ_LENGTH_BUCKETS = "ReadLengths"
+# position of the EstimatedBases histogram in reports whose histograms are not labelled
+LEGACY_N50_INDEX = 3
+
+
+class RunInfo(object):
+    """Fields collected from one report, the last acquisition's values win."""
+
+    def __init__(self):
+        self.sample_id = None
+        self.position = None
+        self.flow_cell_id = None
+        self.throughput = None
+        self.pore_count = None
+        # (read_length_type, bucket_value_type, n50) of the last acquisition's histograms in report order
+        self.histograms = []
+
+    def n50(self, read_length_type=DEFAULT_N50_TYPE):
+        # MinKNOW lists a read count and a read length histogram per type, told apart by bucket_value_type
+        matches = [n50 for histogram_type, buckets, n50 in self.histograms
+                   if histogram_type == read_length_type and buckets == READ_LENGTH_BUCKETS]
+        if matches:
+            return matches[-1]
+        # only reports without either label are read by position
+        if len(self.histograms) > LEGACY_N50_INDEX and all(t is None and b is None for t, b, n50 in self.histograms):
+            return self.histograms[LEGACY_N50_INDEX][2]
+        raise KeyError("no %s read length histogram" % read_length_type)
+
+    def row(self, read_length_type=DEFAULT_N50_TYPE):
+        return [self.sample_id, self.position, self.flow_cell_id, int(self.throughput) / 1e9,
+                self.pore_count, int(self.n50(read_length_type)) / 1e3]
+
+
+def _first_n50(histogram):
+    histogram_data = histogram.get('plot', {}).get('histogram_data', [])
+    return histogram_data[0]['n50'] if histogram_data else None
+
+
+def run_info_from_document(seq_json):
+    info = RunInfo()
+    #protocol info
+    info.sample_id = seq_json['protocol_run_info']['user_info']['sample_id']
+    info.position = seq_json['protocol_run_info']['device']['device_id']
+    info.flow_cell_id = seq_json['protocol_run_info']['flow_cell']['flow_cell_id']
+    #acquisition info
+    acquisition = seq_json['acquisitions'][-1]
+    info.throughput = acquisition['acquisition_run_info']['yield_summary']['estimated_selected_bases']
+    info.pore_count = acquisition['acquisition_run_info']['bream_info']['mux_scan_results'][-1]['counts']['single_pore']
+    info.histograms = [(h.get('read_length_type'), h.get('bucket_value_type'), _first_n50(h))
+                       for h in acquisition['read_length_histogram']]
+    return info
+
+
+def run_info_from_stream(f_in):
+    """Pull the fields out of a report with ijson without building the document."""
+    info = RunInfo()
+    acquisition = None
+    histogram = None
+    for prefix, event, value in ijson.parse(f_in):
+        if prefix == 'protocol_run_info.user_info.sample_id':
+            info.sample_id = value
+        elif prefix == 'protocol_run_info.device.device_id':
+            info.position = value
+        elif prefix == 'protocol_run_info.flow_cell.flow_cell_id':
+            info.flow_cell_id = value
+        elif prefix == 'acquisitions.item' and event == 'start_map':
+            acquisition = {'throughput': None, 'pore_count': None, 'histograms': []}
+        elif prefix == 'acquisitions.item' and event == 'end_map':
+            info.throughput = acquisition['throughput']
+            info.pore_count = acquisition['pore_count']
+            info.histograms = acquisition['histograms']
+        elif prefix == 'acquisitions.item.acquisition_run_info.yield_summary.estimated_selected_bases':
+            acquisition['throughput'] = value
+        elif prefix == 'acquisitions.item.acquisition_run_info.bream_info.mux_scan_results.item.counts.single_pore':
+            acquisition['pore_count'] = value
+        elif prefix == 'acquisitions.item.read_length_histogram.item':
+            if event == 'start_map':
+                histogram = [None, None, None]
+            elif event == 'end_map':
+                acquisition['histograms'].append(tuple(histogram))
+        elif prefix == 'acquisitions.item.read_length_histogram.item.read_length_type':
+            histogram[0] = value
+        elif prefix == 'acquisitions.item.read_length_histogram.item.bucket_value_type':
+            histogram[1] = value
+        elif prefix == 'acquisitions.item.read_length_histogram.item.plot.histogram_data.item.n50':
+            if histogram[2] is None:
+                histogram[2] = value
+    for name in ('sample_id', 'position', 'flow_cell_id', 'throughput', 'pore_count'):
+        if getattr(info, name) is None:
+            raise KeyError(name)
+    return info
+
+
+def read_report(path, read_length_type=DEFAULT_N50_TYPE):
+    """Returns (path, row, None), or (path, None, error message) if the report is missing a field."""
+    try:
+        if ijson is not None:
+            with open(path, 'rb') as f_in:
+                info = run_info_from_stream(f_in)
+        else:
+            with open(path, 'r') as f_in:
+                info = run_info_from_document(json.load(f_in))
+        return path, info.row(read_length_type), None
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def find_reports(inputs, pattern="report*.json"):
+    """Report paths from a mix of files, directories and glob patterns, without duplicates."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for dirpath, dirnames, filenames in os.walk(item):
+                dirnames[:] = [d for d in dirnames if not d.startswith('fast5') and not d.startswith('pod5')]
+                paths.extend(os.path.join(dirpath, f) for f in filenames if fnmatch.fnmatch(f, pattern))
+        elif os.path.isfile(item):
+            paths.append(item)
+        else:
+            paths.extend(sorted(glob.glob(item, recursive=True)))
+    seen = set()
+    return [p for p in paths if not (p in seen or seen.add(p))]
+
+
+def load_cache(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f_in:
+        return json.load(f_in)
+
+
+def save_cache(path, cache):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as out:
+        json.dump(cache, out)
+    os.replace(tmp_path, path)
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def extract(paths, processes=None, cache_path=None, read_length_type=DEFAULT_N50_TYPE):
+    """
+    Returns:
+        List of (path, row) in the order of paths, reports that could not be read are left out.
+    """
+    cache = load_cache(cache_path)
+    rows = {}
+    todo = []
+    for path in paths:
+        entry = cache.get(path)
+        # rows cached before the N50 was chosen by bucket_value_type are read again
+        if (entry is not None and entry['key'] == file_key(path) and entry['n50_type'] == read_length_type
+                and entry.get('n50_buckets') == READ_LENGTH_BUCKETS):
+            rows[path] = entry['row']
+        else:
+            todo.append(path)
+
+    if len(todo) > 1 and processes != 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(read_report, todo, [read_length_type] * len(todo), chunksize=8))
+    else:
+        results = [read_report(path, read_length_type) for path in todo]
+    for path, row, error in results:
+        if error is not None:
+            print("Skipping %s, %s" % (path, error), file=sys.stderr)
+            continue
+        rows[path] = row
+        cache[path] = {'key': file_key(path), 'n50_type': read_length_type, 'n50_buckets': READ_LENGTH_BUCKETS, 'row': row}
+
+    if cache_path is not None and todo:
+        save_cache(cache_path, cache)
+    return [(path, rows[path]) for path in paths if path in rows]
 
-seq_data = sys.argv[1]
 
-seq_json = json.load(open(seq_data, 'r'))
+def write_parquet(path, results):
+    import pandas as pd
+    table = pd.DataFrame([row + [report] for report, row in results], columns=list(COLUMNS) + ["report"])
+    table.to_parquet(path, index=False)
 
-#protocol info
-sample_id = seq_json['protocol_run_info']['user_info']['sample_id']
-position = seq_json['protocol_run_info']['device']['device_id']
-flowcell = seq_json['protocol_run_info']['flow_cell']['flow_cell_id']
 
-#acquisition info
-## yield
-throughput = seq_json['acquisitions'][-1]['acquisition_run_info']['yield_summary']['estimated_selected_bases']
+def main():
+    parser = argparse.ArgumentParser(description="Summarise MinKNOW run report JSONs into one table.")
+    parser.add_argument("reports", nargs="+", help="report JSON files, directories to search, or glob patterns")
+    parser.add_argument("--pattern", default="report*.json", help="file name pattern searched for in directories [default report*.json]")
+    parser.add_argument("--output", default=None, help="write a table with a header to this file, .parquet for Parquet (needs pandas and pyarrow), TSV otherwise [default TSV rows to stdout]")
+    parser.add_argument("--cache", default=None, help="JSON file caching each report's row by mtime and size")
+    parser.add_argument("--processes", type=int, default=None, help="reports read in parallel [default one per cpu]")
+    parser.add_argument("--n50_type", default=DEFAULT_N50_TYPE, help="read length histogram to take the N50 from [default %s]" % DEFAULT_N50_TYPE)
+    args = parser.parse_args()
 
-# pores left
-pore_count = seq_json['acquisitions'][-1]['acquisition_run_info']['bream_info']['mux_scan_results'][-1]['counts']['single_pore']
+    paths = find_reports(args.reports, args.pattern)
+    results = extract(paths, args.processes, args.cache, args.n50_type)
 
-#n50
-n50 = seq_json['acquisitions'][-1]['read_length_histogram'][3]['plot']['histogram_data'][0]['n50']
+    if args.output is not None and args.output.endswith('.parquet'):
+        write_parquet(args.output, results)
+        return
+    out = open(args.output, 'w') if args.output is not None else sys.stdout
+    # a single report prints the same line as always, batches add the report path
+    batch = len(paths) > 1 or args.output is not None
+    if args.output is not None:
+        print('\t'.join(COLUMNS + ("report",)), file=out)
+    for path, row in results:
+        print('\t'.join(map(str, row + [path] if batch else row)), file=out)
+    if out is not sys.stdout:
+        out.close()
 
-print('\t'.join(map(str,[sample_id, position, flowcell, int(throughput)/1e9, pore_count, int(n50)/1e3])))
 
+if __name__ == "__main__":
+    main()
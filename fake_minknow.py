@@ -0,0 +1,364 @@
+"""
+In-process stand-in for a MinKNOW manager and its flow cell positions.
+
+FakeManager serves any number of FakeFlowCellPositions. They answer the same
+calls the scripts make on minknow_api (flow_cell_positions, connect,
+acquisition.current_status / get_acquisition_info /
+watch_current_acquisition_run, device.get_flow_cell_info,
+protocol.start_protocol / stop_protocol / list_protocols). Every call sleeps for
+an injectable latency and is counted, so the polling and start logic can be
+timed without a PromethION.
+
+Runs follow synthetic curves on a SimClock: yield rises as
+rate * tau * (1 - exp(-t / tau)) and single pores decay exponentially, with a
+mux scan every mux_scan_period seconds. SimClock.sleep advances simulated
+time instantly, so a 72 hour run plays out in seconds while RPC latency is
+still spent in real time.
+
+Example usage might be:
+
+    clock = SimClock()
+    manager = FakeManager.with_positions(48, clock, latency=LatencyModel(0.02, 0.01))
+    results = poll_positions(manager.flow_cell_positions())
+    print(manager.rpc_counts())
+"""
+
+import math
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+# 3 is enum code for PROCESSING, 1 for READY
+PROCESSING = 3
+READY = 1
+# 1 is enum code for ACQUISITION_RUNNING, 3 for ACQUISITION_COMPLETED
+ACQUISITION_RUNNING = 1
+ACQUISITION_COMPLETED = 3
+
+DEFAULT_MUX_SCAN_PERIOD = 1.5 * 3600
+
+
+class SimClock(object):
+    """time()/sleep() pair where sleeping jumps simulated time forward instead of waiting."""
+
+    def __init__(self, start=None):
+        self._real_start = time.time()
+        self._start = self._real_start if start is None else start
+        self._offset = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            return self._start + (time.time() - self._real_start) + self._offset
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._offset += seconds
+
+
+class LatencyModel(object):
+    """Per call latency of mean seconds plus exponentially distributed jitter."""
+
+    def __init__(self, mean=0.0, jitter=0.0, seed=0):
+        self.mean = mean
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        if self.jitter <= 0:
+            return self.mean
+        with self._lock:
+            return self.mean + self._random.expovariate(1.0 / self.jitter)
+
+
+class RpcCounter(object):
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, method):
+        with self._lock:
+            self._counts[method] = self._counts.get(method, 0) + 1
+
+    def counts(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class SyntheticRun(object):
+    """Yield and pore curves of one sequencing run, in bases and pores at seconds since start."""
+
+    def __init__(self, rate=4e5, tau=30 * 3600, pores=7000, pore_tau=40 * 3600,
+                 mux_scan_period=DEFAULT_MUX_SCAN_PERIOD, yield_update_interval=60):
+        """
+        Args:
+            rate: initial bases per second.
+            tau: seconds for the sequencing rate to fall by a factor of e.
+            pores: single pores at the first mux scan.
+            pore_tau: seconds for the pore count to fall by a factor of e.
+            yield_update_interval: seconds between updates of the reported yield, like MinKNOW's yield summary.
+        """
+        self.rate = rate
+        self.tau = tau
+        self.pores = pores
+        self.pore_tau = pore_tau
+        self.mux_scan_period = mux_scan_period
+        self.yield_update_interval = yield_update_interval
+
+    @property
+    def max_yield(self):
+        return self.rate * self.tau
+
+    def yield_at(self, t):
+        return 0 if t <= 0 else self.rate * self.tau * (1 - math.exp(-t / self.tau))
+
+    def pores_at(self, t):
+        return int(self.pores * math.exp(-max(0, t) / self.pore_tau))
+
+    def reported_yield_at(self, t):
+        """Yield as MinKNOW would report it at t, from its last update."""
+        if self.yield_update_interval:
+            t = t // self.yield_update_interval * self.yield_update_interval
+        return self.yield_at(t)
+
+    def time_to_yield(self, target):
+        """Seconds after the start the run reaches target bases, inf if it never does."""
+        if target >= self.max_yield:
+            return float("inf")
+        return -self.tau * math.log(1 - target / self.max_yield)
+
+    def mux_scans(self, t):
+        """Single pore counts of every mux scan finished by t."""
+        return [self.pores_at(i * self.mux_scan_period) for i in range(int(max(0, t) // self.mux_scan_period) + 1)]
+
+    @classmethod
+    def random(cls, rng, **overrides):
+        """A run with rate, decay and pores varied around the defaults, like a real fleet."""
+        args = dict(
+            rate=rng.uniform(2.5e5, 5.5e5),
+            tau=rng.uniform(20, 40) * 3600,
+            pores=int(rng.uniform(5000, 8500)),
+            pore_tau=rng.uniform(30, 60) * 3600,
+        )
+        args.update(overrides)
+        return cls(**args)
+
+
+class _Stream(object):
+    """watch_current_acquisition_run(): yields the acquisition info every update_interval seconds until cancelled."""
+
+    def __init__(self, position, update_interval):
+        self.position = position
+        self.update_interval = update_interval
+        self._cancelled = threading.Event()
+
+    def __iter__(self):
+        while not self._cancelled.is_set():
+            info = self.position._acquisition_info()
+            yield info
+            if info.state == ACQUISITION_COMPLETED:
+                return
+            self._cancelled.wait(self.update_interval)
+
+    def cancel(self):
+        self._cancelled.set()
+
+
+class _Acquisition(object):
+    def __init__(self, position):
+        self.position = position
+
+    def current_status(self):
+        self.position._rpc("acquisition.current_status")
+        return SimpleNamespace(status=self.position.status())
+
+    def get_acquisition_info(self):
+        self.position._rpc("acquisition.get_acquisition_info")
+        return self.position._acquisition_info()
+
+    def watch_current_acquisition_run(self):
+        self.position._rpc("acquisition.watch_current_acquisition_run")
+        return _Stream(self.position, self.position.stream_interval)
+
+
+class _Device(object):
+    def __init__(self, position):
+        self.position = position
+
+    def get_flow_cell_info(self):
+        self.position._rpc("device.get_flow_cell_info")
+        has_flow_cell = self.position.run is not None
+        return SimpleNamespace(
+            has_flow_cell=has_flow_cell,
+            product_code=self.position.product_code if has_flow_cell else "",
+            user_specified_product_code="",
+            flow_cell_id="PA%05d" % self.position.index if has_flow_cell else "",
+        )
+
+
+class _Protocol(object):
+    def __init__(self, position):
+        self.position = position
+
+    def list_protocols(self, force_reload=False):
+        self.position._rpc("protocol.list_protocols")
+        return SimpleNamespace(protocols=self.position.manager.protocols)
+
+    def start_protocol(self, identifier, args=None, user_info=None):
+        self.position._rpc("protocol.start_protocol")
+        self.position.start(identifier)
+        return SimpleNamespace(run_id="run_%s_%d" % (self.position.name, self.position.index))
+
+    def stop_protocol(self):
+        self.position._rpc("protocol.stop_protocol")
+        self.position.stop()
+
+
+class FakeConnection(object):
+    def __init__(self, position):
+        self.acquisition = _Acquisition(position)
+        self.device = _Device(position)
+        self.protocol = _Protocol(position)
+
+
+class FakeFlowCellPosition(object):
+    def __init__(self, manager, index, name, run=None, started_at=None, product_code="FLO-PRO114M"):
+        """
+        Args:
+            run: SyntheticRun of the inserted flow cell, None for an empty position.
+            started_at: clock time the run started, None if no protocol is running yet.
+        """
+        self.manager = manager
+        self.index = index
+        self.name = name
+        self.run = run
+        self.started_at = started_at
+        self.stopped_at = None
+        self.protocol_id = None
+        self.product_code = product_code
+        self.stream_interval = 60
+        self.running = True
+        self.description = SimpleNamespace(
+            name=name, rpc_ports=SimpleNamespace(secure=8000 + 2 * index, insecure=8001 + 2 * index))
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "FakeFlowCellPosition(%s)" % self.name
+
+    def _rpc(self, method):
+        self.manager.counter.add(method)
+        latency = self.manager.latency.sample()
+        if latency > 0:
+            time.sleep(latency)
+
+    def connect(self):
+        self._rpc("connect")
+        return FakeConnection(self)
+
+    def elapsed(self, now=None):
+        """Seconds the run has been sequencing at now, stopping the clock at the stop."""
+        if self.started_at is None:
+            return 0.0
+        end = self.manager.clock.time() if now is None else now
+        if self.stopped_at is not None:
+            end = min(end, self.stopped_at)
+        return max(0.0, end - self.started_at)
+
+    def status(self):
+        with self._lock:
+            if self.run is None or self.started_at is None or self.stopped_at is not None:
+                return READY
+            if self.manager.clock.time() < self.started_at:
+                return READY
+            return PROCESSING
+
+    def yield_at(self, now=None):
+        return self.run.yield_at(self.elapsed(now)) if self.run is not None else 0
+
+    def _acquisition_info(self):
+        with self._lock:
+            t = self.elapsed()
+            stopped = self.stopped_at is not None
+            started_at = self.started_at
+        return SimpleNamespace(
+            state=ACQUISITION_COMPLETED if stopped else ACQUISITION_RUNNING,
+            start_time=SimpleNamespace(seconds=int(started_at or 0)),
+            yield_summary=SimpleNamespace(estimated_selected_bases=int(self.run.reported_yield_at(t))),
+            bream_info=SimpleNamespace(mux_scan_results=[
+                SimpleNamespace(counts={'single_pore': pores}) for pores in self.run.mux_scans(t)
+            ]),
+        )
+
+    def start(self, identifier):
+        with self._lock:
+            self.protocol_id = identifier
+            self.started_at = self.manager.clock.time()
+            self.stopped_at = None
+
+    def stop(self):
+        with self._lock:
+            if self.stopped_at is None and self.started_at is not None:
+                self.stopped_at = self.manager.clock.time()
+
+
+def _position_names(n):
+    """PromethION style names (1A..3G) for up to 48 positions, P001.. beyond that."""
+    if n <= 48:
+        return ["%d%s" % (i // 8 + 1, "ABCDEFGH"[i % 8]) for i in range(n)]
+    return ["P%03d" % (i + 1) for i in range(n)]
+
+
+class FakeManager(object):
+    def __init__(self, clock=None, latency=None):
+        self.clock = clock if clock is not None else SimClock()
+        self.latency = latency if latency is not None else LatencyModel()
+        self.counter = RpcCounter()
+        self.positions = []
+        # protocols served by list_protocols, shaped like minknow_api's ProtocolInfo
+        self.protocols = [
+            SimpleNamespace(
+                identifier="sequencing/sequencing_PRO114_DNA_e8_2_400K:FLO-PRO114M:%s%s" % (kit, ":basecalling" if basecalling else ""),
+                tag_extraction_result=SimpleNamespace(
+                    success=True, flow_cell_product_code="FLO-PRO114M", kit=kit,
+                    experiment_type="sequencing", base_calling=basecalling, barcoding=False, barcoding_kits=[]),
+            )
+            for kit in ("SQK-LSK114", "SQK-LSK110", "SQK-LSK109") for basecalling in (False, True)
+        ]
+
+    def add_position(self, run=None, started_at=None, name=None):
+        index = len(self.positions)
+        position = FakeFlowCellPosition(self, index, name or "P%03d" % (index + 1), run, started_at)
+        self.positions.append(position)
+        return position
+
+    def flow_cell_positions(self):
+        self.counter.add("manager.flow_cell_positions")
+        latency = self.latency.sample()
+        if latency > 0:
+            time.sleep(latency)
+        return list(self.positions)
+
+    def rpc_counts(self):
+        return self.counter.counts()
+
+    @classmethod
+    def with_positions(cls, n, clock=None, latency=None, seed=0, started=True, start_spread=600):
+        """A manager with n flow cells on random synthetic curves.
+
+        Args:
+            started: start every run within start_spread seconds of now, False to leave them waiting for start_protocol.
+        """
+        manager = cls(clock, latency)
+        rng = random.Random(seed)
+        now = manager.clock.time()
+        for name in _position_names(n):
+            started_at = now + rng.uniform(0, start_spread) if started else None
+            manager.add_position(SyntheticRun.random(rng), started_at, name)
+        return manager
@@ -0,0 +1,140 @@
+"""
+Incremental watcher for newly written raw data files in MinKNOW output directories.
+
+Rather than listing every fast5 directory and diffing it against everything
+seen so far, a Fast5Watcher reports only files that have been closed since the
+last poll. With the optional inotify_simple package installed it subscribes to
+IN_CLOSE_WRITE / IN_MOVED_TO events; otherwise it falls back to os.scandir and
+treats a file as closed once its mtime is at least settle_seconds old. Files
+closed shortly before the inotify watch started never produce an event, so
+the scandir pass keeps running until settle_seconds after the watch started.
+
+Files already handed to a basecalling job are recorded in a small append-only
+index next to each directory, so a restarted controller loads one file per
+sample instead of re-reading every job's input list.
+
+Example usage might be:
+
+    watcher = Fast5Watcher({sample_dir + '/fast5': sample_dir + '/fastq/tmp/dispatched_fast5s.txt'})
+    for fast5_dir, new_files in watcher.poll().items():
+        ...
+        watcher.mark_dispatched(fast5_dir, new_files)
+"""
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+DEFAULT_SETTLE_SECONDS = 60
+
+
+class DispatchIndex(object):
+    """Append-only record of the file names already dispatched from one directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.names = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f_in:
+                for line in f_in:
+                    self.names.add(line.strip())
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def add(self, names):
+        names = [name for name in names if name not in self.names]
+        if not names:
+            return
+        with open(self.path, 'a') as out:
+            out.write('\n'.join(names) + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        self.names.update(names)
+
+
+class Fast5Watcher(object):
+    def __init__(self, index_paths, suffixes=(".fast5", ".pod5"), settle_seconds=DEFAULT_SETTLE_SECONDS, use_inotify=True):
+        """
+        Args:
+            index_paths: dict of watched directory -> path of its dispatch index file.
+            suffixes: only files with one of these extensions are reported.
+            settle_seconds: how long a file must go unmodified to count as closed when scanning.
+            use_inotify: set False to force the scandir fallback.
+        """
+        self.suffixes = tuple(suffixes)
+        self.settle_seconds = settle_seconds
+        self.indexes = dict((directory, DispatchIndex(path)) for directory, path in index_paths.items())
+        self._reported = dict((directory, set()) for directory in self.indexes)
+        self._inotify = None
+        self._watch_dirs = {}
+        if use_inotify and INotify is not None:
+            self._inotify = INotify()
+            for directory in self.indexes:
+                wd = self._inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+                self._watch_dirs[wd] = directory
+        # files closed before the watch started are only found by scanning, until they are all settle_seconds old
+        self._rescan_until = time.time() + settle_seconds
+
+    @property
+    def backend(self):
+        return "inotify" if self._inotify is not None else "scandir"
+
+    def _wanted(self, directory, name):
+        return (name.endswith(self.suffixes) and name not in self.indexes[directory]
+                and name not in self._reported[directory])
+
+    def _scan(self):
+        """scandir pass: report files that have not been modified for settle_seconds."""
+        cutoff = time.time() - self.settle_seconds
+        new_files = {}
+        for directory in self.indexes:
+            with os.scandir(directory) as entries:
+                names = [
+                    entry.name for entry in entries
+                    if entry.is_file() and self._wanted(directory, entry.name) and entry.stat().st_mtime <= cutoff
+                ]
+            if names:
+                new_files[directory] = names
+        return new_files
+
+    def _read_events(self):
+        new_files = {}
+        for event in self._inotify.read(timeout=0):
+            directory = self._watch_dirs.get(event.wd)
+            if directory is None or not self._wanted(directory, event.name):
+                continue
+            new_files.setdefault(directory, []).append(event.name)
+        return new_files
+
+    def poll(self):
+        """Return {directory: [file names]} of files closed since the last poll and not yet dispatched."""
+        if self._inotify is None:
+            new_files = self._scan()
+        else:
+            new_files = self._read_events()
+            if self._rescan_until is not None:
+                # checked before scanning, so the last scan's cutoff is at or after the watch started
+                # and every file closed before then has been reported
+                last_scan = time.time() >= self._rescan_until
+                for directory, names in self._scan().items():
+                    new_files.setdefault(directory, []).extend(names)
+                if last_scan:
+                    self._rescan_until = None
+        for directory, names in new_files.items():
+            names[:] = sorted(set(names))
+            self._reported[directory].update(names)
+        return new_files
+
+    def mark_dispatched(self, directory, names):
+        """Persist that names from directory have been handed to a job."""
+        self.indexes[directory].add(names)
+        self._reported[directory].difference_update(names)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
@@ -0,0 +1,190 @@
+"""
+Per-cycle snapshot of the fleet that makes each MinKNOW read at most once.
+
+A FleetSnapshot stands for one polling cycle. It lists the manager's
+positions once and hands out connections whose read-only calls
+(acquisition.current_status, acquisition.get_acquisition_info,
+device.get_flow_cell_info) are fetched on first use and then shared: every
+later caller in the same cycle (the stop policy, the dashboard, telemetry,
+the start phases) gets the same response object, and callers racing on
+the same position wait for the one call in flight instead of repeating it.
+A failed call is remembered for the cycle too, so one dead position is not
+retried by every consumer. Calls that change state (protocol.stop_protocol,
+start_protocol, ...) are passed straight through.
+
+A snapshot never changes once a value has been fetched; the next cycle gets
+a new one from SnapshotSource.next_cycle(). The source counts the RPCs made
+and the ones saved by sharing.
+
+It has the same connect/invalidate/prune interface as
+PositionConnectionCache, so it can be passed anywhere a connection_cache is,
+and a flow_cell_positions() like the manager's:
+
+    snapshots = SnapshotSource(manager, PositionConnectionCache())
+    snapshot = snapshots.next_cycle()
+    results = poll_positions(snapshot.positions(), connection_cache=snapshot)
+    ...
+    print(snapshots.stats_summary())
+"""
+
+import threading
+import time
+from collections import Counter
+
+# (service, method) of the reads shared within a cycle
+SHARED_CALLS = {
+    "acquisition": ("current_status", "get_acquisition_info"),
+    "device": ("get_flow_cell_info",),
+}
+FLOW_CELL_POSITIONS = "manager.flow_cell_positions"
+
+
+class SnapshotStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.made = Counter()
+        self.saved = Counter()
+        self.cycles = 0
+
+    def add(self, method, saved):
+        with self._lock:
+            (self.saved if saved else self.made)[method] += 1
+
+    def summary(self):
+        made = sum(self.made.values())
+        saved = sum(self.saved.values())
+        details = ", ".join("%s %d" % item for item in sorted(self.saved.items(), key=lambda item: -item[1]))
+        return "Fleet snapshots: %d cycles, %d RPCs made, %d saved by sharing%s" % (
+            self.cycles, made, saved, " (%s)" % details if details else "")
+
+
+class _Shared(object):
+    """One memoized call: the first caller fetches, everyone else waits for and reuses its result."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _SharedService(object):
+    def __init__(self, snapshot, name, service_name, service):
+        self._snapshot = snapshot
+        self._name = name
+        self._service_name = service_name
+        self._service = service
+
+    def __getattr__(self, method):
+        attribute = getattr(self._service, method)
+        if method not in SHARED_CALLS.get(self._service_name, ()):
+            return attribute
+        name = "%s.%s" % (self._service_name, method)
+
+        def shared_call(*args, **kwargs):
+            if args or kwargs:
+                # only the plain reads are the same for every consumer
+                return attribute(*args, **kwargs)
+            return self._snapshot._fetch(self._name, name, attribute)
+        return shared_call
+
+
+class _SharedConnection(object):
+    """Connection wrapper whose read-only calls are shared for the snapshot's cycle."""
+
+    def __init__(self, snapshot, name, connection):
+        self._snapshot = snapshot
+        self._name = name
+        self._connection = connection
+        self._services = {}
+
+    @property
+    def connection(self):
+        """The underlying connection, for calls that must not be shared."""
+        return self._connection
+
+    def __getattr__(self, service_name):
+        service = getattr(self._connection, service_name)
+        if service_name not in SHARED_CALLS:
+            return service
+        if service_name not in self._services:
+            self._services[service_name] = _SharedService(self._snapshot, self._name, service_name, service)
+        return self._services[service_name]
+
+
+class FleetSnapshot(object):
+    def __init__(self, manager, connection_cache, stats, cycle=0, taken_at=None):
+        self.manager = manager
+        self.connection_cache = connection_cache
+        self.stats = stats
+        self.cycle = cycle
+        self.taken_at = time.time() if taken_at is None else taken_at
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._connections = {}
+
+    def _fetch(self, name, method, call):
+        key = (name, method)
+        with self._lock:
+            shared = self._calls.get(key)
+            owner = shared is None
+            if owner:
+                shared = self._calls[key] = _Shared()
+        if not owner:
+            shared.done.wait()
+            self.stats.add(method, saved=True)
+        else:
+            self.stats.add(method, saved=False)
+            try:
+                shared.value = call()
+            except Exception as e:
+                shared.error = e
+            finally:
+                shared.done.set()
+        if shared.error is not None:
+            raise shared.error
+        return shared.value
+
+    def positions(self):
+        """The manager's positions, listed once per cycle."""
+        return self._fetch(None, FLOW_CELL_POSITIONS, self.manager.flow_cell_positions)
+
+    # so a snapshot can also be passed where a manager is expected
+    flow_cell_positions = positions
+
+    def connect(self, pos):
+        """Connection to pos whose current_status, get_acquisition_info and get_flow_cell_info are shared this cycle."""
+        connection = self.connection_cache.connect(pos) if self.connection_cache is not None else pos.connect()
+        with self._lock:
+            shared = self._connections.get(pos.name)
+            if shared is None or shared.connection is not connection:
+                shared = self._connections[pos.name] = _SharedConnection(self, pos.name, connection)
+            return shared
+
+    def invalidate(self, name):
+        if self.connection_cache is not None:
+            self.connection_cache.invalidate(name)
+
+    def prune(self, positions):
+        if self.connection_cache is not None:
+            self.connection_cache.prune(positions)
+
+    def stats_summary(self):
+        return self.stats.summary()
+
+
+class SnapshotSource(object):
+    """Hands out one FleetSnapshot per cycle and keeps the RPC counts across them."""
+
+    def __init__(self, manager, connection_cache=None):
+        self.manager = manager
+        self.connection_cache = connection_cache
+        self.stats = SnapshotStats()
+        self.snapshot = None
+
+    def next_cycle(self, now=None):
+        self.stats.cycles += 1
+        self.snapshot = FleetSnapshot(self.manager, self.connection_cache, self.stats, self.stats.cycles, now)
+        return self.snapshot
+
+    def stats_summary(self):
+        return self.stats.summary()
@@ -0,0 +1,102 @@
+"""
+Lease GPU devices to basecalling jobs.
+
+Each device can be leased by at most jobs_per_device jobs at a time. A job
+takes a lease on the least loaded device before it starts, the remaining jobs
+wait in the queue, and the lease is released when the job's process exits
+(whether it succeeded or not). Jobs are run from threads that wait on their
+subprocess, so leases live in one process and do not depend on
+multiprocessing worker identities.
+
+Example usage might be:
+
+    scheduler = DeviceLeaseScheduler(["cuda:0", "cuda:1"], jobs_per_device=2)
+    results = run_jobs(job_list, scheduler, run_job)
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DeviceLeaseScheduler(object):
+    def __init__(self, devices, jobs_per_device=1):
+        if not devices:
+            raise ValueError("DeviceLeaseScheduler needs at least one device")
+        self.devices = list(devices)
+        self.jobs_per_device = jobs_per_device
+        self._leases = dict((device, 0) for device in self.devices)
+        self._busy_seconds = dict((device, 0.0) for device in self.devices)
+        self._condition = threading.Condition()
+
+    @property
+    def slots(self):
+        return len(self.devices) * self.jobs_per_device
+
+    def acquire(self):
+        """Block until a device has a free slot and lease it, least loaded device first."""
+        with self._condition:
+            while True:
+                device = min(self.devices, key=lambda d: self._leases[d])
+                if self._leases[device] < self.jobs_per_device:
+                    self._leases[device] += 1
+                    return device
+                self._condition.wait()
+
+    def release(self, device, busy_seconds=0.0):
+        with self._condition:
+            self._leases[device] -= 1
+            self._busy_seconds[device] += busy_seconds
+            self._condition.notify()
+
+    def lease(self):
+        """Context manager form of acquire()/release()."""
+        return _Lease(self)
+
+    def utilisation(self):
+        """Seconds each device spent leased to jobs."""
+        with self._condition:
+            return dict(self._busy_seconds)
+
+
+class _Lease(object):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.device = None
+        self.start = None
+
+    def __enter__(self):
+        self.device = self.scheduler.acquire()
+        self.start = time.time()
+        return self.device
+
+    def __exit__(self, exc_type, exc, tb):
+        self.scheduler.release(self.device, time.time() - self.start)
+        return False
+
+
+def run_jobs(jobs, scheduler, run_fn):
+    """Run run_fn(job, device) for every job, each holding a device lease while it runs.
+
+    Returns:
+        List of (job, device, result, seconds) in the order jobs finished.
+    """
+    results = []
+    results_lock = threading.Lock()
+
+    def run_one(job):
+        with scheduler.lease() as device:
+            start = time.time()
+            result = run_fn(job, device)
+            elapsed = time.time() - start
+        with results_lock:
+            results.append((job, device, result, elapsed))
+
+    jobs = list(jobs)
+    if not jobs:
+        return results
+    with ThreadPoolExecutor(max_workers=min(scheduler.slots, len(jobs))) as pool:
+        futures = [pool.submit(run_one, job) for job in jobs]
+    for future in futures:
+        future.result()
+    return results
@@ -0,0 +1,179 @@
+"""
+SQLite ledger of basecalling jobs.
+
+Every job the controllers hand to a basecaller has one row holding its state
+(queued, running, checkpointed, done or failed), how many times it has been
+started, and where its input, output and resume checkpoint live. Each state
+change is a single UPDATE, so a controller killed mid-run leaves every job in
+a state it can pick up from. On restart the jobs left to do come from one
+indexed query, and the input directories do not have to be crawled for
+marker files.
+
+Example usage might be:
+
+    ledger = JobLedger("samples_to_basecall.pod5_list.txt.ledger.sqlite")
+    ledger.add(pod5_dir, input_path=pod5_dir, output_path=out_bam, size_bytes=size)
+    for job in ledger.jobs(states=(QUEUED, CHECKPOINTED)):
+        if ledger.start(job.job_id):
+            ...
+            ledger.finish(job.job_id, exit_status)
+
+    python job_ledger.py --db samples_to_basecall.pod5_list.txt.ledger.sqlite
+"""
+
+import argparse
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+QUEUED = "queued"
+RUNNING = "running"
+CHECKPOINTED = "checkpointed"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    parent TEXT,
+    input_path TEXT NOT NULL,
+    output_path TEXT,
+    checkpoint_path TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    size_bytes INTEGER,
+    exit_status INTEGER,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent);
+"""
+
+COLUMNS = ("job_id", "parent", "input_path", "output_path", "checkpoint_path",
+           "state", "attempts", "size_bytes", "exit_status", "updated_at")
+
+
+class JobRecord(NamedTuple):
+    job_id: str
+    parent: Optional[str]
+    input_path: str
+    output_path: Optional[str]
+    checkpoint_path: Optional[str]
+    state: str
+    attempts: int
+    size_bytes: Optional[int]
+    exit_status: Optional[int]
+    updated_at: float
+
+
+class JobLedger(object):
+    def __init__(self, path):
+        self.path = path
+        # shared by the job threads, every statement runs under the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor.rowcount
+
+    def _select(self, sql, params=()):
+        with self._lock:
+            return [JobRecord(*row) for row in self._db.execute(sql, params)]
+
+    def add(self, job_id, input_path, output_path=None, size_bytes=None, parent=None,
+            state=QUEUED, checkpoint_path=None):
+        """Record a new job, returns False if job_id is already in the ledger."""
+        return self._execute(
+            "INSERT OR IGNORE INTO jobs (job_id, parent, input_path, output_path, checkpoint_path, state, size_bytes, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, parent, input_path, output_path, checkpoint_path, state, size_bytes, time.time())) == 1
+
+    def get(self, job_id):
+        rows = self._select("SELECT * FROM jobs WHERE job_id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def jobs(self, states=None, parent=None):
+        """Jobs in any of states (all states if None), optionally only the children of parent."""
+        sql = "SELECT * FROM jobs"
+        clauses = []
+        params = []
+        if states is not None:
+            clauses.append("state IN (%s)" % ",".join("?" * len(states)))
+            params.extend(states)
+        if parent is not None:
+            clauses.append("parent = ?")
+            params.append(parent)
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return self._select(sql + " ORDER BY job_id", params)
+
+    def job_ids(self):
+        with self._lock:
+            return set(row[0] for row in self._db.execute("SELECT job_id FROM jobs"))
+
+    def count(self, parent):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE parent = ?", (parent,)).fetchone()[0]
+
+    def start(self, job_id):
+        """Claim a job for running. Returns False if it is already running or done."""
+        return self._execute(
+            "UPDATE jobs SET state = ?, attempts = attempts + 1, updated_at = ? "
+            "WHERE job_id = ? AND state NOT IN (?, ?)",
+            (RUNNING, time.time(), job_id, RUNNING, DONE)) == 1
+
+    def finish(self, job_id, exit_status):
+        """Mark a job done on a zero exit status, failed otherwise. Clears its checkpoint when done."""
+        if exit_status == 0:
+            self._execute(
+                "UPDATE jobs SET state = ?, exit_status = 0, checkpoint_path = NULL, updated_at = ? WHERE job_id = ?",
+                (DONE, time.time(), job_id))
+        else:
+            self._execute(
+                "UPDATE jobs SET state = ?, exit_status = ?, updated_at = ? WHERE job_id = ?",
+                (FAILED, exit_status, time.time(), job_id))
+
+    def checkpoint(self, job_id, checkpoint_path, exit_status=None):
+        """Record that job_id stopped with partial output at checkpoint_path that it can resume from.
+
+        exit_status is the status of a failed run, None if the run was interrupted.
+        """
+        self._execute(
+            "UPDATE jobs SET state = ?, checkpoint_path = ?, exit_status = ?, updated_at = ? WHERE job_id = ?",
+            (CHECKPOINTED, checkpoint_path, exit_status, time.time(), job_id))
+
+    def requeue(self, job_id):
+        self._execute("UPDATE jobs SET state = ?, updated_at = ? WHERE job_id = ?", (QUEUED, time.time(), job_id))
+
+    def state_counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the jobs in a basecalling job ledger")
+    parser.add_argument("--db", required=True, help="job ledger SQLite file")
+    parser.add_argument("--state", action="append", help="only jobs in this state, may be repeated")
+    args = parser.parse_args()
+
+    ledger = JobLedger(args.db)
+    print("\t".join(COLUMNS))
+    for job in ledger.jobs(states=args.state):
+        print("\t".join("" if value is None else str(value) for value in job))
+    print(", ".join("%s %d" % (state, n) for state, n in sorted(ledger.state_counts().items())))
+    ledger.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Size-aware planning of basecalling jobs.
+
+Basecalling time scales with the amount of raw signal, so jobs are measured
+by the total bytes of their pod5 files. Directories larger than a shard size
+are split into shards of pod5 files (packed largest file first so shards come
+out about the same size), the jobs are ordered longest first, and workers take
+the next job from the queue as soon as they are free. This is the classic LPT
+(longest processing time) rule, which keeps one huge flow cell from running
+for hours after every other worker has gone idle.
+
+Example usage might be:
+
+    shards = plan_shards(pod5_files(pod5_dir), max_shard_bytes=200 * 1e9)
+    jobs = longest_first(jobs, key=lambda job: job.size_bytes)
+    print("predicted makespan %.1f hours" % (predict_makespan(sizes, slots, bytes_per_second) / 3600))
+"""
+
+import heapq
+import math
+import os
+
+
+def pod5_files(path):
+    """(path, size in bytes) of every pod5 file under path, or path itself if it is a file."""
+    if os.path.isfile(path):
+        return [(path, os.path.getsize(path))]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith('.pod5'):
+                file_path = os.path.join(dirpath, filename)
+                files.append((file_path, os.path.getsize(file_path)))
+    return files
+
+
+def plan_shards(files, max_shard_bytes):
+    """Split (path, size) files into the fewest shards of about max_shard_bytes each.
+
+    Returns:
+        List of shards, each a list of file paths. A single shard holding every
+        file if the total is under max_shard_bytes.
+    """
+    total = sum(size for path, size in files)
+    n_shards = max(1, int(math.ceil(total / float(max_shard_bytes)))) if max_shard_bytes else 1
+    n_shards = min(n_shards, max(1, len(files)))
+    if n_shards == 1:
+        return [[path for path, size in files]]
+    # largest file into the currently smallest shard
+    heap = [(0, i) for i in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for path, size in sorted(files, key=lambda x: -x[1]):
+        shard_bytes, i = heapq.heappop(heap)
+        shards[i].append(path)
+        heapq.heappush(heap, (shard_bytes + size, i))
+    return shards
+
+
+def longest_first(jobs, key):
+    return sorted(jobs, key=key, reverse=True)
+
+
+def predict_makespan(sizes, slots, bytes_per_second):
+    """Seconds until the last job finishes when sizes are handed out in order to the first free slot."""
+    if not sizes or bytes_per_second <= 0:
+        return 0.0
+    finish_times = [0.0] * max(1, slots)
+    for size in sizes:
+        start = heapq.heappop(finish_times)
+        heapq.heappush(finish_times, start + size / bytes_per_second)
+    return max(finish_times)
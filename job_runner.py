@@ -0,0 +1,260 @@
+"""
+Run basecaller processes under supervision.
+
+run_command starts a basecaller with subprocess in its own process group. It
+copies stderr (and stdout, unless stdout is the job's output) to a per-job
+log file and parses dorado or guppy progress messages from it as they arrive.
+The job is killed if it runs longer than the wall-clock timeout, or if it
+goes stall_timeout seconds with no new progress messages and no growth of its
+output file. The returned JobResult has the exit status, how the job ended,
+and the read and sample throughput, so a slow or stuck job shows up in the
+controller's summary instead of leaving a worker blocked forever.
+
+Example usage might be:
+
+    result = run_command(
+        [dorado, "basecaller", "sup", pod5_dir, "--device", "cuda:0"],
+        log_path=out_bam + ".log", stdout_path=out_bam,
+        progress=DoradoProgress(), stall_timeout=1800,
+    )
+    print(format_result(job_id, result))
+"""
+
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from typing import NamedTuple, Optional
+
+DEFAULT_STALL_TIMEOUT = 1800
+KILL_GRACE_SECONDS = 30
+
+# how a job ended, besides exiting on its own
+WALL_TIMEOUT = "wall timeout"
+STALL_TIMEOUT = "no progress"
+# exit status of a job whose command could not be started, as a shell reports a missing command
+NOT_STARTED_EXIT_STATUS = 127
+
+
+class JobResult(NamedTuple):
+    exit_status: int
+    seconds: float
+    killed: Optional[str]
+    reads: Optional[int]
+    samples: Optional[float]
+    log_path: str
+
+    @property
+    def reads_per_second(self):
+        if self.reads is None or self.seconds <= 0:
+            return None
+        return self.reads / self.seconds
+
+    @property
+    def samples_per_second(self):
+        if self.samples is None or self.seconds <= 0:
+            return None
+        return self.samples / self.seconds
+
+
+class DoradoProgress(object):
+    """Progress from dorado's stderr: the progress bar percentage and the end of run summary."""
+    PERCENT = re.compile(r"\]?\s(\d{1,3}(?:\.\d+)?)%")
+    READS = re.compile(r"reads basecalled:\s*(\d+)", re.IGNORECASE)
+    SAMPLES_PER_SECOND = re.compile(r"Samples/s:\s*([0-9.eE+-]+)")
+
+    def __init__(self):
+        self.fraction = 0.0
+        self.reads = None
+        self.samples_per_second = None
+
+    def feed(self, line):
+        """Parse one line of output, returns True if it shows the job moving forward."""
+        advanced = False
+        match = self.PERCENT.search(line)
+        if match and float(match.group(1)) / 100 > self.fraction:
+            self.fraction = float(match.group(1)) / 100
+            advanced = True
+        match = self.READS.search(line)
+        if match:
+            self.reads = (self.reads or 0) + int(match.group(1))
+            advanced = True
+        match = self.SAMPLES_PER_SECOND.search(line)
+        if match:
+            self.samples_per_second = float(match.group(1))
+            advanced = True
+        return advanced
+
+    def samples(self, seconds):
+        if self.samples_per_second is None:
+            return None
+        return self.samples_per_second * seconds
+
+
+class GuppyProgress(object):
+    """Progress from guppy_basecaller: the row of '*' (2% each) and the closing 'Caller time' line."""
+    CALLER_TIME = re.compile(r"Caller time:\s*(\d+)\s*ms,\s*Samples called:\s*(\d+)")
+    READS = re.compile(r"Found\s+(\d+)\s+reads", re.IGNORECASE)
+
+    def __init__(self):
+        self.fraction = 0.0
+        self.reads = None
+        self.samples_called = None
+
+    def feed(self, line):
+        advanced = False
+        stars = line.count("*")
+        if stars and not line.strip("* \n"):
+            self.fraction = min(1.0, self.fraction + stars * 0.02)
+            advanced = True
+        match = self.READS.search(line)
+        if match:
+            self.reads = int(match.group(1))
+            advanced = True
+        match = self.CALLER_TIME.search(line)
+        if match:
+            self.samples_called = int(match.group(2))
+            advanced = True
+        return advanced
+
+    def samples(self, seconds):
+        return self.samples_called
+
+
+def _kill(process):
+    """SIGTERM the job's whole process group, SIGKILL it if it has not exited after a grace period."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(KILL_GRACE_SECONDS)
+    except ProcessLookupError:
+        pass
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def run_command(args, log_path, stdout_path=None, progress=None, wall_timeout=None,
+                stall_timeout=DEFAULT_STALL_TIMEOUT, check_interval=10):
+    """Run args to completion, a timeout, or a stall.
+
+    Args:
+        args: command line as a list.
+        log_path: file stderr (and stdout when stdout_path is None) is written to.
+        stdout_path: file the process's stdout is written to, e.g. dorado's bam.
+        progress: DoradoProgress or GuppyProgress fed every line of output.
+        wall_timeout: seconds the job may run in total, None for no limit.
+        stall_timeout: seconds the job may go without progress or output growth, None for no limit.
+        check_interval: seconds between timeout checks.
+
+    Returns:
+        JobResult. exit_status is the process's return code, negative if it was killed by a signal,
+        NOT_STARTED_EXIT_STATUS if the command could not be started (e.g. a missing basecaller).
+    """
+    progress_lock = threading.Lock()
+    last_progress = [time.time()]
+
+    with open(log_path, "ab") as log:
+        stdout = open(stdout_path, "wb") if stdout_path else subprocess.PIPE
+        try:
+            start = time.time()
+            process = subprocess.Popen(
+                args,
+                stdout=stdout,
+                stderr=subprocess.PIPE if stdout_path else subprocess.STDOUT,
+                start_new_session=True,
+            )
+        except OSError as e:
+            # fails this job only, the caller records it and frees its device for the next one
+            message = "could not start %s: %s" % (args[0], e)
+            print(message)
+            log.write(("[job_runner] %s\n" % message).encode())
+            return JobResult(NOT_STARTED_EXIT_STATUS, time.time() - start, None, None, None, log_path)
+        finally:
+            if stdout_path:
+                stdout.close()
+
+        def read_output(stream):
+            # progress bars redraw with \r, so treat it as a line end too
+            buffer = b""
+            for chunk in iter(lambda: stream.read1(65536), b""):
+                log.write(chunk)
+                log.flush()
+                buffer += chunk
+                lines = re.split(rb"[\r\n]", buffer)
+                buffer = lines.pop()
+                with progress_lock:
+                    for line in lines:
+                        if progress is not None and progress.feed(line.decode("utf-8", "replace")):
+                            last_progress[0] = time.time()
+            if buffer and progress is not None:
+                with progress_lock:
+                    progress.feed(buffer.decode("utf-8", "replace"))
+
+        reader = threading.Thread(
+            target=read_output,
+            args=(process.stderr if stdout_path else process.stdout,),
+            daemon=True,
+        )
+        reader.start()
+
+        killed = None
+        output_size = 0
+        while True:
+            try:
+                process.wait(check_interval)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            now = time.time()
+            if stdout_path:
+                size = _file_size(stdout_path)
+                if size > output_size:
+                    output_size = size
+                    with progress_lock:
+                        last_progress[0] = now
+            if wall_timeout and now - start > wall_timeout:
+                killed = WALL_TIMEOUT
+            elif stall_timeout:
+                with progress_lock:
+                    if now - last_progress[0] > stall_timeout:
+                        killed = STALL_TIMEOUT
+            if killed:
+                _kill(process)
+                break
+        reader.join()
+        seconds = time.time() - start
+        if killed:
+            log.write(("\n[job_runner] killed after %.0f s: %s\n" % (seconds, killed)).encode())
+
+    reads = samples = None
+    if progress is not None:
+        reads = progress.reads
+        samples = progress.samples(seconds)
+    return JobResult(process.returncode, seconds, killed, reads, samples, log_path)
+
+
+def format_result(name, result, device=None):
+    """One summary line for a finished job."""
+    fields = ["{}".format(name)]
+    if device is not None:
+        fields.append("device={}".format(device))
+    fields.append("exit={}".format(result.exit_status))
+    if result.killed:
+        fields.append("killed={}".format(result.killed))
+    # wall time, a device shared with --jobs_per_gpu > 1 is not busy with this job alone
+    fields.append("wall_seconds={:.0f}".format(result.seconds))
+    if result.reads_per_second is not None:
+        fields.append("reads/s={:.1f}".format(result.reads_per_second))
+    if result.samples_per_second is not None:
+        fields.append("samples/s={:.3g}".format(result.samples_per_second))
+    fields.append("log={}".format(result.log_path))
+    return "\t".join(fields)
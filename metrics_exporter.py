@@ -0,0 +1,151 @@
+"""
+Prometheus / OpenMetrics endpoint for the sequencing fleet.
+
+Serves GET /metrics from the latest DashboardSnapshot of a FleetView (see
+dashboard.py), which the run until loop or the dashboard's poller publish
+after every sweep. A scrape never talks to MinKNOW: the exposition text is
+rendered once per snapshot and the same bytes are served to every scraper
+until the next poll, so any number of Grafana or Prometheus instances can
+scrape at any rate without adding a single gRPC call.
+
+Exposed per position: estimated_selected_bases, single pores from the last
+mux scan, acquisition status, smoothed yield rate, target and time to
+target, plus the run until controller's stop decisions and the poller's
+own sweep counts and timings.
+
+Example usage might be:
+
+    view = FleetView(target_yields)
+    MetricsExporter(view, port=9108).start()
+    run_until(..., view=view)
+
+    python run_until.py --target sample_sheet.tsv --metrics_port 9108
+    curl localhost:9108/metrics
+"""
+
+import threading
+
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 9108
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PREFIX = "minknow"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return "{%s}" % ",".join('%s="%s"' % (key, _escape(value)) for key, value in labels.items())
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics(snapshot, openmetrics=False):
+    """Exposition text for a dashboard.DashboardSnapshot.
+
+    Counters are written without the _total suffix in their TYPE line for OpenMetrics,
+    which is the only difference between the two formats here besides the # EOF.
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        family = "%s_%s" % (PREFIX, name)
+        type_name = family[:-len("_total")] if openmetrics and kind == "counter" else family
+        lines.append("# HELP %s %s" % (type_name, help_text))
+        lines.append("# TYPE %s %s" % (type_name, kind))
+        for labels, value in samples:
+            if value is not None:
+                lines.append("%s%s %s" % (family, labels, _number(value)))
+
+    rows = snapshot.rows
+    metric("position_estimated_selected_bases", "gauge", "Estimated selected bases of the current or last acquisition.",
+           [(_labels(position=row.position), row.yield_bases) for row in rows])
+    metric("position_single_pores", "gauge", "Single pores in the last mux scan.",
+           [(_labels(position=row.position), row.pores) for row in rows])
+    metric("position_status", "gauge", "1 for the position's current acquisition status or controller decision.",
+           [(_labels(position=row.position, status=row.status), 1) for row in rows])
+    metric("position_yield_rate_bases_per_second", "gauge", "Smoothed yield rate.",
+           [(_labels(position=row.position), row.rate) for row in rows])
+    metric("position_target_bases", "gauge", "Yield the run until controller stops the position at.",
+           [(_labels(position=row.position), row.target) for row in rows])
+    metric("position_seconds_to_target", "gauge", "Forecast seconds until the target is reached.",
+           [(_labels(position=row.position), row.eta) for row in rows])
+    metric("controller_decision_timestamp_seconds", "gauge",
+           "When the run until controller decided a position had hit its target (stopped or left to run to exhaustion).",
+           [(_labels(position=name, decision=decision), when) for name, decision, when in snapshot.decisions])
+    metric("fleet_estimated_selected_bases", "gauge", "Summed estimated selected bases of every position.",
+           [("", snapshot.total.yield_bases)])
+    metric("fleet_yield_rate_bases_per_second", "gauge", "Summed yield rate of the running positions.",
+           [("", snapshot.total.rate)])
+    metric("poll_sweeps_total", "counter", "Poll sweeps published.", [("", snapshot.sweeps)])
+    metric("poll_errors_total", "counter", "Positions that failed to answer a poll.", [("", snapshot.errors)])
+    metric("poll_sweep_seconds", "gauge", "Wall time of the last poll sweep.", [("", snapshot.sweep_seconds)])
+    metric("snapshot_timestamp_seconds", "gauge", "When the served snapshot was taken.",
+           [("", snapshot.taken_at if snapshot.sweeps else None)])
+    if openmetrics:
+        lines.append("# EOF")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class MetricsExporter(object):
+    """HTTP server on its own thread answering /metrics from view.snapshot."""
+
+    def __init__(self, view, host=DEFAULT_METRICS_HOST, port=DEFAULT_METRICS_PORT):
+        # imported here so the controllers that only read DEFAULT_METRICS_HOST start without http.server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.view = view
+        self.scrapes = 0
+        self.renders = 0
+        self._lock = threading.Lock()
+        self._cache = {}
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+                body = exporter.body(openmetrics)
+                self.send_response(200)
+                self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes every few seconds would drown the controller's own output
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def body(self, openmetrics=False):
+        """Rendered metrics of the current snapshot, rendered again only after a new snapshot is published."""
+        snapshot = self.view.snapshot
+        with self._lock:
+            self.scrapes += 1
+            cached = self._cache.get(openmetrics)
+            if cached is None or cached[0] is not snapshot:
+                cached = (snapshot, render_metrics(snapshot, openmetrics))
+                self._cache[openmetrics] = cached
+                self.renders += 1
+            return cached[1]
+
+    def start(self):
+        self._thread.start()
+        print("Serving metrics on http://%s:%d/metrics" % self.server.server_address[:2])
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,184 @@
+"""
+One entry point for the utility scripts.
+
+Subcommands are registered by module name only, so running this (or
+asking for --help) imports nothing but the standard library. The
+subcommand's module is imported when it is chosen and its main() is
+handed the remaining arguments, and the scripts themselves import
+minknow_api, pandas, plotext and numpy where they are used, after parsing arguments,
+so `<command> --help` stays fast too. Each script can still be run on
+its own as before.
+
+`startup` is the import time benchmark: it runs every `<command> --help`
+in a fresh interpreter under `python -X importtime`, reports the median
+wall time and the slowest imports, and exits 1 if a command is over
+budget, fails, or loads a heavy module (minknow_api, grpc, pandas,
+plotext, numpy) just to print its help.
+
+Example usage might be:
+
+    python minknow_util.py run-until --target 120 --telemetry_db telemetry.sqlite
+    python minknow_util.py basecall --pod5_list pod5_dirs.txt --num_gpus 4
+    python minknow_util.py startup --repeats 5 --max_ms 300
+"""
+
+import argparse
+import importlib
+import importlib.util
+import os
+import subprocess
+import sys
+import time
+from typing import NamedTuple
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# name: (script file, one line summary)
+COMMANDS = {
+    "start": ("start_protocol.r10.py", "start protocols from a sample sheet, optionally followed by run until"),
+    "start-r9": ("start_protocol.py", "start R9.4.1 protocols from a sample sheet"),
+    "run-until": ("run_until.py", "stop each flow cell once it reaches its target yield"),
+    "run-until-rapid": ("run_until_rapid.py", "stop every flow cell once the total yield reaches a target"),
+    "monitor": ("dashboard.py", "live per position yield, pores, rate and time to target"),
+    "telemetry": ("telemetry_log.py", "print logged per position yield and pore counts"),
+    "basecall": ("dorado_basecall_controller.py", "basecall pod5 directories with dorado across GPUs"),
+    "basecall-guppy": ("base_call_controller.py", "basecall fast5 directories with guppy across GPUs"),
+    "report": ("extract_run_info.py", "summarize run reports (yield, N50, pores)"),
+    "pore-count": ("pore_count.py", "count single pores in pore scan files"),
+    "transfer": ("transfer_daemon.py", "move finished files off the sequencer"),
+    "checksum": ("checksum.py", "hash files in parallel"),
+    "ledger": ("job_ledger.py", "print the basecalling job ledger"),
+    "sample-sheet": ("sample_sheet.py", "check a sample sheet"),
+    "stop-policy": ("stop_policy.py", "check a stop policy config"),
+    "benchmark": ("benchmark.py", "benchmark run until and protocol start against a fake MinKNOW"),
+}
+# modules that should never be loaded just to print help
+HEAVY_MODULES = ("minknow_api", "grpc", "pandas", "plotext", "matplotlib", "numpy")
+DEFAULT_REPEATS = 5
+DEFAULT_MAX_MS = 500
+
+
+def load_command(name):
+    """Import the module behind a subcommand."""
+    filename = COMMANDS[name][0]
+    module_name = os.path.splitext(filename)[0]
+    if '.' not in module_name:
+        if SCRIPT_DIR not in sys.path:
+            sys.path.insert(0, SCRIPT_DIR)
+        return importlib.import_module(module_name)
+    # start_protocol.r10.py is not an importable name
+    module_name = module_name.replace('.', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_command(name, argv):
+    module = load_command(name)
+    # the script's own argparse then shows "minknow_util.py <name>" in its usage
+    sys.argv = ["%s %s" % (os.path.basename(sys.argv[0]), name)] + list(argv)
+    return module.main()
+
+
+class StartupTime(NamedTuple):
+    command: str
+    median_ms: float
+    exit_status: int
+    # (cumulative microseconds, module) of the slowest top level imports of the last repeat
+    slowest: list
+    heavy: list
+
+
+def parse_importtime(stderr):
+    """
+    Returns:
+        (list of (cumulative us, module) for top level imports, set of every module imported).
+    """
+    top_level = []
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        module = fields[2].rstrip()
+        name = module.strip()
+        modules.add(name)
+        # nested imports are indented by two spaces per level
+        if len(module) - len(module.lstrip()) <= 1:
+            top_level.append((int(fields[1]), name))
+    return top_level, modules
+
+
+def time_startup(command, repeats=DEFAULT_REPEATS, top=5):
+    """Time `minknow_util.py [command] --help` in fresh interpreters."""
+    args = [sys.executable, "-X", "importtime", os.path.abspath(__file__)]
+    if command is not None:
+        args.append(command)
+    args.append("--help")
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    top_level, modules = parse_importtime(process.stderr)
+    heavy = sorted(name for name in modules if name.split('.')[0] in HEAVY_MODULES and '.' not in name)
+    slowest = sorted(top_level, reverse=True)[:top]
+    return StartupTime(command or "(none)", times[len(times) // 2], process.returncode, slowest, heavy)
+
+
+def startup_benchmark(argv):
+    parser = argparse.ArgumentParser(prog="%s startup" % os.path.basename(sys.argv[0]),
+                                     description="Import time benchmark of every subcommand's --help.")
+    parser.add_argument("commands", nargs="*", help="subcommands to time [defaults to all]")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="fresh interpreters per command, the median is reported [default %d]" % DEFAULT_REPEATS)
+    parser.add_argument("--max_ms", type=float, default=DEFAULT_MAX_MS, help="fail if a command's median startup is slower [default %d]" % DEFAULT_MAX_MS)
+    parser.add_argument("--top", type=int, default=3, help="slowest imports listed per command [default 3]")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.commands if name not in COMMANDS]
+    if unknown:
+        parser.error("unknown command(s) %s" % ", ".join(unknown))
+
+    failures = 0
+    print("command\tmedian_ms\tstatus\tslowest imports (cumulative ms)")
+    for name in [None] + (args.commands or sorted(COMMANDS)):
+        result = time_startup(name, args.repeats, args.top)
+        problems = []
+        if result.exit_status != 0:
+            problems.append("exit status %d" % result.exit_status)
+        if result.median_ms > args.max_ms:
+            problems.append("over %.0f ms" % args.max_ms)
+        if result.heavy:
+            problems.append("loads %s" % ", ".join(result.heavy))
+        failures += bool(problems)
+        print("%s\t%.0f\t%s\t%s" % (result.command, result.median_ms, "; ".join(problems) or "ok",
+                                    ", ".join("%s %.1f" % (module, us / 1000) for us, module in result.slowest)))
+    if failures:
+        print("%d command(s) failed the startup budget" % failures)
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="MinKNOW utility scripts.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n%s\n  %-17s %s\n\nrun `%s <command> --help` for a command's options" % (
+            "\n".join("  %-17s %s" % (name, COMMANDS[name][1]) for name in COMMANDS),
+            "startup", "import time benchmark of every command's --help",
+            os.path.basename(sys.argv[0])))
+    parser.add_argument("command", choices=sorted(COMMANDS) + ["startup"], metavar="command")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="options passed on to the command")
+    args = parser.parse_args()
+
+    if args.command == "startup":
+        return startup_benchmark(args.args)
+    return run_command(args.command, args.args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Count single pores in the last mux scan of every pore_scan_data*.csv below a directory.
+
+Replaces the grep | cut | sort | uniq pipeline of pore_count.sh. Only the
+channel assessment and scan number columns are read, found by their header
+names (falling back to the 16th and 53rd columns the shell script used),
+the single pore rows are counted per scan with NumPy, and files are
+processed in parallel. With --cache, counts are kept by file mtime and size
+so a rerun only reads new scans.
+
+Example usage might be:
+
+    python pore_count.py /data/RUSHAD_P12 --cache pore_count.cache.json
+    python pore_count.py . --all_scans
+"""
+
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from extract_run_info import load_cache, save_cache, file_key
+
+DEFAULT_ASSESSMENT_COLUMN = "mux_scan_assessment"
+DEFAULT_SCAN_COLUMN = "repeat"
+# 0-based positions of the columns pore_count.sh cut out (cut -f 16,53)
+LEGACY_COLUMNS = (15, 52)
+
+
+def find_pore_scans(directory):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        # raw data directories hold tens of thousands of files and never a pore scan
+        dirnames[:] = [d for d in dirnames if not d.startswith('fast5') and not d.startswith('pod5')]
+        paths.extend(os.path.join(dirpath, f) for f in filenames if f.startswith('pore_scan_data') and f.endswith('.csv'))
+    return sorted(paths)
+
+
+def column_indexes(path, assessment_column, scan_column):
+    with open(path, 'r', newline='') as f_in:
+        header = next(csv.reader(f_in))
+    if assessment_column in header and scan_column in header:
+        return header.index(assessment_column), header.index(scan_column)
+    return LEGACY_COLUMNS
+
+
+def count_single_pores(path, assessment_column=DEFAULT_ASSESSMENT_COLUMN, scan_column=DEFAULT_SCAN_COLUMN):
+    """Single pore count per scan of one pore scan file.
+
+    Returns:
+        (path, [[scan, single pores], ...] sorted by scan, None) or (path, None, error message).
+    """
+    import numpy as np
+    import pandas as pd
+
+    try:
+        assessment_index, scan_index = column_indexes(path, assessment_column, scan_column)
+        table = pd.read_csv(path, usecols=[assessment_index, scan_index], header=0)
+        assessments = table.iloc[:, 0 if assessment_index < scan_index else 1].to_numpy()
+        scans = table.iloc[:, 1 if assessment_index < scan_index else 0].to_numpy(dtype=float)
+        scans, counts = np.unique(scans[assessments == 'single_pore'], return_counts=True)
+        return path, [[float(scan), int(count)] for scan, count in zip(scans, counts)], None
+    except (OSError, ValueError, StopIteration, pd.errors.ParserError) as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def pore_counts(paths, processes=None, cache_path=None, assessment_column=DEFAULT_ASSESSMENT_COLUMN,
+                scan_column=DEFAULT_SCAN_COLUMN):
+    """
+    Returns:
+        List of (path, per scan counts) in the order of paths, unreadable files are left out.
+    """
+    cache = load_cache(cache_path)
+    columns = [assessment_column, scan_column]
+    counts = {}
+    todo = []
+    for path in paths:
+        entry = cache.get(path)
+        if entry is not None and entry['key'] == file_key(path) and entry['columns'] == columns:
+            counts[path] = entry['counts']
+        else:
+            todo.append(path)
+
+    if len(todo) > 1 and processes != 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(count_single_pores, todo, [assessment_column] * len(todo),
+                                    [scan_column] * len(todo), chunksize=4))
+    else:
+        results = [count_single_pores(path, assessment_column, scan_column) for path in todo]
+    for path, scan_counts, error in results:
+        if error is not None:
+            print("Skipping %s, %s" % (path, error), file=sys.stderr)
+            continue
+        counts[path] = scan_counts
+        cache[path] = {'key': file_key(path), 'columns': columns, 'counts': scan_counts}
+
+    if cache_path is not None and todo:
+        save_cache(cache_path, cache)
+    return [(path, counts[path]) for path in paths if path in counts]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count single pores in the last mux scan of every pore_scan_data*.csv")
+    parser.add_argument("directory", nargs="?", default=".", help="directory searched for pore scan files [default .]")
+    parser.add_argument("--cache", default=None, help="JSON file caching each file's counts by mtime and size")
+    parser.add_argument("--processes", type=int, default=None, help="files read in parallel [default one per cpu]")
+    parser.add_argument("--all_scans", default=False, action="store_true", help="print the count of every scan, not only the last")
+    parser.add_argument("--assessment_column", default=DEFAULT_ASSESSMENT_COLUMN, help="column holding the single_pore classification [default %s]" % DEFAULT_ASSESSMENT_COLUMN)
+    parser.add_argument("--scan_column", default=DEFAULT_SCAN_COLUMN, help="column numbering the scans [default %s]" % DEFAULT_SCAN_COLUMN)
+    args = parser.parse_args()
+
+    results = pore_counts(find_pore_scans(args.directory), args.processes, args.cache,
+                          args.assessment_column, args.scan_column)
+    for path, scan_counts in results:
+        if not scan_counts:
+            print("%s\t0\tsingle_pore" % path)
+            continue
+        for scan, count in (scan_counts if args.all_scans else scan_counts[-1:]):
+            print("%s\t%d\tsingle_pore\t%g" % (path, count, scan))
+
+
+if __name__ == "__main__":
+    main()
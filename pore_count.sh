@@ -1,10 +1,5 @@
+# single pore count of the last mux scan in every pore_scan_data*.csv below a directory (the current one by default),
+# see pore_count.py for the options (--cache, --all_scans, ...)
 function pore_count {
-	for i in $(find . -name "pore_scan_data*.csv");
-	do 
-		echo -e "$i\t$( \
-		grep 'single_pore' $i | \
-		cut -f 16,53 -d ',' | \
-		sed 's/,/\t/g' | \
-		sort -k2,2g | uniq -c | tail -1)"
-	done
+	python "$(dirname "${BASH_SOURCE[0]}")/pore_count.py" "${@:-.}"
 }
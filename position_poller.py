@@ -0,0 +1,91 @@
+"""
+Concurrent status polling for MinKNOW flow cell positions.
+
+Each position is polled on a worker thread so that one sweep over a fully
+loaded P48 takes roughly as long as the slowest position rather than the sum
+of all of them. The run until scripts consume the returned PositionStatus
+tuples and keep their own stop logic.
+
+Example usage might be:
+
+    results = poll_positions(manager.flow_cell_positions(), max_concurrency=16)
+    for result in results:
+        if result.is_processing:
+            print(result.name, result.acquisition_info.yield_summary.estimated_selected_bases)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+# 3 is enum code for PROCESSING
+PROCESSING = 3
+
+DEFAULT_MAX_CONCURRENCY = 16
+
+class PositionStatus(NamedTuple):
+    position: object
+    connection: object
+    has_flow_cell: bool
+    status: Optional[int]
+    acquisition_info: object
+    error: Optional[Exception]
+
+    @property
+    def name(self):
+        return self.position.name
+
+    @property
+    def is_processing(self):
+        return self.error is None and self.status == PROCESSING
+
+
+def poll_position(pos, check_flow_cell=False, connection_cache=None):
+    """Connect to one position and fetch its acquisition status and info.
+
+    Acquisition info is only requested for positions that are currently
+    processing. Errors are captured on the result so a single unreachable
+    position does not abort the whole sweep. When a connection_cache is
+    given the connection is reused across sweeps and dropped on failure.
+
+    Returns:
+        PositionStatus for the position.
+    """
+    connection = None
+    has_flow_cell = True
+    status = None
+    acquisition_info = None
+    try:
+        connection = connection_cache.connect(pos) if connection_cache is not None else pos.connect()
+        if check_flow_cell:
+            has_flow_cell = connection.device.get_flow_cell_info().has_flow_cell
+        if has_flow_cell:
+            status = connection.acquisition.current_status().status
+            if status == PROCESSING:
+                acquisition_info = connection.acquisition.get_acquisition_info()
+    except Exception as e:
+        if connection_cache is not None:
+            connection_cache.invalidate(pos.name)
+        return PositionStatus(pos, connection, has_flow_cell, status, acquisition_info, e)
+    return PositionStatus(pos, connection, has_flow_cell, status, acquisition_info, None)
+
+
+def poll_positions(positions, max_concurrency=DEFAULT_MAX_CONCURRENCY, check_flow_cell=False, connection_cache=None,
+                   report_errors=True):
+    """Poll every position in parallel.
+
+    Failures are printed unless report_errors is False (e.g. under a full screen dashboard),
+    they are always on the results.
+
+    Returns:
+        List of PositionStatus in the same order as positions.
+    """
+    positions = list(positions)
+    if not positions:
+        return []
+    max_workers = max(1, min(max_concurrency, len(positions)))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda pos: poll_position(pos, check_flow_cell, connection_cache), positions))
+    for result in results:
+        if report_errors and result.error is not None:
+            print("Failed to poll position %s: %s" % (result.name, result.error))
+    return results
@@ -0,0 +1,122 @@
+"""
+Helpers for starting protocols on many positions at once.
+
+Most flow cells in a start share the same (product_code, kit, basecalling)
+combination, so ProtocolResolver only asks MinKNOW to search its protocol list
+once per combination. run_per_position runs a per-position function on a
+thread pool and reports how long each position took, and RateLimiter spaces
+out calls such as start_protocol so MinKNOW is not hit with 48 at once.
+
+Example usage might be:
+
+    resolver = ProtocolResolver()
+    limiter = RateLimiter(2)
+    timings = run_per_position(experiment_specs, start_one, max_concurrency=8)
+    print_timings("start", timings)
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+DEFAULT_START_CONCURRENCY = 8
+DEFAULT_START_RATE = 2.0
+
+
+class ProtocolResolver(object):
+    """Memoized protocols.find_protocol keyed on (product_code, kit, basecalling)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key: Future of the identifier, set by the first caller to ask for that combination
+        self._identifiers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, position_connection, product_code, kit, basecalling):
+        """Return the protocol identifier for the combination, searching MinKNOW only once for it."""
+        # We need `find_protocol` to search for the required protocol given a kit + product code.
+        from minknow_api.tools import protocols
+
+        key = (product_code, kit, basecalling)
+        # only the dict is locked, so different combinations are searched for in parallel
+        # and callers asking for one already being searched for wait on its future
+        with self._lock:
+            future = self._identifiers.get(key)
+            searching = future is None
+            if searching:
+                future = Future()
+                self._identifiers[key] = future
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not searching:
+            return future.result()
+        try:
+            protocol_info = protocols.find_protocol(
+                position_connection,
+                product_code=product_code,
+                kit=kit,
+                basecalling=basecalling
+            )
+        except BaseException as e:
+            # the callers already waiting see the error, later ones search again
+            with self._lock:
+                del self._identifiers[key]
+            future.set_exception(e)
+            raise
+        future.set_result(protocol_info.identifier)
+        return protocol_info.identifier
+
+
+class RateLimiter(object):
+    """Let at most rate calls per second through acquire(), spaced evenly."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def run_per_position(experiment_specs, fn, max_concurrency=DEFAULT_START_CONCURRENCY):
+    """Call fn(spec) for every spec on a thread pool.
+
+    Exceptions raised by fn are re-raised here once every spec has finished.
+
+    Returns:
+        List of (spec, result, seconds taken) in the order of experiment_specs.
+    """
+    def timed(spec):
+        start = time.time()
+        result = fn(spec)
+        return result, time.time() - start
+
+    experiment_specs = list(experiment_specs)
+    if not experiment_specs:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(experiment_specs)))) as pool:
+        futures = [pool.submit(timed, spec) for spec in experiment_specs]
+    timings = []
+    for spec, future in zip(experiment_specs, futures):
+        result, elapsed = future.result()
+        timings.append((spec, result, elapsed))
+    return timings
+
+
+def print_timings(step, timings):
+    """Print how long each position took for a step, slowest first."""
+    if not timings:
+        return
+    print("Per-position %s time:" % step)
+    for spec, result, elapsed in sorted(timings, key=lambda x: -x[2]):
+        print("    position={}\t{:.2f} s".format(spec.entry.position_id, elapsed))
+    print("    slowest %.2f s, total %.2f s across %d positions" % (
+        max(x[2] for x in timings), sum(x[2] for x in timings), len(timings)))
@@ -1,12 +1,105 @@
 ### > python run_until.py --host "localhost" --port 9501
 
 import argparse
+import threading
 import time
-import pandas as pd
-# minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities for
-# querying sequencing positions + offline basecalling tools.
-from minknow_api.manager import Manager
-from collections import defaultdict
+from position_poller import poll_positions, DEFAULT_MAX_CONCURRENCY
+from connection_cache import PositionConnectionCache
+from fleet_snapshot import SnapshotSource
+from acquisition_watcher import AcquisitionWatcher
+from telemetry_log import TelemetryLog, single_pores
+from sample_sheet import parse_target, SampleSheetError, DEFAULT_TARGET_GB
+from metrics_exporter import DEFAULT_METRICS_HOST
+from run_until_checkpoint import save_checkpoint, load_checkpoint
+from run_until_scheduler import RunUntilScheduler, LatestReadings, check_position, default_policy, run_until, DEFAULT_MIN_INTERVAL, DEFAULT_MAX_INTERVAL
+
+
+def watch_until(manager, args, target_yields, target_positions, connection_cache, policy, telemetry=None, view=None):
+    """Event driven run until: stop each position from its acquisition update stream.
+
+    Positions are discovered with a polling sweep every discovery_interval
+    seconds; once a position is processing its stream drives the stop decision
+    and it is no longer polled.
+    """
+    lock = threading.Lock()
+    running_samples = set()
+    finished_samples = set()
+    yields = {}
+    # every position's latest update, so the stop policy sees the whole fleet on each one
+    readings = LatestReadings()
+    if args.resume:
+        checkpoint = load_checkpoint(args.checkpoint)
+        if checkpoint is not None:
+            running_samples = checkpoint.running_samples
+            finished_samples = checkpoint.finished_samples
+            yields = checkpoint.yields
+
+    def on_update(pos, connection, acquisition_info):
+        # 2 and 3 are enum codes for ACQUISITION_FINISHING and ACQUISITION_COMPLETED
+        if acquisition_info.state in (2, 3): return True
+        if telemetry is not None:
+            telemetry.record(time.time(), pos.name, 3, acquisition_info.yield_summary.estimated_selected_bases, single_pores(acquisition_info))
+        if view is not None:
+            view.record(time.time(), pos.name, "running", acquisition_info.yield_summary.estimated_selected_bases, single_pores(acquisition_info))
+            view.publish(time.time())
+        with lock:
+            if pos.name in finished_samples: return True
+            yields[pos.name] = check_position(pos.name, connection, acquisition_info, readings, target_yields, finished_samples, policy, report=False,
+                                              on_decision=None if view is None else lambda name, decision: view.decide(time.time(), name, decision))
+            if pos.name in finished_samples:
+                if args.checkpoint != None:
+                    save_checkpoint(args.checkpoint, running_samples, finished_samples, yields)
+                return True
+            return False
+
+    watcher = AcquisitionWatcher(on_update, connection_cache)
+    snapshots = SnapshotSource(manager, connection_cache)
+    while True:
+        snapshot = snapshots.next_cycle()
+        positions = snapshot.positions()
+        snapshot.prune(positions)
+        with lock:
+            positions = [
+                pos for pos in positions
+                if pos.name not in finished_samples and not watcher.watching(pos.name)
+                and (target_positions == None or pos.name in target_positions)
+            ]
+        sweep_start = time.time()
+        results = poll_positions(positions, max_concurrency=args.max_concurrency, connection_cache=snapshot)
+        if view is not None:
+            for result in results:
+                view.record_result(sweep_start, result)
+            view.publish(time.time(), time.time() - sweep_start)
+        for result in results:
+            if not result.is_processing: continue
+            with lock:
+                running_samples.add(result.name)
+            watcher.watch(result.position)
+        if args.checkpoint != None:
+            with lock:
+                save_checkpoint(args.checkpoint, running_samples, finished_samples, yields)
+
+        # sleep until the next discovery sweep, waking early on stream updates to see if we are done
+        deadline = time.time() + args.discovery_interval
+        while time.time() < deadline:
+            with lock:
+                done = len(running_samples) == len(finished_samples)
+                total_yield = sum(yields.values())
+            if done:
+                watcher.cancel_all()
+                print("All sequencing jobs finished.")
+                print("Estimated %.2f Gb sequenced" % (total_yield / 1000000000))
+                print("%d acquisition updates received." % watcher.updates)
+                print("Qutting now. Have a nice day :)")
+                return
+            watcher.changed.wait(deadline - time.time())
+            watcher.changed.clear()
+
+        with lock:
+            print("{} samples currently sequencing.".format(len(running_samples) - len(finished_samples)))
+            print("Estimated %.2f Gb sequenced." % (sum(yields.values()) / 1000000000))
+            print("{} runs  completed.".format(len(finished_samples)))
+        print("%d acquisition updates received." % watcher.updates)
 
 
 def main():
@@ -14,78 +107,93 @@ def main():
     parser = argparse.ArgumentParser(description="Stop sequencing once an estimated base troughput has been met.")
     parser.add_argument("--host", default="localhost", help="Specify which host to connect to.")
     parser.add_argument("--port", default=None, help="Specify which porer to connect to.")
-    parser.add_argument("--target", default="140", help="Gigabase yield target to stop sequencing (in gigabases). [default 60]")
+    parser.add_argument("--target", default=str(DEFAULT_TARGET_GB), help="Gigabase yield target to stop sequencing (in gigabases), or a sample sheet with a target column. [default %d]" % DEFAULT_TARGET_GB)
     parser.add_argument("--flowcell_positions", default=None, help="Comma-seperated list of flowcell positions to check [defaults to all currently running flowcells]")
+    parser.add_argument("--max_concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Max number of positions polled in parallel. [default %d]" % DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--min_interval", type=float, default=DEFAULT_MIN_INTERVAL, help="Shortest time between checks of a position close to its target (in seconds). [default %d]" % DEFAULT_MIN_INTERVAL)
+    parser.add_argument("--max_interval", type=float, default=DEFAULT_MAX_INTERVAL, help="Longest time between checks of a position far from its target (in seconds). [default %d]" % DEFAULT_MAX_INTERVAL)
+    parser.add_argument("--telemetry_db", default=None, help="SQLite file to log every position's yield and pore count to on each poll.")
+    parser.add_argument("--checkpoint", default=None, help="File to save controller state to after every check, for use with --resume.")
+    parser.add_argument("--resume", default=False, action="store_true", help="Reload the state saved in --checkpoint, skipping runs already stopped or left to run to exhaustion.")
+    parser.add_argument("--stop_policy", default=None, help="JSON file of stop rules (target, aggregate_target, pore_floor, rate_decay, max_runtime), see stop_policy.py. [default stop above target with more than 1500 pores left]")
+    parser.add_argument("--watch", default=False, action="store_true", help="Stop runs from MinKNOW's streamed acquisition updates instead of polling.")
+    parser.add_argument("--metrics_port", type=int, default=0, help="Serve Prometheus metrics of every position's latest poll on this port. [default 0, off]")
+    parser.add_argument("--metrics_host", default=DEFAULT_METRICS_HOST, help="Address the metrics endpoint listens on. [default %s]" % DEFAULT_METRICS_HOST)
+    parser.add_argument("--discovery_interval", type=float, default=600, help="Seconds between sweeps for newly started runs in --watch mode. [default 600]")
 
     args = parser.parse_args()
+    if args.resume and args.checkpoint == None:
+        parser.error("--resume needs --checkpoint")
+
+    print("assigning target yields:")
+    try:
+        target_yields = parse_target(args.target)
+    except (OSError, SampleSheetError) as e:
+        parser.error(str(e))
+
+    if args.stop_policy != None:
+        from stop_policy import load_policy
+        try:
+            policy = load_policy(args.stop_policy)
+        except (OSError, ValueError) as e:
+            parser.error("--stop_policy: %s" % e)
+    else:
+        policy = default_policy()
+    print("stop policy:")
+    print(policy.describe())
+
+    # imported here so --help and the unified CLI start without loading grpc
+    # minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities for
+    # querying sequencing positions + offline basecalling tools.
+    from minknow_api.manager import Manager
 
     # Construct a manager using the host + port provided.
     print("connecting . . . ")
     manager = Manager(host=args.host, port=args.port)
     print("done connecting!!")
 
-    print("assigning target yields:")
-    target_yields = {}
-    if (args.target.isalnum()):
-        target_yields = defaultdict(lambda:float(args.target) * 1e9)
-    else:
-        sample_sheet = pd.read_table(args.target)
-        target_yields = defaultdict(lambda:200 * 1e9)
-        for i,row in sample_sheet.iterrows():
-            target_yields[row.position_id] = row.target * 1e9
 
     target_positions = None
     if args.flowcell_positions != None:
         target_positions = set(args.flowcell_positions.strip().split(','))
 
 
-    running_samples = set()
-    finished_samples = set()
-    #time.sleep(800)
+    connection_cache = PositionConnectionCache()
 
-    
-    while True:
-        # Find a list of currently available sequencing positions.
-        positions = manager.flow_cell_positions()
-
-        total_yield = 0
-        for pos in positions:
-            if pos.name in finished_samples: continue
-            if target_positions == None or pos.name in target_positions:
-                connection = pos.connect()
-
-                # check if flowcell is currently sequencing
-                # 3 is enum code for PROCESSING
-                if connection.acquisition.current_status().status != 3: continue
-                if pos.name in finished_samples: continue
-
-                running_samples.add(pos.name)
-
-                current_yield = connection.acquisition.get_acquisition_info().yield_summary.estimated_selected_bases
-                current_pores = connection.acquisition.get_acquisition_info().bream_info.mux_scan_results[-1].counts['single_pore']
-
-                total_yield += current_yield
-                print("Flowcell at position %s currently sequencing, current yield: %.2f Gb, target yield: %.1f Gb, pores available: %d" % (pos.name, current_yield / 1e9, target_yields[pos.name]/1e9, current_pores))
-                if current_yield > target_yields[pos.name] and current_pores > 1500:
-                    print("Sequencing run in %s has sequenced an estimated %.2f Gb. Flowcell has %d pores left. Stopping run." % (pos.name, current_yield / 1e9, current_pores))
-                    connection.protocol.stop_protocol()
-                    finished_samples.add(pos.name)
-                elif current_yield > target_yields[pos.name]:
-                    print("Sequencing run in %s has hit target, with an estimated %.2f Gb, With only %d pores left, continuing sequencing to exhaustion." % (pos.name, current_yield / 1e9, current_pores ))
-                    finished_samples.add(pos.name)
-
-        if len(running_samples) == len(finished_samples):
-            print("All sequencing jobs finished.")
-            print("Estimated %.2f Gb sequenced" % (total_yield / 1000000000))
-            print("Qutting now. Have a nice day :)")
-            return
+    telemetry = None
+    if args.telemetry_db != None:
+        telemetry = TelemetryLog(args.telemetry_db)
+
+    view = None
+    if args.metrics_port:
+        from dashboard import FleetView
+        from metrics_exporter import MetricsExporter
+        # scrapes are answered from the last published poll, never with extra MinKNOW calls
+        view = FleetView(target_yields)
+        MetricsExporter(view, args.metrics_host, args.metrics_port).start()
 
-        print("{} samples currently sequencing.".format(len(running_samples) - len(finished_samples)))
-        print("Estimated %.2f Gb sequenced." % (total_yield / 1000000000))
-        print("{} runs  completed.".format(len(finished_samples)))
-        print("Waiting 30 minutes to check progress again.")
-        time.sleep(1800) # wait 30 minutes and then check yield again
+    try:
+        if args.watch:
+            watch_until(manager, args, target_yields, target_positions, connection_cache, policy, telemetry, view)
+            return
 
+        scheduler = RunUntilScheduler(min_interval=args.min_interval, max_interval=args.max_interval)
+        run_until(
+            manager,
+            target_yields,
+            args.max_concurrency,
+            connection_cache,
+            position_filter=lambda name: target_positions == None or name in target_positions,
+            scheduler=scheduler,
+            telemetry=telemetry,
+            checkpoint_path=args.checkpoint,
+            resume=args.resume,
+            view=view,
+            policy=policy,
+        )
+    finally:
+        if telemetry is not None:
+            telemetry.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+"""
+Checkpoints of run until controller state for warm restarts.
+
+The set of running and finished positions, their last yields and the
+scheduler's next check times are written to a JSON file after every check.
+Writes go to a temporary file in the same directory which is fsynced and then
+renamed over the checkpoint, so a crash mid-write leaves the previous
+checkpoint intact.
+
+Example usage might be:
+
+    save_checkpoint("run_until.checkpoint.json", running_samples, finished_samples, yields, scheduler.state())
+    checkpoint = load_checkpoint("run_until.checkpoint.json")
+"""
+
+import json
+import os
+import tempfile
+import time
+from typing import NamedTuple
+
+CHECKPOINT_VERSION = 1
+
+
+class Checkpoint(NamedTuple):
+    saved_at: float
+    running_samples: set
+    finished_samples: set
+    yields: dict
+    scheduler: dict
+
+
+def save_checkpoint(path, running_samples, finished_samples, yields, scheduler_state=None):
+    """Atomically replace the checkpoint at path with the given state."""
+    state = {
+        "version": CHECKPOINT_VERSION,
+        "saved_at": time.time(),
+        "running_samples": sorted(running_samples),
+        "finished_samples": sorted(finished_samples),
+        "yields": yields,
+        "scheduler": scheduler_state or {},
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, "w") as out:
+            json.dump(state, out)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """Read a checkpoint written by save_checkpoint.
+
+    Returns:
+        Checkpoint, or None if there is no checkpoint at path.
+    """
+    if path is None or not os.path.isfile(path):
+        print("No checkpoint found at %s, starting from scratch." % path)
+        return None
+    with open(path, "r") as f_in:
+        state = json.load(f_in)
+    if state.get("version") != CHECKPOINT_VERSION:
+        print("Checkpoint %s has unsupported version %s, starting from scratch." % (path, state.get("version")))
+        return None
+    return Checkpoint(
+        saved_at=state["saved_at"],
+        running_samples=set(state["running_samples"]),
+        finished_samples=set(state["finished_samples"]),
+        yields=state["yields"],
+        scheduler=state["scheduler"],
+    )
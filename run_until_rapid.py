@@ -1,14 +1,178 @@
-### > python run_until.py --host "localhost" --port 9501
+### > python run_until_rapid.py --host "localhost" --port 9501 --target 210
+
+"""
+Stop every flow cell once the fleet's total estimated yield reaches a target.
+
+The poll / decide cycle is run_until_rapid(), importable on its own like
+run_until_scheduler.run_until, so benchmark.py drives the same code against
+a fake MinKNOW. main() only adds the plots or dashboard around it.
+
+Example usage might be:
+
+    run_until_rapid(manager, StopPolicy([AggregateTargetRule(210)]), 210e9, PositionConnectionCache())
+"""
 
 import argparse
+import threading
 import time
 import statistics
-import plotext as plt
-import pandas as pd
-# minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities for
-# querying sequencing positions + offline basecalling tools.
-from minknow_api.manager import Manager
-from collections import defaultdict
+from position_poller import poll_positions, DEFAULT_MAX_CONCURRENCY
+from connection_cache import PositionConnectionCache
+from fleet_snapshot import SnapshotSource
+from acquisition_watcher import AcquisitionWatcher
+from run_until_scheduler import RunUntilScheduler, STOPPED
+from telemetry_log import TelemetryLog, single_pores
+from dashboard import DEFAULT_REFRESH_INTERVAL
+from metrics_exporter import DEFAULT_METRICS_HOST
+
+
+def discover_and_watch(positions, watcher, max_concurrency, connection_cache):
+    """Start watching every processing position that is not already being watched."""
+    positions = [pos for pos in positions if not watcher.watching(pos.name)]
+    for result in poll_positions(positions, max_concurrency=max_concurrency, connection_cache=connection_cache):
+        if result.is_processing:
+            watcher.watch(result.position)
+
+
+def run_until_rapid(manager, policy, target_yield, connection_cache, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                    min_interval=20, max_interval=600, watch=False, discovery_interval=600, telemetry=None,
+                    view=None, render=None, plot=None, snapshots=None):
+    """Poll (or watch) every position until the stop policy has decided on all of them.
+
+    Args:
+        policy: stop_policy.StopPolicy evaluated over every position each cycle,
+            usually an aggregate_target rule of target_yield.
+        target_yield: fleet total in bases the polling schedule and forecast aim at.
+        watch: follow MinKNOW's acquisition update streams instead of polling.
+        telemetry: optional TelemetryLog every poll result is recorded to.
+        view: optional dashboard.FleetView every poll and decision is published to.
+        render: optional dashboard.RenderThread drawing view; progress is printed
+            only without one and it is stopped once every position is decided on.
+        plot: optional callable(seq_time, yields, total_yield, forecast, yield_history)
+            drawing the progress after every cycle but the first.
+        snapshots: fleet_snapshot.SnapshotSource giving each cycle's shared RPC
+            results, made from manager and connection_cache if not given.
+    """
+    # imported here so --help and the unified CLI start without loading numpy
+    from timeseries_buffer import TimeSeriesStore
+
+    if snapshots is None:
+        snapshots = SnapshotSource(manager, connection_cache)
+    start_time = time.time()
+    yields={}
+    pores = {}
+    # positions the stop policy has stopped or left to sequence to exhaustion, and why
+    decided = set()
+    explanations = []
+    # bounded per position and total yield history, old samples are downsampled automatically
+    yield_history = TimeSeriesStore()
+
+    yields_lock = threading.Lock()
+    target_hit = threading.Event()
+    def on_update(pos, connection, acquisition_info):
+        # 2 and 3 are enum codes for ACQUISITION_FINISHING and ACQUISITION_COMPLETED
+        if acquisition_info.state in (2, 3): return True
+        if telemetry is not None:
+            telemetry.record(time.time(), pos.name, 3, acquisition_info.yield_summary.estimated_selected_bases, single_pores(acquisition_info))
+        if view is not None:
+            view.record(time.time(), pos.name, "running", acquisition_info.yield_summary.estimated_selected_bases, single_pores(acquisition_info))
+        with yields_lock:
+            yields[pos.name] = acquisition_info.yield_summary.estimated_selected_bases
+            pores[pos.name] = single_pores(acquisition_info)
+            if sum(yields.values()) >= target_yield:
+                target_hit.set()
+        return False
+
+    watcher = AcquisitionWatcher(on_update, connection_cache)
+    last_discovery = 0
+    # the aggregate yield is scheduled as a single entry, checked more often as the total approaches target
+    scheduler = RunUntilScheduler(min_interval=min_interval, max_interval=max_interval, idle_interval=min_interval)
+    while True:
+        seq_time = time.time() - start_time
+        # Find a list of currently available sequencing positions.
+        snapshot = snapshots.next_cycle()
+        positions = snapshot.positions()
+        snapshot.prune(positions)
+
+        if watch:
+            if time.time() - last_discovery >= discovery_interval:
+                discover_and_watch(positions, watcher, max_concurrency, snapshot)
+                last_discovery = time.time()
+            with yields_lock:
+                yields_snapshot = dict(yields)
+                pores_snapshot = dict(pores)
+        else:
+            poll_start = time.time()
+            results = poll_positions(positions, max_concurrency=max_concurrency, connection_cache=snapshot, report_errors=render is None)
+            if view is not None:
+                for result in results:
+                    view.record_result(time.time(), result)
+                view.publish(time.time(), time.time() - poll_start)
+            if telemetry is not None:
+                telemetry.record_results(results)
+            for result in results:
+                # check if flowcell is currently sequencing
+                if not result.is_processing: continue
+                current_yield = result.acquisition_info.yield_summary.estimated_selected_bases
+                yields[result.name] = current_yield
+                pores[result.name] = single_pores(result.acquisition_info)
+            yields_snapshot = yields
+            pores_snapshot = pores
+        total_yield = sum(yields_snapshot.values())
+        wait = scheduler.update("total", start_time + seq_time, total_yield, target_yield)
+        forecast = scheduler.forecast("total", target_yield)
+        # the first sample only seeds the history, there is nothing to plot against yet
+        has_history = len(yield_history["total"]) > 0
+        yield_history.append("total", seq_time, total_yield)
+        for name, current_yield in yields_snapshot.items():
+            yield_history.append(name, seq_time, current_yield)
+        if watch and view is not None:
+            view.publish(time.time())
+        if has_history and plot is not None:
+            plot(seq_time, yields_snapshot, total_yield, forecast, yield_history)
+        # every position is decided on in one policy evaluation, the aggregate target stops them all together
+        names = list(yields_snapshot)
+        decisions = policy.evaluate(time.time(), names, [yields_snapshot[name] for name in names],
+                                    pores=[pores_snapshot.get(name) for name in names])
+        positions_by_name = dict((pos.name, pos) for pos in positions)
+        for name, decision, explanation in decisions.fired():
+            if name in decided: continue
+            decided.add(name)
+            explanations.append(explanation)
+            if render is None:
+                print(explanation)
+            if decision == STOPPED and name in positions_by_name:
+                snapshot.connect(positions_by_name[name]).protocol.stop_protocol()
+            if view is not None:
+                view.decide(time.time(), name, decision)
+        if names and decided.issuperset(names):
+            if render is not None:
+                render.stop()
+                print("\n".join(explanations))
+            print("Sequenced a total of %.2f Gb, the stop policy has decided on all %d positions" % (total_yield / 1e9, len(names)))
+            watcher.cancel_all()
+            print(snapshots.stats_summary())
+            return
+
+        if render is None:
+            print(connection_cache.stats_summary())
+            print(snapshots.stats_summary())
+        if watch:
+            if render is None:
+                print("%d acquisition updates received. Waiting for new yield updates." % watcher.updates)
+            # wake immediately once the target is hit, otherwise redraw every 20 seconds if anything changed,
+            # and go round for the next discovery sweep in time to find runs started since the last one
+            deadline = last_discovery + discovery_interval
+            while not target_hit.wait(max(0, min(20, deadline - time.time()))):
+                if watcher.changed.is_set() or time.time() >= deadline:
+                    break
+            watcher.changed.clear()
+            # set again by the next update while the total stays above target
+            target_hit.clear()
+            continue
+        if render is None:
+            print("Waiting %.1f minutes to check progress again." % (wait / 60))
+        time.sleep(wait)
 
 
 def main():
@@ -17,9 +181,40 @@ def main():
     parser.add_argument("--host", default="localhost", help="Specify which host to connect to.")
     parser.add_argument("--port", default=None, help="Specify which porer to connect to.")
     parser.add_argument("--target", default="210", help="Gigabase yield target to stop sequencing (in gigabases). [default 210]")
+    parser.add_argument("--max_concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Max number of positions polled in parallel. [default %d]" % DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--min_interval", type=float, default=20, help="Shortest time between checks once the total is close to target (in seconds). [default 20]")
+    parser.add_argument("--max_interval", type=float, default=600, help="Longest time between checks while the total is far from target (in seconds). [default 600]")
+    parser.add_argument("--telemetry_db", default=None, help="SQLite file to log every position's yield and pore count to on each poll.")
+    parser.add_argument("--stop_policy", default=None, help="JSON file of stop rules (target, aggregate_target, pore_floor, rate_decay, max_runtime), see stop_policy.py. [default an aggregate_target rule of --target]")
+    parser.add_argument("--watch", default=False, action="store_true", help="Follow MinKNOW's streamed acquisition updates and stop as soon as the target is hit instead of polling every 20 seconds.")
+    parser.add_argument("--dashboard", default=False, action="store_true", help="Show a live per position table redrawn on its own thread instead of the plotext plots.")
+    parser.add_argument("--refresh_interval", type=float, default=DEFAULT_REFRESH_INTERVAL, help="Seconds between --dashboard screen refreshes. [default %d]" % DEFAULT_REFRESH_INTERVAL)
+    parser.add_argument("--metrics_port", type=int, default=0, help="Serve Prometheus metrics of every position's latest poll on this port. [default 0, off]")
+    parser.add_argument("--metrics_host", default=DEFAULT_METRICS_HOST, help="Address the metrics endpoint listens on. [default %s]" % DEFAULT_METRICS_HOST)
+    parser.add_argument("--discovery_interval", type=float, default=600, help="Seconds between sweeps for newly started runs in --watch mode. [default 600]")
 
     args = parser.parse_args()
 
+    # imported here so --help and the unified CLI start without loading numpy
+    from stop_policy import StopPolicy, AggregateTargetRule, load_policy
+    from dashboard import FleetView, RenderThread, Screen
+    from metrics_exporter import MetricsExporter
+
+    # the stop policy defaults to the total yield of every position reaching --target
+    policy = StopPolicy([AggregateTargetRule(args.target)])
+    if args.stop_policy != None:
+        try:
+            policy = load_policy(args.stop_policy)
+        except (OSError, ValueError) as e:
+            parser.error("--stop_policy: %s" % e)
+
+    # imported here so --help and the unified CLI start without loading grpc and plotext
+    if not args.dashboard:
+        import plotext as plt
+    # minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities for
+    # querying sequencing positions + offline basecalling tools.
+    from minknow_api.manager import Manager
+
     # Construct a manager using the host + port provided.
     print("connecting . . . ")
     manager = Manager(host=args.host, port=args.port)
@@ -27,36 +222,39 @@ def main():
 
     target_yield = float(args.target) * 1e9
 
-    start_time = time.time()
-    yields={}
-    sequencing_times = []
-    total_yields = []
-    plt.plot_size(90,25)
-    plt.theme('dark')
-    while True:
-        fc_yields = []
-        seq_time = time.time() - start_time
-        # Find a list of currently available sequencing positions.
-        positions = manager.flow_cell_positions()
+    print("stop policy:")
+    print(policy.describe())
 
-        total_yield = 0
-        for pos in positions:
-                connection = pos.connect()
-                # check if flowcell is currently sequencing
-                # 3 is enum code for PROCESSING
-                if connection.acquisition.current_status().status != 3: continue
-                current_yield = connection.acquisition.get_acquisition_info().yield_summary.estimated_selected_bases
-                yields[pos.name] = current_yield
-                #print("Flowcell at position %s currently sequencing, current yield: %.2f Gb" % (pos.name, current_yield / 1e9))
-        fc_yields = list(map(lambda x: x[1], yields.items()))
-        plot_yields = [ x /1e9 for x in fc_yields]
-        total_yield = sum(fc_yields)
-        if len(total_yields) > 0:
-            max_fc = max(yields.items(), key = lambda x: x[1])
-            min_fc = min(yields.items(), key = lambda x: x[1])
+    connection_cache = PositionConnectionCache()
+    # each cycle's reads are made once and shared by the stop check, the display and telemetry
+    snapshots = SnapshotSource(manager, connection_cache)
+    telemetry = None
+    if args.telemetry_db != None:
+        telemetry = TelemetryLog(args.telemetry_db)
+
+    view = None
+    render = None
+    if args.dashboard or args.metrics_port:
+        view = FleetView(total_target=target_yield)
+    if args.dashboard:
+        # drawn from the latest snapshot on its own thread, so a slow redraw never delays a poll
+        render = RenderThread(view, Screen(), args.refresh_interval, title="run until rapid, target %s Gb" % args.target)
+        render.start()
+    if args.metrics_port:
+        # scrapes are answered from the last published poll, never with extra MinKNOW calls
+        MetricsExporter(view, args.metrics_host, args.metrics_port).start()
+
+    plot = None
+    if render is None:
+        plt.plot_size(90,25)
+        plt.theme('dark')
+
+        def plot(seq_time, yields_snapshot, total_yield, forecast, yield_history):
+            fc_yields = list(yields_snapshot.values())
+            plot_yields = [ x /1e9 for x in fc_yields]
+            max_fc = max(yields_snapshot.items(), key = lambda x: x[1])
+            min_fc = min(yields_snapshot.items(), key = lambda x: x[1])
             median_fc = statistics.median(fc_yields)
-            seq_rate = ((total_yield - total_yields[-1])/1e9) / ((seq_time - sequencing_times[-1])/60)
-            time_left = (target_yield - total_yield) / seq_rate
             ## Histogram 
             plt.ylim(0,5)
             plt.hist(plot_yields,50)
@@ -68,23 +266,24 @@ def main():
             ## Throughput line plot
             plt.ylim(0,250)
             plt.xlim(0,180)
-            plt.plot([x/60 for x in sequencing_times + [seq_time]], [y /1e9 for y in total_yields + [total_yield]])
+            plot_times, plot_total_yields = yield_history["total"].history()
+            plt.plot(plot_times / 60, plot_total_yields / 1e9)
             plt.show()
             plt.clear_data()
             print("Sequencing Time: %.2f minutes\t\t Total Sequenced: %.2f Gb \t\t Gb left til Target: %.2f" % (seq_time / 60, total_yield / 1e9, (target_yield - total_yield)/1e9))
-            print("Sequencing Rate: %.3f Gb/min \t\t Estimated time til target: %.2f minutes" % (seq_rate, time_left / 1e9))
-        sequencing_times.append(seq_time)
-        total_yields.append(total_yield)
-        if total_yield >= target_yield:
-            print("Sequenced a total of %.2f Gb, Stopping protocols on all positions" % total_yield / 1e9)
-            positions = manager.flow_cell_positions()
-            for pos in positions:
-                connection = pos.connect()
-                connection.protocol.stop_protocol()
-            return
+            if forecast is not None:
+                print("Sequencing Rate: %.3f Gb/min \t\t Estimated time til target: %.2f minutes (%.2f - %.2f)" % (forecast.rate * 60 / 1e9, forecast.seconds / 60, forecast.earliest / 60, forecast.latest / 60))
+            else:
+                print("Sequencing Rate: not yet known")
 
-        print("Waiting 1 minutes to check progress again.")
-        time.sleep(20) # wait 1 minute and then check yield again
+    try:
+        run_until_rapid(manager, policy, target_yield, connection_cache, max_concurrency=args.max_concurrency,
+                        min_interval=args.min_interval, max_interval=args.max_interval, watch=args.watch,
+                        discovery_interval=args.discovery_interval, telemetry=telemetry, view=view, render=render,
+                        plot=plot, snapshots=snapshots)
+    finally:
+        if telemetry is not None:
+            telemetry.close()
 
     print("Have a nice day :)")
 
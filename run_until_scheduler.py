@@ -0,0 +1,384 @@
+"""
+Shared run until loop with an adaptive, per-position polling schedule.
+
+Instead of sweeping every position on a fixed sleep, each position gets its
+own next check time derived from its current yield rate and its distance to
+target. A flow cell that is hours away from its target is checked rarely; one
+that is minutes away is checked every min_interval seconds. Time to target
+comes from a YieldForecaster per position, and the earliest end of its
+confidence band is used so a noisy rate errs towards checking early. Next
+check times are kept in a priority queue so a wake-up only polls the
+positions that are actually due.
+
+Example usage might be:
+
+    run_until(manager, target_yields, args.max_concurrency, connection_cache,
+              position_filter=lambda name: name in sample_positions,
+              pore_threshold=2000, check_flow_cell=True)
+"""
+
+import heapq
+import time
+from typing import NamedTuple
+
+from position_poller import poll_positions
+from yield_forecast import YieldForecaster, DEFAULT_HALF_LIFE
+from run_until_checkpoint import save_checkpoint, load_checkpoint
+from fleet_snapshot import SnapshotSource
+from telemetry_log import single_pores
+
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 1800
+# used for positions that are not sequencing yet and for the first check of a run
+DEFAULT_IDLE_INTERVAL = 300
+# shortest wait when checking at a predicted target crossing
+MIN_CROSSING_WAIT = 5
+
+
+class RunUntilScheduler(object):
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 idle_interval=DEFAULT_IDLE_INTERVAL, safety=0.5, half_life=DEFAULT_HALF_LIFE):
+        """
+        Args:
+            min_interval: shortest time between two checks of a position (seconds).
+            max_interval: longest time between two checks of a position (seconds).
+            idle_interval: wait used when no yield rate is known yet (seconds).
+            safety: fraction of the predicted time to target to wait before checking again.
+            half_life: smoothing half-life of the yield rate forecasts (seconds).
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_interval = min(idle_interval, max_interval)
+        self.safety = safety
+        self.half_life = half_life
+        self.polls = 0
+        self._heap = []
+        self._next_check = {}
+        self._forecasters = {}
+
+    def __contains__(self, name):
+        return name in self._next_check
+
+    def __len__(self):
+        return len(self._next_check)
+
+    def schedule(self, name, when):
+        """(Re)schedule a position; an earlier entry for it is superseded."""
+        self._next_check[name] = when
+        heapq.heappush(self._heap, (when, name))
+
+    def remove(self, name):
+        self._next_check.pop(name, None)
+        self._forecasters.pop(name, None)
+
+    def pop_due(self, now):
+        """Remove and return the names of all positions due at or before now."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, name = heapq.heappop(self._heap)
+            # skip entries that were rescheduled or removed since being pushed
+            if self._next_check.get(name) != when: continue
+            del self._next_check[name]
+            due.append(name)
+        self.polls += len(due)
+        return due
+
+    def next_check_time(self):
+        while self._heap and self._next_check.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def seconds_until_next(self, now):
+        when = self.next_check_time()
+        if when is None:
+            return self.idle_interval
+        return max(0, when - now)
+
+    def forecaster(self, name):
+        if name not in self._forecasters:
+            self._forecasters[name] = YieldForecaster(half_life=self.half_life)
+        return self._forecasters[name]
+
+    def forecast(self, name, target_yield):
+        """Latest time to target forecast for a position, or None without a usable rate."""
+        if name not in self._forecasters:
+            return None
+        return self._forecasters[name].predict_crossing(target_yield)
+
+    def next_interval(self, forecast):
+        if forecast is None:
+            return self.idle_interval
+        interval = forecast.earliest * self.safety
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        # the target is predicted to be crossed before the next regular check, look right then instead
+        if forecast.seconds < interval:
+            interval = max(MIN_CROSSING_WAIT, forecast.seconds)
+        return interval
+
+    def update(self, name, now, current_yield, target_yield):
+        """Record a yield sample and schedule the position's next check.
+
+        Returns:
+            The number of seconds until the position is checked again.
+        """
+        self.forecaster(name).add(now, current_yield)
+        interval = self.next_interval(self.forecast(name, target_yield))
+        self.schedule(name, now + interval)
+        return interval
+
+    def state(self):
+        """JSON serialisable next check times and forecasts, restored with restore()."""
+        return {
+            "polls": self.polls,
+            "next_check": dict(self._next_check),
+            "forecasters": dict((name, f.state()) for name, f in self._forecasters.items()),
+        }
+
+    def restore(self, state):
+        self.polls = state.get("polls", 0)
+        for name, when in state.get("next_check", {}).items():
+            self.schedule(name, when)
+        for name, forecaster_state in state.get("forecasters", {}).items():
+            self.forecaster(name).restore(forecaster_state)
+
+    def idle(self, name, now):
+        """Schedule a position that is not sequencing to be looked at again later."""
+        self._forecasters.pop(name, None)
+        self.schedule(name, now + self.idle_interval)
+
+
+# decisions passed to check_positions' on_decision
+STOPPED = "stopped"
+TO_EXHAUSTION = "to_exhaustion"
+
+
+def default_policy(pore_threshold=1500):
+    """Stop above target while more than pore_threshold single pores are left, see stop_policy.py."""
+    # imported here so the controllers' --help starts without loading numpy
+    from stop_policy import StopPolicy
+    return StopPolicy.default(pore_threshold)
+
+
+class Reading(NamedTuple):
+    connection: object
+    acquisition_info: object
+    sampled_at: float
+    # smoothed yield rate in bases per second, None to let the policy estimate it
+    rate: object = None
+
+
+class LatestReadings(object):
+    """Latest acquisition info of every sequencing position.
+
+    Only the positions that are due get polled each cycle, but the stop policy
+    is evaluated over all of them so fleet wide rules such as aggregate_target
+    see every position's yield.
+    """
+
+    def __init__(self):
+        self._readings = {}
+        self._idle = set()
+
+    def __len__(self):
+        return len(self._readings)
+
+    def __contains__(self, name):
+        return name in self._readings
+
+    def __getitem__(self, name):
+        return self._readings[name]
+
+    def names(self):
+        return list(self._readings)
+
+    def update(self, name, connection, acquisition_info, sampled_at, rate=None):
+        self._readings[name] = Reading(connection, acquisition_info, sampled_at, rate)
+        self._idle.discard(name)
+
+    def idle(self, name):
+        """The position stopped sequencing; its last yield still counts towards the fleet's total."""
+        if name in self._readings:
+            self._idle.add(name)
+
+    def is_idle(self, name):
+        return name in self._idle
+
+
+def check_positions(now, due, readings, target_yields, finished_samples, policy, report=True, on_decision=None):
+    """Evaluate the stop policy over every position's latest reading and act on the due positions' decisions.
+
+    Args:
+        due: names of the positions read this cycle, already added to readings.
+        readings: LatestReadings of every position tracked.
+        policy: stop_policy.StopPolicy.
+        on_decision: called with (name, STOPPED or TO_EXHAUSTION) for every position decided on.
+
+    Returns:
+        (dict of name: current estimated yield in bases of the due positions,
+         names of positions the policy decided on from an older reading; they
+         should be read again before acting on them).
+    """
+    names = readings.names()
+    infos = [readings[name].acquisition_info for name in names]
+    yields = [acquisition_info.yield_summary.estimated_selected_bases for acquisition_info in infos]
+    pores = [single_pores(acquisition_info) for acquisition_info in infos]
+    # an unset start time reads as 0, the policy then counts from the first time it saw the run
+    started_at = [acquisition_info.start_time.seconds or None for acquisition_info in infos]
+    targets = [target_yields[name] for name in names]
+    due = set(due)
+    if report:
+        for name, current_yield, target_yield, current_pores in zip(names, yields, targets, pores):
+            if name not in due or current_pores is None: continue
+            print("Flowcell at position %s currently sequencing, current yield: %.2f Gb, target yield: %.1f Gb, pores available: %d" % (name, current_yield / 1e9, target_yield/1e9, current_pores))
+
+    result = policy.evaluate(now, names, yields, targets, pores, [readings[name].rate for name in names], started_at,
+                             [readings[name].sampled_at for name in names])
+    stale = []
+    for name, decision, explanation in result.fired():
+        if name in finished_samples or readings.is_idle(name): continue
+        if name not in due:
+            stale.append(name)
+            continue
+        print(explanation)
+        if decision == STOPPED:
+            readings[name].connection.protocol.stop_protocol()
+        finished_samples.add(name)
+        if on_decision is not None:
+            on_decision(name, decision)
+    return dict((name, current_yield) for name, current_yield in zip(names, yields) if name in due), stale
+
+
+def check_position(name, connection, acquisition_info, readings, target_yields, finished_samples, policy, report=True,
+                   on_decision=None):
+    """check_positions for a single position, e.g. from an acquisition update stream.
+
+    The other positions' decisions are left to their own next update.
+
+    Returns:
+        The position's current estimated yield in bases.
+    """
+    now = time.time()
+    readings.update(name, connection, acquisition_info, now)
+    yields, stale = check_positions(now, [name], readings, target_yields, finished_samples, policy,
+                                    report=report, on_decision=on_decision)
+    return yields[name]
+
+
+def run_until(manager, target_yields, max_concurrency, connection_cache, position_filter=None,
+              pore_threshold=1500, check_flow_cell=False, scheduler=None, wait_for_start=False, telemetry=None,
+              checkpoint_path=None, resume=False, view=None, snapshots=None, policy=None):
+    """Poll positions on their adaptive schedule until every run has hit its target.
+
+    Args:
+        position_filter: optional callable taking a position name, positions for
+            which it returns False are ignored.
+        wait_for_start: keep waiting while no run is sequencing yet, used right
+            after protocols have been started.
+        telemetry: optional TelemetryLog every poll result is recorded to.
+        checkpoint_path: file the loop state is saved to after every check.
+        resume: reload the state saved at checkpoint_path and carry on from it.
+            Positions already decided on are not looked at again and the
+            others keep their scheduled check times.
+        view: optional dashboard.FleetView every poll result and stop decision is
+            published to, e.g. for a metrics_exporter.MetricsExporter.
+        snapshots: fleet_snapshot.SnapshotSource giving each cycle's shared RPC
+            results, made from manager and connection_cache if not given.
+        policy: stop_policy.StopPolicy deciding which runs to stop, evaluated
+            once per cycle over every position polled. Defaults to stopping
+            above target with more than pore_threshold single pores left.
+    """
+    if scheduler is None:
+        scheduler = RunUntilScheduler()
+    if snapshots is None:
+        snapshots = SnapshotSource(manager, connection_cache)
+    if policy is None:
+        policy = default_policy(pore_threshold)
+    readings = LatestReadings()
+    running_samples = set()
+    finished_samples = set()
+    yields = {}
+    if resume:
+        checkpoint = load_checkpoint(checkpoint_path)
+        if checkpoint is not None:
+            running_samples = checkpoint.running_samples
+            finished_samples = checkpoint.finished_samples
+            yields = checkpoint.yields
+            scheduler.restore(checkpoint.scheduler)
+            print("Resumed from %s: %d runs sequencing, %d runs completed." % (
+                checkpoint_path, len(running_samples) - len(finished_samples), len(finished_samples)))
+
+    while True:
+        now = time.time()
+        # every read this cycle (listing, status, acquisition info, flow cell info) is made once and shared
+        snapshot = snapshots.next_cycle(now)
+        # Find a list of currently available sequencing positions.
+        positions = snapshot.positions()
+        snapshot.prune(positions)
+        positions = dict(
+            (pos.name, pos) for pos in positions
+            if pos.name not in finished_samples and (position_filter is None or position_filter(pos.name))
+        )
+        for name in positions:
+            if name not in scheduler: scheduler.schedule(name, now)
+
+        due = [positions[name] for name in scheduler.pop_due(now) if name in positions]
+        results = poll_positions(due, max_concurrency=max_concurrency, check_flow_cell=check_flow_cell,
+                                 connection_cache=snapshot)
+        if telemetry is not None:
+            telemetry.record_results(results, now)
+        if view is not None:
+            for result in results:
+                view.record_result(now, result)
+        checked = []
+        for result in results:
+            # check if flowcell is currently sequencing
+            if not result.has_flow_cell or not result.is_processing:
+                scheduler.idle(result.name, now)
+                readings.idle(result.name)
+                continue
+            running_samples.add(result.name)
+            # rate as of the previous check
+            readings.update(result.name, result.connection, result.acquisition_info, now, scheduler.forecaster(result.name).rate)
+            checked.append(result.name)
+
+        # one policy evaluation over the latest reading of every position, acting on the ones polled this cycle
+        checked_yields, stale = check_positions(now, checked, readings, target_yields, finished_samples, policy,
+                                                on_decision=None if view is None else lambda name, decision: view.decide(now, name, decision))
+        yields.update(checked_yields)
+        for name in stale:
+            # decided on from an older reading, read it again right away before stopping it
+            if name in scheduler: scheduler.schedule(name, now)
+        for name, current_yield in checked_yields.items():
+            if name in finished_samples:
+                scheduler.remove(name)
+            else:
+                interval = scheduler.update(name, now, current_yield, target_yields[name])
+                forecast = scheduler.forecast(name, target_yields[name])
+                if forecast is not None:
+                    print("    %.0f Mb/min, estimated %.1f minutes to target (%.1f - %.1f), next check in %.1f minutes" % (
+                        forecast.rate * 60 / 1e6, forecast.seconds / 60, forecast.earliest / 60, forecast.latest / 60, interval / 60))
+
+        if view is not None and due:
+            view.publish(now, time.time() - now)
+
+        if checkpoint_path is not None and due:
+            save_checkpoint(checkpoint_path, running_samples, finished_samples, yields, scheduler.state())
+
+        total_yield = sum(yields.values())
+        if len(running_samples) == len(finished_samples) and (running_samples or not wait_for_start):
+            print("All sequencing jobs finished.")
+            print("Estimated %.2f Gb sequenced" % (total_yield / 1000000000))
+            print("%d position checks made." % scheduler.polls)
+            print(snapshots.stats_summary())
+            print("Qutting now. Have a nice day :)")
+            return
+
+        wait = scheduler.seconds_until_next(time.time())
+        if due:
+            print("{} samples currently sequencing.".format(len(running_samples) - len(finished_samples)))
+            print("Estimated %.2f Gb sequenced." % (total_yield / 1000000000))
+            print("{} runs  completed.".format(len(finished_samples)))
+            print(connection_cache.stats_summary())
+            print(snapshots.stats_summary())
+            print("Waiting %.1f minutes to check progress again." % (wait / 60))
+        time.sleep(wait)
@@ -0,0 +1,185 @@
+"""
+Sample sheet loading shared by the start and run until scripts.
+
+A sample sheet is a tab (or comma) separated table with a header naming at
+least position_id, sample_id and experiment_id, and optionally a target
+column giving the yield in gigabases to stop that flow cell at. The whole
+sheet is checked before anything is started: missing columns, empty cells,
+bad targets and positions listed twice are all reported together, with
+their line numbers. Entries are indexed by position and by sample, so
+matching thousands of positions to the sheet is one dict lookup each.
+
+Parsed with the csv module, so starting a run never has to import pandas.
+
+Example usage might be:
+
+    sheet = read_sample_sheet("sample_sheet.tsv", require_target=True)
+    spec = sheet.by_position.get(position.name)
+    target_yields = sheet.target_yields()
+"""
+
+import argparse
+import csv
+from collections import defaultdict
+from typing import NamedTuple, Optional
+
+# yield in gigabases a position stops at when neither the sheet nor the command line gives one
+DEFAULT_TARGET_GB = 140
+REQUIRED_COLUMNS = ("position_id", "sample_id", "experiment_id")
+TARGET_COLUMN = "target"
+
+
+class SampleSheetError(ValueError):
+    pass
+
+
+class SampleSheetEntry(NamedTuple):
+    position_id: str
+    sample_id: str
+    experiment_id: str
+    # gigabases, None when the sheet has no target for this position
+    target: Optional[float] = None
+    line: int = 0
+
+
+class SampleSheet(object):
+    def __init__(self, entries, default_target=DEFAULT_TARGET_GB):
+        self.entries = list(entries)
+        self.default_target = default_target
+        self.by_position = dict((entry.position_id, entry) for entry in self.entries)
+        # a sample may be sequenced on more than one flow cell
+        self.by_sample = defaultdict(list)
+        for entry in self.entries:
+            self.by_sample[entry.sample_id].append(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, position_id):
+        return position_id in self.by_position
+
+    def positions(self):
+        return [entry.position_id for entry in self.entries]
+
+    def target_yields(self):
+        """
+        Returns:
+            defaultdict of position name to target yield in bases, positions missing from
+            the sheet (or without a target) get default_target.
+        """
+        default = self.default_target * 1e9
+        target_yields = defaultdict(lambda: default)
+        for entry in self.entries:
+            if entry.target is not None:
+                target_yields[entry.position_id] = entry.target * 1e9
+        return target_yields
+
+
+def _delimiter(header_line):
+    return '\t' if '\t' in header_line else ','
+
+
+def parse_sample_sheet(lines, require_target=False, default_target=DEFAULT_TARGET_GB, name="sample sheet"):
+    """Parse and validate sample sheet lines.
+
+    Args:
+        lines: iterable of text lines, header first.
+        require_target: every row must have a target.
+        name: used in error messages.
+
+    Returns:
+        SampleSheet.
+
+    Raises:
+        SampleSheetError listing every problem found.
+    """
+    lines = iter(lines)
+    header_line = next(lines, "")
+    header = [column.strip() for column in next(csv.reader([header_line], delimiter=_delimiter(header_line)), [])]
+    required = REQUIRED_COLUMNS + ((TARGET_COLUMN,) if require_target else ())
+    missing = [column for column in required if column not in header]
+    if missing:
+        raise SampleSheetError("%s is missing column(s) %s, found %s" % (
+            name, ", ".join(missing), ", ".join(header) or "no header"))
+    indexes = dict((column, header.index(column)) for column in REQUIRED_COLUMNS)
+    target_index = header.index(TARGET_COLUMN) if TARGET_COLUMN in header else None
+
+    errors = []
+    entries = []
+    first_line = {}
+    for line_number, row in enumerate(csv.reader(lines, delimiter=_delimiter(header_line)), 2):
+        row = [cell.strip() for cell in row]
+        if not any(row):
+            continue
+        row += [""] * (len(header) - len(row))
+        values = dict((column, row[index]) for column, index in indexes.items())
+        empty = [column for column in REQUIRED_COLUMNS if not values[column]]
+        if empty:
+            errors.append("line %d: empty %s" % (line_number, ", ".join(empty)))
+            continue
+
+        target = None
+        if target_index is not None and row[target_index]:
+            try:
+                target = float(row[target_index])
+            except ValueError:
+                errors.append("line %d: target %r is not a number" % (line_number, row[target_index]))
+                continue
+            if target <= 0:
+                errors.append("line %d: target %r must be above 0 Gb" % (line_number, row[target_index]))
+                continue
+        elif require_target:
+            errors.append("line %d: no target for %s" % (line_number, values["position_id"]))
+            continue
+
+        position_id = values["position_id"]
+        if position_id in first_line:
+            errors.append("line %d: position %s is already used on line %d, cannot start two experiments on the same flow cell" % (
+                line_number, position_id, first_line[position_id]))
+            continue
+        first_line[position_id] = line_number
+        entries.append(SampleSheetEntry(position_id, values["sample_id"], values["experiment_id"], target, line_number))
+
+    if errors:
+        raise SampleSheetError("%s has %d problem(s):\n    %s" % (name, len(errors), "\n    ".join(errors)))
+    return SampleSheet(entries, default_target)
+
+
+def read_sample_sheet(path, require_target=False, default_target=DEFAULT_TARGET_GB):
+    with open(path, 'r', newline='') as f_in:
+        return parse_sample_sheet(f_in, require_target, default_target, name=path)
+
+
+def parse_target(target, default_target=DEFAULT_TARGET_GB):
+    """Target yields for a --target argument that is either a number of gigabases or a sample sheet path.
+
+    Returns:
+        defaultdict of position name to target yield in bases.
+    """
+    try:
+        gigabases = float(target)
+    except ValueError:
+        return read_sample_sheet(target, require_target=False, default_target=default_target).target_yields()
+    return defaultdict(lambda: gigabases * 1e9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a sample sheet and print its entries")
+    parser.add_argument("sample_sheet", help="tab or comma separated sample sheet")
+    parser.add_argument("--require_target", default=False, action="store_true", help="every row must have a target")
+    args = parser.parse_args()
+    try:
+        sheet = read_sample_sheet(args.sample_sheet, args.require_target)
+    except SampleSheetError as e:
+        parser.exit(1, "%s\n" % e)
+    for entry in sheet:
+        print("%s\t%s\t%s\t%s" % (entry.position_id, entry.sample_id, entry.experiment_id,
+                                  "%g Gb" % entry.target if entry.target is not None else "default %g Gb" % sheet.default_target))
+    print("%d positions, %d samples" % (len(sheet), len(sheet.by_sample)))
+
+
+if __name__ == "__main__":
+    main()
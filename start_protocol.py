@@ -16,18 +16,21 @@ python ./python/minknow_api/examples/start_protocol.py \
 
 import argparse
 import logging
-import pandas as pd
 import sys
 
-# minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities
-# for querying sequencing positions + offline basecalling tools.
 from enum import Enum
-from typing import Optional, NamedTuple, Sequence
-from minknow_api.manager import Manager, FlowCellPosition
-
-# We need `find_protocol` to search for the required protocol given a kit + product code.
-from minknow_api.protocol_pb2 import ProtocolRunUserInfo
-from minknow_api.tools import protocols
+from typing import Sequence
+
+from connection_cache import PositionConnectionCache
+from sample_sheet import read_sample_sheet, SampleSheetEntry, SampleSheetError
+from protocol_start import (
+    ProtocolResolver,
+    RateLimiter,
+    run_per_position,
+    print_timings,
+    DEFAULT_START_CONCURRENCY,
+    DEFAULT_START_RATE,
+)
 
 
 def parse_args():
@@ -58,6 +61,18 @@ def parse_args():
         default=False, 
         action="store_true"
     )
+    parser.add_argument(
+        "--start_concurrency",
+        type=int,
+        default=DEFAULT_START_CONCURRENCY,
+        help="number of positions looked up and started in parallel [default %d]" % DEFAULT_START_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--start_rate",
+        type=float,
+        default=DEFAULT_START_RATE,
+        help="max number of start_protocol calls per second [default %.0f]" % DEFAULT_START_RATE,
+    )
     parser.add_argument(
         "--kit",
         default="SQK-LSK110",
@@ -110,63 +125,44 @@ def parse_args():
 
     return args
 
-ParsedSampleSheetEntry = NamedTuple(
-    "ParsedSampleSheetEntry",
-    [
-        ("position_id", Optional[str]),
-        ("sample_id", Optional[str]),
-        ("experiment_id", Optional[str]),
-    ]
-)
-
 class ExperimentSpec(object):
-    def __init__(self, entry: ParsedSampleSheetEntry):
+    def __init__(self, entry: SampleSheetEntry):
         self.entry = entry
         self.position = None
         self.basecalling = False
         self.protocol_id = ""
+        self.flow_cell_id = ""
 
 
 ExperimentSpecs = Sequence[ExperimentSpec]
 
-# Add sample sheet entry info to experiment_specs
-def add_sample_sheet_entries(experiment_specs : ExperimentSpecs, args):
-    if args.sample_sheet:
-        sample_sheet = pd.read_table(args.sample_sheet)
-        for i,row in sample_sheet.iterrows():
-            # Add the entry to the specs
-            experiment_specs.append(
-                ExperimentSpec(
-                    entry=ParsedSampleSheetEntry(
-                        position_id=row.position_id,
-                        sample_id=row.sample_id,
-                        experiment_id=row.experiment_id,
-                    )
-                )
-            )
-
-def add_position_to_specs(experiment_specs: ExperimentSpecs, position):
-    # Look up by position_id
-    matches = [
-        spec for spec in experiment_specs if spec.entry.position_id == position.name
-    ]
-
-    if not matches:
-        return
-    if len(matches) > 1:
-        print("Trying to start multiple experiments on the same flow cell")
+# Add sample sheet entry info to experiment_specs, returns the sample sheet
+def add_sample_sheet_entries(experiment_specs : ExperimentSpecs, args, require_target=False):
+    if not args.sample_sheet:
+        return None
+    try:
+        # duplicate positions and missing columns are caught here, before anything is started
+        sample_sheet = read_sample_sheet(args.sample_sheet, require_target=require_target)
+    except (OSError, SampleSheetError) as e:
+        print(e)
         sys.exit(1)
+    for entry in sample_sheet:
+        experiment_specs.append(ExperimentSpec(entry=entry))
+    return sample_sheet
 
-    #print(matches)
-    matches[0].position = position
-
+def add_position_to_specs(specs_by_position, position):
+    # Look up by position_id, the sample sheet has at most one entry per position
+    spec = specs_by_position.get(position.name)
+    if spec is not None:
+        spec.position = position
 
 
 # Add position info to the experiment_specs
 def add_position_info(experiment_specs, manager):
+    specs_by_position = dict((spec.entry.position_id, spec) for spec in experiment_specs)
     positions = manager.flow_cell_positions()
     for position in positions:
-        add_position_to_specs(experiment_specs, position)
+        add_position_to_specs(specs_by_position, position)
 
 
 def add_basecalling_info(experiment_specs: ExperimentSpecs, args):
@@ -175,103 +171,120 @@ def add_basecalling_info(experiment_specs: ExperimentSpecs, args):
             spec.basecalling = True
         else: return
 
+# Look up the protocol to run on one experiment's flow cell, returns False if there is no flow cell
+def add_protocol_id(spec, args, connection_cache, resolver):
+    # Connect to the sequencing position:
+    position_connection = connection_cache.connect(spec.position)
+
+    # Check if a flowcell is available for sequencing
+    flow_cell_info = position_connection.device.get_flow_cell_info()
+    if not flow_cell_info.has_flow_cell:
+        print("No flow cell present in position {}".format(spec.position))
+        return False
+
+    product_code = flow_cell_info.product_code
+    if not product_code:
+        product_code = flow_cell_info.user_specified_product_code
+
+    # Find the protocol identifier for the required protocol and store it for later:
+    spec.protocol_id = resolver.resolve(position_connection, product_code, args.kit, spec.basecalling)
+    spec.flow_cell_id = flow_cell_info.flow_cell_id
+    return True
+
 # Determine which protocol to run for each experiment, and add its ID to experiment_specs
-def add_protocol_ids(experiment_specs, args):
-    print(experiment_specs)
-    for spec in experiment_specs:
-        print(spec)
-        # Connect to the sequencing position:
-        print(spec.position)
-        position_connection = spec.position.connect()
-
-        # Check if a flowcell is available for sequencing
-        flow_cell_info = position_connection.device.get_flow_cell_info()
-        if not flow_cell_info.has_flow_cell:
-            print("No flow cell present in position {}".format(spec.position))
-            sys.exit(1)
-
-        print(flow_cell_info)
-        product_code = flow_cell_info.product_code
-        if not product_code:
-            product_code = flow_cell_info.user_specified_product_code
-
-        # Find the protocol identifier for the required protocol:
-        protocol_info = protocols.find_protocol(
-            position_connection,
-            product_code=product_code,
-            kit=args.kit,
-            basecalling=spec.basecalling
-        )
-
-        # Store the identifier for later:
-        spec.protocol_id = protocol_info.identifier
+def add_protocol_ids(experiment_specs, args, connection_cache, resolver):
+    timings = run_per_position(
+        experiment_specs,
+        lambda spec: add_protocol_id(spec, args, connection_cache, resolver),
+        max_concurrency=args.start_concurrency,
+    )
+    print("Protocol lookup: %d searches, %d cached" % (resolver.misses, resolver.hits))
+    print_timings("protocol lookup", timings)
+    if not all(has_flow_cell for spec, has_flow_cell, elapsed in timings):
+        sys.exit(1)
+
+
+def start_experiment(spec, args, connection_cache, rate_limiter):
+    position_connection = connection_cache.connect(spec.position)
+
+    protocol_arguments = [
+       "--experiment_time={}".format(args.experiment_duration),
+       "--start_bias_voltage=-165",
+       "--fast5=on",
+       "--fast5_data",
+       "raw",
+       "fastq",
+       "vbz_compress",
+       "--min_read_length=200",
+       "--generate_bulk_file=off",
+       "--active_channel_selection=on",
+       "--pore_reserve=off",
+       "--fast5_reads_per_file={}".format(args.fast5_reads_per_file),
+       "--mux_scan_period={}".format(args.mux_scan_period),
+       "--guppy_filename=dna_r9.4.1_450bps_hac_prom.cfg",
+       "--bam=off",
+    ]
+    if spec.basecalling:
+        protocol_arguments.extend([
+            "--base_calling=on",
+            "--fastq=on",
+            "--fastq_data",
+            "compress",
+            "--fastq_reads_per_file={}".format(args.fastq_reads_per_file),
+            "--read_filtering",
+            "min_qscore={}".format(args.min_qscore)
+        ])
+    else:
+        protocol_arguments.extend([
+            "--base_calling=off",
+            "--fastq=off",
+            ])
+
+    from minknow_api.protocol_pb2 import ProtocolRunUserInfo
+
+    user_info = ProtocolRunUserInfo()
+    user_info.sample_id.value = spec.entry.sample_id
+    user_info.protocol_group_id.value = spec.entry.experiment_id
+    rate_limiter.acquire()
+    position_connection.protocol.start_protocol(
+            identifier=spec.protocol_id,
+            args=protocol_arguments,
+            user_info=user_info
+    )
+
+    print("Started protocol:\n    position={}\n    flow_cell_id={}".format(spec.position.name, spec.flow_cell_id))
 
 def main():
     """Entrypoint to start protocol example"""
     # Parse arguments to be passed to started protocols:
     args = parse_args()
 
+    # imported here so --help and the unified CLI start without loading grpc
+    # minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities
+    # for querying sequencing positions + offline basecalling tools.
+    from minknow_api.manager import Manager
+
     # Construct a manager using the host + port provided:
     manager = Manager(host=args.host, port=args.port) 
 
+    connection_cache = PositionConnectionCache()
+    resolver = ProtocolResolver()
+
     experiment_specs = []
     add_sample_sheet_entries(experiment_specs, args)
     add_position_info(experiment_specs, manager)
     add_basecalling_info(experiment_specs, args)
-    add_protocol_ids(experiment_specs, args)
+    add_protocol_ids(experiment_specs, args, connection_cache, resolver)
 
     # Now start the protocol(s):
     print("Starting protocol on %s positions" % len(experiment_specs))
-    for spec in experiment_specs:
-        position_connection = spec.position.connect()
-
-        protocol_arguments = [
-           "--experiment_time={}".format(args.experiment_duration),
-           "--start_bias_voltage=-165",
-           "--fast5=on",
-           "--fast5_data",
-           "raw",
-           "fastq",
-           "vbz_compress",
-           "--min_read_length=200",
-           "--generate_bulk_file=off",
-           "--active_channel_selection=on",
-           "--pore_reserve=off",
-           "--fast5_reads_per_file={}".format(args.fast5_reads_per_file),
-           "--mux_scan_period={}".format(args.mux_scan_period),
-           "--guppy_filename=dna_r9.4.1_450bps_hac_prom.cfg",
-           "--bam=off",
-        ]
-        if spec.basecalling:
-            protocol_arguments.extend([
-                "--base_calling=on",
-                "--fastq=on",
-                "--fastq_data",
-                "compress",
-                "--fastq_reads_per_file={}".format(args.fastq_reads_per_file),
-                "--read_filtering",
-                "min_qscore={}".format(args.min_qscore)
-            ])
-        else:
-            protocol_arguments.extend([
-                "--base_calling=off",
-                "--fastq=off",
-                ])
-
-        user_info = ProtocolRunUserInfo()
-        user_info.sample_id.value = spec.entry.sample_id
-        user_info.protocol_group_id.value = spec.entry.experiment_id
-        position_connection.protocol.start_protocol(
-                identifier=spec.protocol_id,
-                args=protocol_arguments,
-                user_info=user_info
-        )
-
-        flow_cell_info = position_connection.device.get_flow_cell_info()
-
-        print("Started protocol:")
-        print("    position={}".format(spec.position.name))
-        print("    flow_cell_id={}".format(flow_cell_info.flow_cell_id))
+    rate_limiter = RateLimiter(args.start_rate)
+    timings = run_per_position(
+        experiment_specs,
+        lambda spec: start_experiment(spec, args, connection_cache, rate_limiter),
+        max_concurrency=args.start_concurrency,
+    )
+    print_timings("protocol start", timings)
 
 
 if __name__ == "__main__":
@@ -16,20 +16,27 @@ python ./python/minknow_api/examples/start_protocol.py \
 
 import argparse
 import logging
-import pandas as pd
 import time
 import sys
-from collections import defaultdict
 
-# minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities
-# for querying sequencing positions + offline basecalling tools.
 from enum import Enum
-from typing import Optional, NamedTuple, Sequence
-from minknow_api.manager import Manager, FlowCellPosition
-
-# We need `find_protocol` to search for the required protocol given a kit + product code.
-from minknow_api.protocol_pb2 import ProtocolRunUserInfo
-from minknow_api.tools import protocols
+from typing import Sequence
+
+from connection_cache import PositionConnectionCache
+from fleet_snapshot import SnapshotSource
+from sample_sheet import read_sample_sheet, SampleSheetEntry, SampleSheetError
+from protocol_start import (
+    ProtocolResolver,
+    RateLimiter,
+    run_per_position,
+    print_timings,
+    DEFAULT_START_CONCURRENCY,
+    DEFAULT_START_RATE,
+)
+from position_poller import DEFAULT_MAX_CONCURRENCY
+from telemetry_log import TelemetryLog
+from run_until_scheduler import RunUntilScheduler, default_policy, run_until, DEFAULT_MIN_INTERVAL, DEFAULT_MAX_INTERVAL
+from metrics_exporter import DEFAULT_METRICS_HOST
 
 
 def parse_args():
@@ -66,6 +73,69 @@ def parse_args():
         default=False,
         action="store_true"
     )
+    parser.add_argument(
+        "--start_concurrency",
+        type=int,
+        default=DEFAULT_START_CONCURRENCY,
+        help="number of positions looked up and started in parallel [default %d]" % DEFAULT_START_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--start_rate",
+        type=float,
+        default=DEFAULT_START_RATE,
+        help="max number of start_protocol calls per second [default %.0f]" % DEFAULT_START_RATE,
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENCY,
+        help="max number of positions polled in parallel by run until [default %d]" % DEFAULT_MAX_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--min_interval",
+        type=float,
+        default=DEFAULT_MIN_INTERVAL,
+        help="shortest time in seconds between run until checks of a position close to its target [default %d]" % DEFAULT_MIN_INTERVAL,
+    )
+    parser.add_argument(
+        "--max_interval",
+        type=float,
+        default=DEFAULT_MAX_INTERVAL,
+        help="longest time in seconds between run until checks of a position far from its target [default %d]" % DEFAULT_MAX_INTERVAL,
+    )
+    parser.add_argument(
+        "--telemetry_db",
+        default=None,
+        help="SQLite file run until logs every position's yield and pore count to on each poll",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="file run until saves its state to after every check, for use with --resume",
+    )
+    parser.add_argument(
+        "--resume",
+        help="reload run until state from --checkpoint, skipping runs already decided on",
+        default=False,
+        action="store_true"
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=0,
+        help="serve Prometheus metrics of every position's latest run until poll on this port [default 0, off]",
+    )
+    parser.add_argument(
+        "--metrics_host",
+        default=DEFAULT_METRICS_HOST,
+        help="address the metrics endpoint listens on [default %s]" % DEFAULT_METRICS_HOST,
+    )
+    parser.add_argument(
+        "--stop_policy",
+        default=None,
+        help="JSON file of stop rules for --run_until, see stop_policy.py "
+        "[default stop above target with more than 2000 pores left]",
+    )
     parser.add_argument(
         "--kit",
         default="SQK-LSK114",
@@ -97,66 +167,57 @@ def parse_args():
         help="qscore threshold above which read 'passes' basecalling"
     )
     args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+    # checked before any protocol is started
+    args.policy = default_policy(pore_threshold=2000)
+    if args.stop_policy:
+        from stop_policy import load_policy
+        try:
+            args.policy = load_policy(args.stop_policy)
+        except (OSError, ValueError) as e:
+            parser.error("--stop_policy: %s" % e)
 
     return args
 
-ParsedSampleSheetEntry = NamedTuple(
-    "ParsedSampleSheetEntry",
-    [
-        ("position_id", Optional[str]),
-        ("sample_id", Optional[str]),
-        ("experiment_id", Optional[str]),
-    ]
-)
-
 class ExperimentSpec(object):
-    def __init__(self, entry: ParsedSampleSheetEntry):
+    def __init__(self, entry: SampleSheetEntry):
         self.entry = entry
         self.position = None
         self.basecalling = False
         self.protocol_id = ""
+        self.flow_cell_id = ""
 
 
 ExperimentSpecs = Sequence[ExperimentSpec]
 
-# Add sample sheet entry info to experiment_specs
-def add_sample_sheet_entries(experiment_specs : ExperimentSpecs, args):
-    if args.sample_sheet:
-        sample_sheet = pd.read_table(args.sample_sheet)
-        for i,row in sample_sheet.iterrows():
-            # Add the entry to the specs
-            experiment_specs.append(
-                ExperimentSpec(
-                    entry=ParsedSampleSheetEntry(
-                        position_id=row.position_id,
-                        sample_id=row.sample_id,
-                        experiment_id=row.experiment_id,
-                    )
-                )
-            )
-
-def add_position_to_specs(experiment_specs: ExperimentSpecs, position):
-    # Look up by position_id
-    matches = [
-        spec for spec in experiment_specs if spec.entry.position_id == position.name
-    ]
-
-    if not matches:
-        return
-    if len(matches) > 1:
-        print("Trying to start multiple experiments on the same flow cell")
+# Add sample sheet entry info to experiment_specs, returns the sample sheet
+def add_sample_sheet_entries(experiment_specs : ExperimentSpecs, args, require_target=False):
+    if not args.sample_sheet:
+        return None
+    try:
+        # duplicate positions and missing columns are caught here, before anything is started
+        sample_sheet = read_sample_sheet(args.sample_sheet, require_target=require_target)
+    except (OSError, SampleSheetError) as e:
+        print(e)
         sys.exit(1)
+    for entry in sample_sheet:
+        experiment_specs.append(ExperimentSpec(entry=entry))
+    return sample_sheet
 
-    #print(matches)
-    matches[0].position = position
-
+def add_position_to_specs(specs_by_position, position):
+    # Look up by position_id, the sample sheet has at most one entry per position
+    spec = specs_by_position.get(position.name)
+    if spec is not None:
+        spec.position = position
 
 
 # Add position info to the experiment_specs
 def add_position_info(experiment_specs, manager):
+    specs_by_position = dict((spec.entry.position_id, spec) for spec in experiment_specs)
     positions = manager.flow_cell_positions()
     for position in positions:
-        add_position_to_specs(experiment_specs, position)
+        add_position_to_specs(specs_by_position, position)
 
 
 def add_basecalling_info(experiment_specs: ExperimentSpecs, args):
@@ -165,161 +226,170 @@ def add_basecalling_info(experiment_specs: ExperimentSpecs, args):
             spec.basecalling = True
         else: return
 
+# Look up the protocol to run on one experiment's flow cell, returns False if there is no flow cell
+def add_protocol_id(spec, args, connection_cache, resolver):
+    # Connect to the sequencing position:
+    position_connection = connection_cache.connect(spec.position)
+
+    # Check if a flowcell is available for sequencing
+    flow_cell_info = position_connection.device.get_flow_cell_info()
+    if not flow_cell_info.has_flow_cell:
+        print("No flow cell present in position {}".format(spec.position))
+        return False
+
+    product_code = flow_cell_info.product_code
+    if not product_code:
+        product_code = flow_cell_info.user_specified_product_code
+
+    # Find the protocol identifier for the required protocol and store it for later:
+    spec.protocol_id = resolver.resolve(position_connection, product_code, args.kit, spec.basecalling)
+    spec.flow_cell_id = flow_cell_info.flow_cell_id
+    return True
+
 # Determine which protocol to run for each experiment, and add its ID to experiment_specs
-def add_protocol_ids(experiment_specs, args):
-    for spec in experiment_specs:
-        # Connect to the sequencing position:
-        print(spec.position)
-        position_connection = spec.position.connect()
-
-        # Check if a flowcell is available for sequencing
-        flow_cell_info = position_connection.device.get_flow_cell_info()
-        if not flow_cell_info.has_flow_cell:
-            print("No flow cell present in position {}".format(spec.position))
-            continue
-
-        print(flow_cell_info)
-        product_code = flow_cell_info.product_code
-        if not product_code:
-            product_code = flow_cell_info.user_specified_product_code
-
-        # Find the protocol identifier for the required protocol:
-        protocol_info = protocols.find_protocol(
-            position_connection,
-            product_code=product_code,
-            kit=args.kit,
-            basecalling=spec.basecalling
-        )
-
-        # Store the identifier for later:
-        spec.protocol_id = protocol_info.identifier
+def add_protocol_ids(experiment_specs, args, connection_cache, resolver):
+    timings = run_per_position(
+        experiment_specs,
+        lambda spec: add_protocol_id(spec, args, connection_cache, resolver),
+        max_concurrency=args.start_concurrency,
+    )
+    print("Protocol lookup: %d searches, %d cached" % (resolver.misses, resolver.hits))
+    print_timings("protocol lookup", timings)
+
+
+def start_experiment(spec, connection_cache, rate_limiter):
+    # no flow cell was found when looking up the protocol
+    if not spec.protocol_id: return
+    position_connection = connection_cache.connect(spec.position)
+    if position_connection.acquisition.current_status().status == 3: return #flowcell is already processing
+
+    protocol_arguments = [
+       "--fast5=off",
+       "--pod5=on",
+       "--fastq=off",
+       "--generate_bulk_file=off",
+       "--active_channel_selection=on",
+       "--pod5_reads_per_file=10000",
+       "--mux_scan_period=2",
+       "--pore_reserve=off",
+       "--min_read_length=200",
+       "--kit",
+       "SQK-LSK114-XL"
+    ]
+    if spec.basecalling:
+        protocol_arguments.extend([
+            "--base_calling=on",
+            "--fastq=off",
+            "--bam=on",
+            "--guppy_filename=dna_r10.4.1_e8.2_400bps_5khz_modbases_5hmc_5mc_cg_sup_prom.cfg",
+            "--read_filtering",
+            "min_qscore=10",
+            "--read_splitting",
+            "enable=on",
+            "--min_read_length=200"
+        ])
+    else:
+        protocol_arguments.extend([
+            "--base_calling=off",
+            "--bam=off"
+            ])
+
+    from minknow_api.protocol_pb2 import ProtocolRunUserInfo
+
+    user_info = ProtocolRunUserInfo()
+    user_info.sample_id.value = spec.entry.sample_id
+    user_info.protocol_group_id.value = spec.entry.experiment_id
+    rate_limiter.acquire()
+    position_connection.protocol.start_protocol(
+            identifier=spec.protocol_id,
+            args=protocol_arguments,
+            user_info=user_info
+    )
+
+    print("Started protocol:\n    position={}\n    flow_cell_id={}".format(spec.position.name, spec.flow_cell_id))
+
+# Start the protocol on every experiment's position, skipping positions that are already sequencing
+def start_protocols(experiment_specs, args, connection_cache):
+    print("Starting protocol on %s positions" % len(experiment_specs))
+    rate_limiter = RateLimiter(args.start_rate)
+    timings = run_per_position(
+        experiment_specs,
+        lambda spec: start_experiment(spec, connection_cache, rate_limiter),
+        max_concurrency=args.start_concurrency,
+    )
+    print_timings("protocol start", timings)
+    return [spec.position.name for spec in experiment_specs]
+
 
 def main():
     """Entrypoint to start protocol example"""
     # Parse arguments to be passed to started protocols:
     args = parse_args()
 
+    # imported here so --help and the unified CLI start without loading grpc
+    # minknow_api.manager supplies "Manager" a wrapper around MinKNOW's Manager gRPC API with utilities
+    # for querying sequencing positions + offline basecalling tools.
+    from minknow_api.manager import Manager
+
     # Construct a manager using the host + port provided:
     manager = Manager(host=args.host, port=args.port) 
 
+    connection_cache = PositionConnectionCache()
+    snapshots = SnapshotSource(manager, connection_cache)
+
     experiment_specs = []
-    add_sample_sheet_entries(experiment_specs, args)
-    add_position_info(experiment_specs, manager)
-    add_basecalling_info(experiment_specs, args)
-    add_protocol_ids(experiment_specs, args)
+    sample_sheet = add_sample_sheet_entries(experiment_specs, args, require_target=args.run_until)
+    if args.resume:
+        # protocols were started before the restart, go straight back to monitoring them
+        sample_positions = [spec.entry.position_id for spec in experiment_specs]
+    else:
+        # the lookup and start phases share one snapshot, so positions, flow cell info and status are read once
+        snapshot = snapshots.next_cycle()
+        add_position_info(experiment_specs, snapshot)
+        add_basecalling_info(experiment_specs, args)
+        add_protocol_ids(experiment_specs, args, snapshot, ProtocolResolver())
+        sample_positions = start_protocols(experiment_specs, args, snapshot)
+        print(snapshots.stats_summary())
 
-    sample_positions=[]
-    # Now start the protocol(s):
-    print("Starting protocol on %s positions" % len(experiment_specs))
-    for spec in experiment_specs:
-        position_connection = spec.position.connect()
-        sample_positions.append(spec.position.name)
-        flow_cell_info = position_connection.device.get_flow_cell_info()
-        if not flow_cell_info.has_flow_cell:
-            continue
-        if position_connection.acquisition.current_status().status == 3: continue #flowcell is already processing
-        
-        protocol_arguments = [
-           "--fast5=off",
-           "--pod5=on",
-           "--fastq=off",
-           "--generate_bulk_file=off",
-           "--active_channel_selection=on",
-           "--pod5_reads_per_file=10000",
-           "--mux_scan_period=2",
-           "--pore_reserve=off",
-           "--min_read_length=200",
-           "--kit",
-           "SQK-LSK114-XL"
-        ]
-        if spec.basecalling:
-            protocol_arguments.extend([
-                "--base_calling=on",
-                "--fastq=off",
-                "--bam=on",
-                "--guppy_filename=dna_r10.4.1_e8.2_400bps_5khz_modbases_5hmc_5mc_cg_sup_prom.cfg",
-                "--read_filtering",
-                "min_qscore=10",
-                "--read_splitting",
-                "enable=on",
-                "--min_read_length=200"
-            ])
-        else:
-            protocol_arguments.extend([
-                "--base_calling=off",
-                "--bam=off"
-                ])
-
-        user_info = ProtocolRunUserInfo()
-        user_info.sample_id.value = spec.entry.sample_id
-        user_info.protocol_group_id.value = spec.entry.experiment_id
-        position_connection.protocol.start_protocol(
-                identifier=spec.protocol_id,
-                args=protocol_arguments,
-                user_info=user_info
-        )
-
-        flow_cell_info = position_connection.device.get_flow_cell_info()
-
-        print("Started protocol:")
-        print("    position={}".format(spec.position.name))
-        print("    flow_cell_id={}".format(flow_cell_info.flow_cell_id))
-    
     if args.run_until:
-        time.sleep(900) # wait 10 minutes and then start checking yield
-        sample_sheet = pd.read_table(args.sample_sheet)
-        target_yields = {}
-        target_yields = defaultdict(lambda:120 * 1e9)
-        for i,row in sample_sheet.iterrows():
-            target_yields[row.position_id] = row.target * 1e9
-
-        running_samples = set()
-        finished_samples = set()
-
-        while True:
-            # Find a list of currently available sequencing positions.
-            fc_positions = manager.flow_cell_positions()
-
-            total_yield = 0
-            for pos in fc_positions:
-                if pos.name in finished_samples: continue
-                if pos.name in sample_positions:
-                    connection = pos.connect()
-
-                    # check if flowcell is currently sequencing
-                    # 3 is enum code for PROCESSING
-                    flow_cell_info = connection.device.get_flow_cell_info()
-                    if not flow_cell_info.has_flow_cell:
-                        continue
-                    if connection.acquisition.current_status().status != 3: continue
-                    if pos.name in finished_samples: continue
-
-                    running_samples.add(pos.name)
-
-                    current_yield = connection.acquisition.get_acquisition_info().yield_summary.estimated_selected_bases
-                    current_pores = connection.acquisition.get_acquisition_info().bream_info.mux_scan_results[-1].counts['single_pore']
-
-                    total_yield += current_yield
-                    print("Flowcell at position %s currently sequencing, current yield: %.2f Gb, target yield: %.1f Gb, pores available: %d" % (pos.name, current_yield / 1e9, target_yields[pos.name]/1e9, current_pores))
-                    if current_yield > target_yields[pos.name] and current_pores > 2000:
-                        print("Sequencing run in %s has sequenced an estimated %.2f Gb. Flowcell has %d pores left. Stopping run." % (pos.name, current_yield / 1e9, current_pores))
-                        connection.protocol.stop_protocol()
-                        finished_samples.add(pos.name)
-                    elif current_yield > target_yields[pos.name]:
-                        print("Sequencing run in %s has hit target, with an estimated %.2f Gb, With only %d pores left, continuing sequencing to exhaustion." % (pos.name, current_yield / 1e9, current_pores ))
-                        finished_samples.add(pos.name)
-
-            if len(running_samples) == len(finished_samples):
-                print("All sequencing jobs finished.")
-                print("Estimated %.2f Gb sequenced" % (total_yield / 1000000000))
-                print("Qutting now. Have a nice day :)")
-                return
-
-            print("{} samples currently sequencing.".format(len(running_samples) - len(finished_samples)))
-            print("Estimated %.2f Gb sequenced." % (total_yield / 1000000000))
-            print("{} runs  completed.".format(len(finished_samples)))
-            print("Waiting 30 minutes to check progress again.")
-            time.sleep(1800) # wait 30 minutes and then check yield again
+        target_yields = sample_sheet.target_yields()
+        print("stop policy:")
+        print(args.policy.describe())
+
+        telemetry = None
+        if args.telemetry_db:
+            telemetry = TelemetryLog(args.telemetry_db)
+
+        view = None
+        if args.metrics_port:
+            from dashboard import FleetView
+            from metrics_exporter import MetricsExporter
+            # scrapes are answered from the last published poll, never with extra MinKNOW calls
+            view = FleetView(target_yields)
+            MetricsExporter(view, args.metrics_host, args.metrics_port).start()
+
+        # positions are checked as soon as they start sequencing rather than after a fixed startup delay
+        scheduler = RunUntilScheduler(min_interval=args.min_interval, max_interval=args.max_interval)
+        try:
+            run_until(
+                manager,
+                target_yields,
+                args.max_concurrency,
+                connection_cache,
+                position_filter=lambda name: name in sample_positions,
+                check_flow_cell=True,
+                scheduler=scheduler,
+                wait_for_start=True,
+                telemetry=telemetry,
+                checkpoint_path=args.checkpoint,
+                resume=args.resume,
+                view=view,
+                snapshots=snapshots,
+                policy=args.policy,
+            )
+        finally:
+            if telemetry is not None:
+                telemetry.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,371 @@
+"""
+Declarative stop rules evaluated over the whole fleet at once.
+
+A StopPolicy is a list of rules, read from a JSON config or built from
+the command line defaults, that decides for every sequencing position
+whether to keep going, stop the run, or leave it to sequence to
+exhaustion. Each cycle the positions' yields, targets, single pores,
+yield rates and run times are laid out as NumPy arrays and every rule is
+evaluated on all of them in one vector operation, so the decision cost
+stays flat from a MinION to hundreds of positions. Every decision comes
+with a log line saying which rule fired and on what values.
+
+Rules, in the order they are given in the config:
+
+    target            yield above the position's target (sample sheet or --target)
+    aggregate_target  summed yield of every position above gigabases, stops them all
+    pore_floor        a yield rule that fires with pores or fewer single pores left
+                      sequences to exhaustion instead of stopping, and waits for the
+                      first mux scan when the pore count is not known yet
+    rate_decay        yield rate below fraction of the run's peak rate, after min_hours
+    max_runtime       run time above hours
+
+Example config (run_until.py's old behaviour plus two extra cut offs):
+
+    {"rules": [
+        {"rule": "target"},
+        {"rule": "pore_floor", "pores": 1500},
+        {"rule": "rate_decay", "fraction": 0.15, "min_hours": 24},
+        {"rule": "max_runtime", "hours": 72}
+    ]}
+
+Example usage might be:
+
+    policy = load_policy("stop_policy.json")
+    result = policy.evaluate(now, names, yields, targets, pores)
+    for name, decision, explanation in result.fired():
+        print(explanation)
+
+    python stop_policy.py stop_policy.json
+"""
+
+import argparse
+import json
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+# numpy is imported inside the functions that evaluate the rules, so checking a
+# config and the controllers' --help start without loading it
+from run_until_scheduler import STOPPED, TO_EXHAUSTION
+
+# decision codes, a stronger decision wins when several rules fire
+CONTINUE = 0
+EXHAUST = 1
+STOP = 2
+DECISION_NAMES = {EXHAUST: TO_EXHAUSTION, STOP: STOPPED}
+# smoothing of the yield rate the policy estimates itself when no rates are passed in
+RATE_SMOOTHING = 0.3
+
+
+class PolicyInputs(NamedTuple):
+    now: float
+    names: list
+    yields: 'np.ndarray'
+    # bases, nan where a position has no target
+    targets: 'np.ndarray'
+    # single pores from the last mux scan, nan before the first one
+    pores: 'np.ndarray'
+    # bases per second, nan while unknown
+    rates: 'np.ndarray'
+    peak_rates: 'np.ndarray'
+    runtimes: 'np.ndarray'
+
+
+class Rule(ABC):
+    """A stop rule. Yield rules are the ones a pore_floor rule applies to."""
+
+    name = "rule"
+    yield_rule = False
+
+    @abstractmethod
+    def fires(self, inputs):
+        """Boolean array, True for the positions this rule wants to stop."""
+
+    @abstractmethod
+    def explain(self, inputs, i):
+        """Why the rule fired for position i, for the decision's log line."""
+
+    @abstractmethod
+    def describe(self):
+        """One line summary of the rule and its settings."""
+
+
+class TargetRule(Rule):
+    name = "target"
+    yield_rule = True
+
+    def fires(self, inputs):
+        import numpy as np
+        with np.errstate(invalid='ignore'):
+            return inputs.yields > inputs.targets
+
+    def explain(self, inputs, i):
+        return "%.2f Gb sequenced, above the %.2f Gb target" % (inputs.yields[i] / 1e9, inputs.targets[i] / 1e9)
+
+    def describe(self):
+        return "target: stop once a position's yield is above its own target"
+
+
+class AggregateTargetRule(Rule):
+    name = "aggregate_target"
+    yield_rule = True
+
+    def __init__(self, gigabases):
+        self.gigabases = float(gigabases)
+
+    def fires(self, inputs):
+        import numpy as np
+        return np.full(len(inputs.names), inputs.yields.sum() >= self.gigabases * 1e9)
+
+    def explain(self, inputs, i):
+        return "%.2f Gb sequenced over %d positions, above the %.2f Gb aggregate target" % (
+            inputs.yields.sum() / 1e9, len(inputs.names), self.gigabases)
+
+    def describe(self):
+        return "aggregate_target: stop every position once their summed yield is %.2f Gb" % self.gigabases
+
+
+class PoreFloorRule(Rule):
+    """Changes what a yield rule does instead of firing on its own."""
+
+    name = "pore_floor"
+
+    def __init__(self, pores):
+        self.pores = float(pores)
+
+    def fires(self, inputs):
+        import numpy as np
+        return np.zeros(len(inputs.names), dtype=bool)
+
+    def explain(self, inputs, i):
+        return "%d single pores left, the floor is %d" % (inputs.pores[i], self.pores)
+
+    def describe(self):
+        return "pore_floor: positions with %d single pores or fewer that hit a yield rule sequence to exhaustion" % self.pores
+
+
+class RateDecayRule(Rule):
+    name = "rate_decay"
+
+    def __init__(self, fraction, min_hours=0):
+        self.fraction = float(fraction)
+        self.min_hours = float(min_hours)
+
+    def fires(self, inputs):
+        import numpy as np
+        with np.errstate(invalid='ignore'):
+            return ((inputs.runtimes >= self.min_hours * 3600) & (inputs.peak_rates > 0)
+                    & (inputs.rates < self.fraction * inputs.peak_rates))
+
+    def explain(self, inputs, i):
+        return "yield rate %.3f Gb/h is below %.0f%% of the %.3f Gb/h peak after %.1f h" % (
+            inputs.rates[i] * 3600 / 1e9, self.fraction * 100, inputs.peak_rates[i] * 3600 / 1e9, inputs.runtimes[i] / 3600)
+
+    def describe(self):
+        return "rate_decay: stop when the yield rate falls below %.0f%% of its peak, after %.1f h" % (self.fraction * 100, self.min_hours)
+
+
+class MaxRuntimeRule(Rule):
+    name = "max_runtime"
+
+    def __init__(self, hours):
+        self.hours = float(hours)
+
+    def fires(self, inputs):
+        return inputs.runtimes >= self.hours * 3600
+
+    def explain(self, inputs, i):
+        return "running for %.1f h, the limit is %.1f h" % (inputs.runtimes[i] / 3600, self.hours)
+
+    def describe(self):
+        return "max_runtime: stop runs after %.1f h" % self.hours
+
+
+RULE_TYPES = {
+    "target": TargetRule,
+    "aggregate_target": AggregateTargetRule,
+    "pore_floor": PoreFloorRule,
+    "rate_decay": RateDecayRule,
+    "max_runtime": MaxRuntimeRule,
+}
+
+
+class PolicyResult(NamedTuple):
+    inputs: PolicyInputs
+    # CONTINUE, EXHAUST or STOP per position
+    decisions: 'np.ndarray'
+    # index into the policy's rules of the rule that decided, -1 for CONTINUE
+    rules: 'np.ndarray'
+    policy: object
+
+    def fired(self):
+        """(name, STOPPED or TO_EXHAUSTION, log line) for every position that is not continuing."""
+        import numpy as np
+
+        for i in np.flatnonzero(self.decisions):
+            rule = self.policy.rules[self.rules[i]]
+            decision = DECISION_NAMES[self.decisions[i]]
+            line = "Stop policy: %s %s by %s rule, %s" % (
+                self.inputs.names[i], "stopped" if self.decisions[i] == STOP else "left to sequence to exhaustion",
+                rule.name, rule.explain(self.inputs, i))
+            if rule.yield_rule and self.policy.pore_floor is not None and not np.isnan(self.inputs.pores[i]):
+                line += ", %d single pores (floor %d)" % (self.inputs.pores[i], self.policy.pore_floor.pores)
+            yield self.inputs.names[i], decision, line
+
+
+class StopPolicy(object):
+    def __init__(self, rules):
+        self.rules = list(rules)
+        floors = [rule for rule in self.rules if isinstance(rule, PoreFloorRule)]
+        self.pore_floor = floors[-1] if floors else None
+        # per position state kept in arrays indexed by slot, made on the first evaluation
+        self._slots = {}
+        self._capacity = 0
+        self._first_seen = None
+        self._peak_rates = None
+        self._last_time = None
+        self._last_yield = None
+        self._rates = None
+
+    @classmethod
+    def default(cls, pore_threshold=1500):
+        """The classic run until rule: stop above target if more than pore_threshold pores are left."""
+        return cls([TargetRule(), PoreFloorRule(pore_threshold)])
+
+    def describe(self):
+        return "\n".join("    %s" % rule.describe() for rule in self.rules)
+
+    def _slot_indexes(self, names):
+        import numpy as np
+
+        def grown(values, fill):
+            added = np.full(capacity - self._capacity, fill)
+            return added if values is None else np.concatenate([values, added])
+
+        for name in names:
+            if name not in self._slots:
+                self._slots[name] = len(self._slots)
+        size = len(self._slots)
+        if size > self._capacity or self._first_seen is None:
+            capacity = max(size, 2 * self._capacity)
+            self._first_seen = grown(self._first_seen, np.nan)
+            self._peak_rates = grown(self._peak_rates, 0.0)
+            self._last_time = grown(self._last_time, np.nan)
+            self._last_yield = grown(self._last_yield, np.nan)
+            self._rates = grown(self._rates, np.nan)
+            self._capacity = capacity
+        return np.fromiter((self._slots[name] for name in names), dtype=np.intp, count=len(names))
+
+    def _estimate_rates(self, slots, sampled_at, yields):
+        import numpy as np
+        last_time = self._last_time[slots]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # a reading seen again in a later evaluation adds no new rate sample
+            sample = np.where(sampled_at > last_time, (yields - self._last_yield[slots]) / (sampled_at - last_time), np.nan)
+        # a yield that went backwards is a new acquisition on the position
+        restarted = sample < 0
+        sample[restarted] = np.nan
+        previous = self._rates[slots]
+        previous[restarted] = np.nan
+        rates = np.where(np.isnan(previous), sample, np.where(np.isnan(sample), previous,
+                         RATE_SMOOTHING * sample + (1 - RATE_SMOOTHING) * previous))
+        self._rates[slots] = rates
+        self._last_time[slots] = sampled_at
+        self._last_yield[slots] = yields
+        return rates
+
+    def evaluate(self, now, names, yields, targets=None, pores=None, rates=None, started_at=None, sampled_at=None):
+        """Decide for every position at once.
+
+        Args:
+            names: position names.
+            yields: bases per position.
+            targets: target bases per position, None for no target.
+            pores: single pores per position, None before the first mux scan.
+            rates: yield rate per position in bases per second, estimated from
+                successive calls where not given or None.
+            started_at: acquisition start time per position; where it is None
+                the first time the position was evaluated is used instead.
+            sampled_at: when each position's values were read, now where not
+                given. Lets the latest reading of positions that were not polled
+                this cycle be evaluated again, e.g. for an aggregate_target rule.
+
+        Returns:
+            PolicyResult.
+        """
+        import numpy as np
+
+        names = list(names)
+        n = len(names)
+        slots = self._slot_indexes(names)
+        yields = np.asarray(yields, dtype=float)
+
+        def column(values):
+            # None entries become nan
+            return np.full(n, np.nan) if values is None else np.asarray(values, dtype=float)
+
+        targets = column(targets)
+        pores = column(pores)
+        sampled_at = np.where(np.isnan(column(sampled_at)), now, column(sampled_at))
+        estimated = self._estimate_rates(slots, sampled_at, yields)
+        rates = estimated if rates is None else np.where(np.isnan(column(rates)), estimated, column(rates))
+        first_seen = self._first_seen[slots]
+        first_seen = np.where(np.isnan(first_seen), now, first_seen)
+        self._first_seen[slots] = first_seen
+        started_at = np.where(np.isnan(column(started_at)), first_seen, column(started_at))
+        peak_rates = np.fmax(self._peak_rates[slots], rates)
+        self._peak_rates[slots] = np.nan_to_num(peak_rates)
+        inputs = PolicyInputs(now, names, yields, targets, pores, rates, peak_rates, now - started_at)
+
+        decisions = np.zeros(n, dtype=np.int8)
+        rules = np.full(n, -1, dtype=np.intp)
+        for index, rule in enumerate(self.rules):
+            fired = rule.fires(inputs)
+            decision = np.where(fired, STOP, CONTINUE).astype(np.int8)
+            if rule.yield_rule and self.pore_floor is not None:
+                with np.errstate(invalid='ignore'):
+                    decision[fired & (pores <= self.pore_floor.pores)] = EXHAUST
+                # no mux scan yet, wait for the first pore count before deciding
+                decision[fired & np.isnan(pores)] = CONTINUE
+            stronger = decision > decisions
+            decisions[stronger] = decision[stronger]
+            rules[stronger] = index
+        return PolicyResult(inputs, decisions, rules, self)
+
+
+def build_policy(config):
+    """StopPolicy from a {"rules": [{"rule": name, ...arguments}]} dict."""
+    rules = []
+    for i, entry in enumerate(config.get("rules", [])):
+        entry = dict(entry)
+        kind = entry.pop("rule", None)
+        if kind not in RULE_TYPES:
+            raise ValueError("rule %d: unknown rule %r, expected one of %s" % (i + 1, kind, ", ".join(sorted(RULE_TYPES))))
+        try:
+            rules.append(RULE_TYPES[kind](**entry))
+        except TypeError as e:
+            raise ValueError("rule %d (%s): %s" % (i + 1, kind, e))
+    if not any(not isinstance(rule, PoreFloorRule) for rule in rules):
+        raise ValueError("stop policy has no rule that can stop a run")
+    return StopPolicy(rules)
+
+
+def load_policy(path):
+    with open(path, 'r') as f_in:
+        return build_policy(json.load(f_in))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a stop policy config and print its rules")
+    parser.add_argument("config", help="JSON stop policy")
+    args = parser.parse_args()
+    try:
+        policy = load_policy(args.config)
+    except (OSError, ValueError) as e:
+        parser.exit(1, "%s\n" % e)
+    print("Stop policy %s:" % args.config)
+    print(policy.describe())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Append-only log of per-position yield and pore counts.
+
+Every poll snapshot is written as one row per position (timestamp, position,
+acquisition status, estimated yield, single pore count) to a SQLite database
+indexed on (position, timestamp). Rows are handed to a background writer
+thread through a queue and inserted in batches, so the polling loop never
+waits on disk. A database that cannot be opened raises from the constructor,
+and once a write fails (e.g. a full disk) the error is printed and later rows
+are dropped rather than queued.
+
+Example usage might be:
+
+    telemetry = TelemetryLog("run_until.telemetry.sqlite")
+    telemetry.record_results(poll_positions(positions))
+    ...
+    telemetry.close()
+
+    python telemetry_log.py --db run_until.telemetry.sqlite --position 1A --start 2024-01-01T00:00:00
+"""
+
+import argparse
+import datetime
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS position_telemetry (
+    timestamp REAL NOT NULL,
+    position TEXT NOT NULL,
+    status INTEGER,
+    yield_bases INTEGER,
+    single_pores INTEGER
+);
+CREATE INDEX IF NOT EXISTS position_telemetry_position_time ON position_telemetry (position, timestamp);
+CREATE INDEX IF NOT EXISTS position_telemetry_time ON position_telemetry (timestamp);
+"""
+
+COLUMNS = ("timestamp", "position", "status", "yield_bases", "single_pores")
+
+
+def single_pores(acquisition_info):
+    """Single pore count from the last mux scan, or None before the first one."""
+    mux_scan_results = acquisition_info.bream_info.mux_scan_results
+    if len(mux_scan_results) == 0:
+        return None
+    return mux_scan_results[-1].counts['single_pore']
+
+
+class TelemetryLog(object):
+    def __init__(self, path, batch_size=500, flush_interval=5.0):
+        """
+        Args:
+            path: SQLite database file, created if it does not exist.
+            batch_size: rows written per transaction.
+            flush_interval: max seconds a row waits in the queue before being written.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        # set by the writer thread when it cannot open or write to the database
+        self._error = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._write_loop, name="telemetry-writer", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self._thread.join()
+            raise self._error
+
+    def record(self, timestamp, position, status, yield_bases, pores):
+        """Queue one row; returns immediately. Dropped once a write has failed."""
+        if self._closed:
+            raise ValueError("TelemetryLog is closed")
+        if self._error is not None:
+            return
+        self._queue.put((timestamp, position, status, yield_bases, pores))
+
+    def record_results(self, results, timestamp=None):
+        """Queue a row for every PositionStatus of a poll sweep."""
+        if timestamp is None:
+            timestamp = time.time()
+        for result in results:
+            yield_bases = None
+            pores = None
+            if result.acquisition_info is not None:
+                yield_bases = result.acquisition_info.yield_summary.estimated_selected_bases
+                pores = single_pores(result.acquisition_info)
+            self.record(timestamp, result.name, result.status, yield_bases, pores)
+
+    def close(self):
+        """Flush everything queued so far and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_loop(self):
+        try:
+            db = sqlite3.connect(self.path)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            db.commit()
+        except sqlite3.Error as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+
+        try:
+            self._write_batches(db)
+        except sqlite3.Error as e:
+            self._error = e
+            print("Telemetry writes to %s failed, no more rows will be logged: %s" % (self.path, e))
+            # rows queued before record() saw the error would otherwise stay in memory
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+        finally:
+            db.close()
+
+    def _write_batches(self, db):
+        done = False
+        while not done:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self._queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if row is None:
+                    done = True
+                    break
+                batch.append(row)
+            if batch:
+                db.executemany("INSERT INTO position_telemetry VALUES (?, ?, ?, ?, ?)", batch)
+                db.commit()
+                self.rows_written += len(batch)
+
+
+def query(path, position=None, start=None, end=None):
+    """Read rows for a position (or all positions) between two timestamps.
+
+    Returns:
+        List of (timestamp, position, status, yield_bases, single_pores) tuples ordered by time.
+    """
+    clauses = []
+    params = []
+    if position is not None:
+        clauses.append("position = ?")
+        params.append(position)
+    if start is not None:
+        clauses.append("timestamp >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("timestamp < ?")
+        params.append(end)
+    sql = "SELECT %s FROM position_telemetry" % ", ".join(COLUMNS)
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY timestamp, position"
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print logged per-position yield and pore counts as a tsv.")
+    parser.add_argument("--db", required=True, help="telemetry database written by the run until scripts")
+    parser.add_argument("--position", default=None, help="only print rows for this flowcell position")
+    parser.add_argument("--start", default=None, help="earliest timestamp (unix seconds or ISO date)")
+    parser.add_argument("--end", default=None, help="latest timestamp (unix seconds or ISO date)")
+    args = parser.parse_args()
+
+    print("\t".join(COLUMNS))
+    for row in query(args.db, args.position, parse_time(args.start), parse_time(args.end)):
+        print("\t".join("" if x is None else str(x) for x in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import random
+import threading
+from collections import defaultdict
+from types import SimpleNamespace
+
+import run_until
+from acquisition_watcher import AcquisitionWatcher
+from connection_cache import PositionConnectionCache
+from fake_minknow import FakeManager, SimClock, SyntheticRun, ACQUISITION_COMPLETED
+from run_until_scheduler import default_policy
+
+# simulated seconds between two streamed updates
+UPDATE_SECONDS = 60
+
+
+def stepping_stream(position, clock):
+    """Every streamed update is UPDATE_SECONDS of simulated time after the last, while streaming runs in real milliseconds."""
+    read = position._acquisition_info
+
+    def acquisition_info():
+        clock.sleep(UPDATE_SECONDS)
+        return read()
+    position._acquisition_info = acquisition_info
+    position.stream_interval = 0.001
+
+
+def test_watch_until_stops_each_run_within_an_update_of_its_target():
+    # one manager and clock per position, so each stream's updates step its own simulated time
+    rng = random.Random(1)
+    positions = []
+    for i, name in enumerate(["1A", "1B", "1C", "1D"]):
+        clock = SimClock()
+        pos = FakeManager(clock).add_position(SyntheticRun.random(rng), clock.time(), name)
+        stepping_stream(pos, clock)
+        positions.append(pos)
+    fleet = SimpleNamespace(flow_cell_positions=lambda: list(positions))
+    # crossed two to three hours in, while plenty of pores are left
+    target_yields = dict((pos.name, pos.run.yield_at((2 + i * 0.25) * 3600)) for i, pos in enumerate(positions))
+    args = SimpleNamespace(resume=False, checkpoint=None, max_concurrency=4, discovery_interval=600)
+
+    finished = threading.Event()
+
+    def watch():
+        run_until.watch_until(fleet, args, target_yields, None, PositionConnectionCache(), default_policy())
+        finished.set()
+    threading.Thread(target=watch, daemon=True).start()
+    assert finished.wait(30)
+
+    for pos in positions:
+        assert pos.stopped_at is not None
+        crossed_at = pos.started_at + pos.run.time_to_yield(target_yields[pos.name])
+        # one update for MinKNOW's yield summary to catch up, one for the stream to deliver it
+        assert 0 <= pos.stopped_at - crossed_at <= 2 * UPDATE_SECONDS + 1
+        counts = pos.manager.rpc_counts()
+        assert counts["acquisition.watch_current_acquisition_run"] == 1
+        # the stop is decided from the stream, the position is polled only to discover it
+        assert counts.get("acquisition.get_acquisition_info", 0) <= 1
+
+
+def test_finished_acquisition_ends_the_stream():
+    clock = SimClock()
+    manager = FakeManager.with_positions(1, clock, start_spread=0)
+    pos = manager.positions[0]
+    stepping_stream(pos, clock)
+    states = []
+
+    def on_update(pos, connection, acquisition_info):
+        states.append(acquisition_info.state)
+        if len(states) == 3:
+            # stopped from elsewhere, e.g. the MinKNOW UI
+            pos.stop()
+        # 2 and 3 are enum codes for ACQUISITION_FINISHING and ACQUISITION_COMPLETED
+        return acquisition_info.state in (2, 3)
+
+    watcher = AcquisitionWatcher(on_update)
+    watcher.watch(pos)
+    watcher.wait(10)
+    assert not watcher.watching(pos.name)
+    assert states[-1] == ACQUISITION_COMPLETED and len(states) == 4
+
+
+def test_cancel_all_closes_a_stream_still_being_opened():
+    clock = SimClock()
+    manager = FakeManager.with_positions(1, clock, start_spread=0)
+    pos = manager.positions[0]
+    pos.stream_interval = 0.001
+    opening = threading.Event()
+    release = threading.Event()
+    connect = pos.connect
+
+    def slow_connect():
+        connection = connect()
+        watch_run = connection.acquisition.watch_current_acquisition_run
+
+        def watch_current_acquisition_run():
+            opening.set()
+            release.wait(10)
+            return watch_run()
+        connection.acquisition.watch_current_acquisition_run = watch_current_acquisition_run
+        return connection
+    pos.connect = slow_connect
+
+    updates = defaultdict(int)
+
+    def on_update(pos, connection, acquisition_info):
+        updates[pos.name] += 1
+        return False
+
+    watcher = AcquisitionWatcher(on_update)
+    watcher.watch(pos)
+    assert opening.wait(10)
+    watcher.cancel_all()
+    release.set()
+    watcher.wait(10)
+    assert not watcher.watching(pos.name)
+    assert updates[pos.name] == 0
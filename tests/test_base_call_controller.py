@@ -0,0 +1,24 @@
+from collections import defaultdict
+
+from base_call_controller import initialize_fast5_dir
+from job_ledger import JobLedger, FAILED
+
+
+def test_failed_guppy_jobs_are_retried_up_to_max_attempts(tmp_path):
+    sample_dir = str(tmp_path / "sample")
+    (tmp_path / "sample" / "fastq" / "tmp").mkdir(parents=True)
+    ledger = JobLedger(str(tmp_path / "ledger.sqlite"))
+    for job_number, attempts in enumerate((1, 3)):
+        save_dir = sample_dir + "/fastq/guppy_job_%d" % job_number
+        ledger.add(save_dir, sample_dir + "/fastq/tmp/fast5_list_%d.txt" % job_number, save_dir, parent=sample_dir)
+        for i in range(attempts):
+            ledger.start(save_dir)
+            ledger.finish(save_dir, 1)
+    ledger.add(sample_dir + "/fastq/guppy_job_2", sample_dir + "/fastq/tmp/fast5_list_2.txt",
+               sample_dir + "/fastq/guppy_job_2", parent=sample_dir)
+
+    job_number_dict = defaultdict(int)
+    job_list = initialize_fast5_dir([sample_dir], job_number_dict, ledger, max_attempts=3)
+    assert sorted(job_id for job_id, command in job_list) == [sample_dir + "/fastq/guppy_job_0", sample_dir + "/fastq/guppy_job_2"]
+    assert ledger.get(sample_dir + "/fastq/guppy_job_1").state == FAILED
+    assert job_number_dict[sample_dir] == 3
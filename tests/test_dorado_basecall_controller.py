@@ -0,0 +1,71 @@
+import sys
+import threading
+from collections import defaultdict
+
+from dorado_basecall_controller import BasecallJob, run_job
+from gpu_scheduler import DeviceLeaseScheduler, run_jobs
+from job_ledger import JobLedger, DONE, FAILED, CHECKPOINTED
+from job_runner import NOT_STARTED_EXIT_STATUS
+
+# stands in for dorado: logs the device it was given, holds it briefly, then exits with the status asked for
+STUB_DORADO = "import sys, time; print('device', sys.argv[1], file=sys.stderr); time.sleep(0.2); sys.exit(int(sys.argv[2]))"
+
+
+def stub_job(tmp_path, ledger, name, exit_status):
+    output_path = str(tmp_path / (name + ".bam"))
+    ledger.add(name, str(tmp_path / name), output_path)
+    command = [sys.executable, "-c", STUB_DORADO, "{device}", str(exit_status)]
+    return BasecallJob(job_id=name, command=command, output_path=output_path, size_bytes=0)
+
+
+def test_run_jobs_leases_devices_to_stub_dorado_jobs(tmp_path):
+    ledger = JobLedger(str(tmp_path / "ledger.sqlite"))
+    # the failing jobs go first, so the rest only get a device if a failed job gives its lease back
+    jobs = [stub_job(tmp_path, ledger, "fail%d" % i, 3) for i in range(4)]
+    jobs += [stub_job(tmp_path, ledger, "ok%d" % i, 0) for i in range(6)]
+    scheduler = DeviceLeaseScheduler(["cuda:0", "cuda:1"], jobs_per_device=2)
+
+    lock = threading.Lock()
+    running = defaultdict(int)
+    most_running = defaultdict(int)
+
+    def run_fn(job, device):
+        with lock:
+            running[device] += 1
+            most_running[device] = max(most_running[device], running[device])
+        try:
+            return run_job(job, device, ledger, wall_timeout=30, stall_timeout=None)
+        finally:
+            with lock:
+                running[device] -= 1
+
+    results = []
+    runner = threading.Thread(target=lambda: results.extend(run_jobs(jobs, scheduler, run_fn)), daemon=True)
+    runner.start()
+    runner.join(60)
+    assert not runner.is_alive(), "jobs waiting on a lease a failed job never released"
+
+    assert sorted(job.job_id for job, device, result, seconds in results) == sorted(job.job_id for job in jobs)
+    for job, device, result, seconds in results:
+        with open(job.output_path + ".log") as log:
+            assert "device %s" % device in log.read()
+        assert result.exit_status == (3 if job.job_id.startswith("fail") else 0)
+        assert ledger.get(job.job_id).state in ((FAILED, CHECKPOINTED) if job.job_id.startswith("fail") else (DONE,))
+    assert set(most_running) == {"cuda:0", "cuda:1"}
+    assert max(most_running.values()) <= scheduler.jobs_per_device
+    # every lease was released, so all the slots can be taken again at once
+    assert [scheduler.acquire() for i in range(scheduler.slots)].count("cuda:0") == scheduler.jobs_per_device
+
+
+def test_a_missing_basecaller_fails_only_its_own_job(tmp_path):
+    ledger = JobLedger(str(tmp_path / "ledger.sqlite"))
+    missing = stub_job(tmp_path, ledger, "missing", 0)._replace(command=[str(tmp_path / "no-dorado"), "{device}"])
+    jobs = [missing] + [stub_job(tmp_path, ledger, "ok%d" % i, 0) for i in range(2)]
+    scheduler = DeviceLeaseScheduler(["cuda:0"], jobs_per_device=1)
+
+    results = run_jobs(jobs, scheduler, lambda job, device: run_job(job, device, ledger, wall_timeout=30, stall_timeout=None))
+    exit_statuses = dict((job.job_id, result.exit_status) for job, device, result, seconds in results)
+    assert exit_statuses == {"missing": NOT_STARTED_EXIT_STATUS, "ok0": 0, "ok1": 0}
+    assert ledger.get("missing").state == FAILED
+    with open(missing.output_path + ".log") as log:
+        assert "could not start" in log.read()
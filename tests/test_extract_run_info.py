@@ -0,0 +1,53 @@
+import io
+import json
+
+import pytest
+
+from extract_run_info import run_info_from_document, run_info_from_stream
+
+
+def histogram(n50, read_length_type=None, bucket_value_type=None):
+    h = {'plot': {'histogram_data': [{'n50': n50}]}}
+    if read_length_type is not None:
+        h['read_length_type'] = read_length_type
+    if bucket_value_type is not None:
+        h['bucket_value_type'] = bucket_value_type
+    return h
+
+
+def report(histograms):
+    return {
+        'protocol_run_info': {'user_info': {'sample_id': 'S1'}, 'device': {'device_id': '1A'},
+                              'flow_cell': {'flow_cell_id': 'PAK12345'}},
+        'acquisitions': [{
+            'acquisition_run_info': {'yield_summary': {'estimated_selected_bases': 100e9},
+                                     'bream_info': {'mux_scan_results': [{'counts': {'single_pore': 5000}}]}},
+            'read_length_histogram': histograms,
+        }],
+    }
+
+
+# the read count histogram listed after the read length one of the same type
+LABELLED = [
+    histogram(4000, 'MinknowEvents', 'ReadLengths'),
+    histogram(3000, 'MinknowEvents', 'ReadCounts'),
+    histogram(21000, 'EstimatedBases', 'ReadLengths'),
+    histogram(9000, 'EstimatedBases', 'ReadCounts'),
+]
+
+
+def test_n50_is_taken_from_the_read_length_histogram_whatever_its_position():
+    assert run_info_from_document(report(LABELLED)).n50() == 21000
+    assert run_info_from_document(report(LABELLED)).n50("MinknowEvents") == 4000
+
+
+def test_unlabelled_reports_fall_back_to_the_histogram_position():
+    assert run_info_from_document(report([histogram(n50) for n50 in (1, 2, 3, 21000, 5)])).n50() == 21000
+    with pytest.raises(KeyError):
+        run_info_from_document(report([histogram(n50, 'EstimatedBases') for n50 in (1, 2, 3, 21000, 5)])).n50()
+
+
+def test_streamed_reports_choose_the_same_histogram():
+    pytest.importorskip("ijson")
+    f_in = io.BytesIO(json.dumps(report(LABELLED)).encode())
+    assert run_info_from_stream(f_in).n50() == 21000
@@ -0,0 +1,37 @@
+import os
+import time
+
+import fast5_watcher
+from fast5_watcher import Fast5Watcher
+
+
+class NoEvents(object):
+    """inotify stand in for a directory whose files were all closed before the watch started."""
+
+    def read(self, timeout=0):
+        return []
+
+
+def test_files_closed_just_before_the_watch_are_reported(tmp_path, monkeypatch):
+    fast5_dir = tmp_path / "fast5"
+    fast5_dir.mkdir()
+    old = fast5_dir / "old.pod5"
+    recent = fast5_dir / "recent.pod5"
+    old.write_bytes(b"x")
+    recent.write_bytes(b"x")
+    now = time.time()
+    os.utime(old, (now - 120, now - 120))
+    os.utime(recent, (now - 10, now - 10))
+
+    clock = [now]
+    monkeypatch.setattr(fast5_watcher.time, "time", lambda: clock[0])
+    watcher = Fast5Watcher({str(fast5_dir): str(tmp_path / "dispatched.txt")}, settle_seconds=60, use_inotify=False)
+    watcher._inotify = NoEvents()
+
+    assert watcher.poll() == {str(fast5_dir): ["old.pod5"]}
+    clock[0] = now + 30
+    assert watcher.poll() == {}
+    # recent.pod5 never produces a close event, the scan after the settle window finds it
+    clock[0] = now + 61
+    assert watcher.poll() == {str(fast5_dir): ["recent.pod5"]}
+    assert watcher._rescan_until is None
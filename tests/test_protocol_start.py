@@ -0,0 +1,34 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from protocol_start import ProtocolResolver, run_per_position
+
+
+def test_only_identical_protocol_lookups_wait_on_each_other(monkeypatch):
+    protocols = pytest.importorskip("minknow_api.tools.protocols")
+    lock = threading.Lock()
+    searches = []
+    active = [0]
+    most_active = [0]
+
+    def find_protocol(position_connection, product_code, kit, basecalling):
+        with lock:
+            searches.append(kit)
+            active[0] += 1
+            most_active[0] = max(most_active[0], active[0])
+        time.sleep(0.2)
+        with lock:
+            active[0] -= 1
+        return SimpleNamespace(identifier="sequencing/%s:%s" % (product_code, kit))
+    monkeypatch.setattr(protocols, "find_protocol", find_protocol)
+
+    resolver = ProtocolResolver()
+    kits = ["SQK-LSK114", "SQK-LSK110", "SQK-LSK109"] * 4
+    results = run_per_position(kits, lambda kit: resolver.resolve(None, "FLO-PRO114M", kit, False), max_concurrency=12)
+    assert [identifier for kit, identifier, seconds in results] == ["sequencing/FLO-PRO114M:%s" % kit for kit in kits]
+    assert sorted(searches) == sorted(set(kits))
+    assert most_active[0] == 3
+    assert (resolver.hits, resolver.misses) == (9, 3)
@@ -0,0 +1,49 @@
+import threading
+import time
+
+import run_until_rapid
+from benchmark import patched
+from connection_cache import PositionConnectionCache
+from fake_minknow import FakeManager, SimClock
+from stop_policy import StopPolicy, AggregateTargetRule
+
+
+def test_stops_every_position_once_the_total_is_reached():
+    clock = SimClock()
+    manager = FakeManager.with_positions(12, clock, seed=0)
+    target_yield = sum(pos.run.max_yield for pos in manager.positions) * 0.6
+    with patched(run_until_rapid, time=clock):
+        run_until_rapid.run_until_rapid(manager, StopPolicy([AggregateTargetRule(target_yield / 1e9)]), target_yield,
+                                        PositionConnectionCache())
+    assert all(pos.stopped_at is not None for pos in manager.positions)
+    total = sum(pos.yield_at(pos.stopped_at) for pos in manager.positions)
+    # stopped on the first check after the total crossed, min_interval (20 s) apart near the target
+    assert target_yield <= total < target_yield * 1.01
+
+
+def test_watch_finds_and_stops_runs_started_after_the_first_sweep():
+    clock = SimClock()
+    manager = FakeManager.with_positions(3, clock, started=False)
+    for pos in manager.positions:
+        pos.stream_interval = 0.01
+    # each run crosses two hours' yield of its own, so only the runs started later can reach the total
+    target_yield = sum(pos.run.yield_at(2 * 3600) for pos in manager.positions)
+    finished = threading.Event()
+
+    def watch():
+        run_until_rapid.run_until_rapid(manager, StopPolicy([AggregateTargetRule(target_yield / 1e9)]), target_yield,
+                                        PositionConnectionCache(), min_interval=0.01, watch=True, discovery_interval=0.05)
+        finished.set()
+    threading.Thread(target=watch, daemon=True).start()
+    # a few sweeps that find nothing sequencing
+    time.sleep(0.3)
+    assert manager.rpc_counts()["manager.flow_cell_positions"] > 1
+
+    for pos in manager.positions:
+        pos.start("sequencing")
+    deadline = time.time() + 20
+    while not finished.is_set() and time.time() < deadline:
+        clock.sleep(60)
+        time.sleep(0.005)
+    assert finished.is_set()
+    assert all(pos.stopped_at is not None for pos in manager.positions)
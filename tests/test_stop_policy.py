@@ -0,0 +1,78 @@
+from collections import defaultdict
+
+import run_until_scheduler
+from benchmark import patched
+from connection_cache import PositionConnectionCache
+from fake_minknow import FakeManager, SimClock
+from run_until_scheduler import LatestReadings, check_position, run_until
+from stop_policy import STOP, CONTINUE, build_policy, StopPolicy, AggregateTargetRule, PoreFloorRule
+
+
+def test_rules_explain_every_decision():
+    policy = build_policy({"rules": [
+        {"rule": "target"},
+        {"rule": "pore_floor", "pores": 1500},
+        {"rule": "max_runtime", "hours": 10},
+    ]})
+    result = policy.evaluate(0, ["1A", "1B", "1C", "1D"], [150e9, 150e9, 150e9, 10e9], [140e9] * 4,
+                             [2000, 1000, None, 2000], started_at=[None, None, None, -11 * 3600])
+    fired = dict((name, (decision, line)) for name, decision, line in result.fired())
+    assert fired["1A"][0] == "stopped" and "target rule" in fired["1A"][1]
+    assert fired["1B"][0] == "to_exhaustion" and "1000 single pores" in fired["1B"][1]
+    # no mux scan yet, the yield rules wait for the first pore count
+    assert "1C" not in fired
+    assert fired["1D"][0] == "stopped" and "max_runtime rule" in fired["1D"][1]
+    for rule in policy.rules:
+        assert rule.describe()
+        assert rule.explain(result.inputs, 0)
+
+
+def test_aggregate_target_sums_every_position():
+    policy = StopPolicy([AggregateTargetRule(100), PoreFloorRule(1500)])
+    result = policy.evaluate(0, ["1A", "1B"], [60e9, 50e9], pores=[2000, 2000])
+    assert list(result.decisions) == [STOP, STOP]
+    result = policy.evaluate(0, ["1A", "1B"], [40e9, 50e9], pores=[2000, 2000])
+    assert list(result.decisions) == [CONTINUE, CONTINUE]
+
+
+def test_run_until_aggregate_target_sees_positions_not_due():
+    clock = SimClock()
+    manager = FakeManager.with_positions(12, clock, seed=0)
+    target = 277.6e9
+    policy = build_policy({"rules": [{"rule": "aggregate_target", "gigabases": target / 1e9}]})
+    with patched(run_until_scheduler, time=clock):
+        run_until(manager, defaultdict(lambda: float("inf")), 4, PositionConnectionCache(),
+                  wait_for_start=True, policy=policy)
+    assert all(pos.stopped_at is not None for pos in manager.positions)
+    stopped_at = max(pos.stopped_at for pos in manager.positions)
+    assert clock.time() - manager.positions[0].started_at < 300 * 3600
+    # every run is stopped shortly after the fleet crosses the target, not long after
+    total = sum(pos.yield_at(stopped_at) for pos in manager.positions)
+    assert target <= total < target * 1.05
+
+
+def test_watch_check_position_sees_the_whole_fleet():
+    clock = SimClock()
+    manager = FakeManager.with_positions(2, clock, seed=0, start_spread=0)
+    clock.sleep(3600)
+    first, second = manager.positions
+    first_yield = first._acquisition_info().yield_summary.estimated_selected_bases
+    second_yield = second._acquisition_info().yield_summary.estimated_selected_bases
+    # above either position's yield, below their sum
+    policy = StopPolicy([AggregateTargetRule((max(first_yield, second_yield) + first_yield + second_yield) / 2e9)])
+    readings = LatestReadings()
+    finished = set()
+
+    def update(pos):
+        with patched(run_until_scheduler, time=clock):
+            check_position(pos.name, pos.connect(), pos._acquisition_info(), readings, defaultdict(float), finished, policy)
+
+    update(first)
+    assert finished == set()
+    update(second)
+    # each update only acts on its own position, the first is stopped on its next update
+    assert finished == set([second.name])
+    assert first.stopped_at is None and second.stopped_at is not None
+    update(first)
+    assert finished == set([first.name, second.name])
+    assert first.stopped_at is not None
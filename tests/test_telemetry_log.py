@@ -0,0 +1,39 @@
+import sqlite3
+import threading
+
+import pytest
+
+from telemetry_log import TelemetryLog, query
+
+
+def test_a_database_that_cannot_be_opened_raises_instead_of_hanging(tmp_path):
+    raised = []
+
+    def open_log():
+        with pytest.raises(sqlite3.Error) as e:
+            TelemetryLog(str(tmp_path / "missing" / "telemetry.sqlite"))
+        raised.append(e.value)
+    opener = threading.Thread(target=open_log, daemon=True)
+    opener.start()
+    opener.join(10)
+    assert raised
+
+
+def test_rows_are_dropped_once_a_write_fails(tmp_path):
+    path = str(tmp_path / "telemetry.sqlite")
+    telemetry = TelemetryLog(path, flush_interval=0.01)
+    telemetry.record(1.0, "1A", 3, 100, 5000)
+    telemetry.close()
+    assert query(path) == [(1.0, "1A", 3, 100, 5000)]
+
+    telemetry = TelemetryLog(path, flush_interval=0.01)
+    db = sqlite3.connect(path)
+    db.execute("DROP TABLE position_telemetry")
+    db.commit()
+    db.close()
+    telemetry.record(2.0, "1A", 3, 200, 4900)
+    telemetry._thread.join(10)
+    assert not telemetry._thread.is_alive()
+    telemetry.record(3.0, "1A", 3, 300, 4800)
+    assert telemetry._queue.empty()
+    telemetry.close()
@@ -0,0 +1,17 @@
+import numpy as np
+
+from timeseries_buffer import TimeSeriesBuffer
+
+
+def test_history_has_no_gap_where_the_tiers_meet():
+    buffer = TimeSeriesBuffer(capacity=16, bucket_size=4, tiers=3)
+    # enough samples to fill every tier, leaving three rows in the bucket between the coarser two
+    for t in range(300):
+        buffer.append(float(t), 10.0 * t)
+    times, values = buffer.history()
+    gaps = np.diff(times)
+    assert (gaps > 0).all()
+    # one entry of the coarsest tier covers bucket_size ** 2 samples
+    assert gaps.max() <= 4 ** 2
+    assert times[-1] == buffer.last_time
+    np.testing.assert_allclose(values, 10.0 * times)
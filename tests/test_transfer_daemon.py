@@ -0,0 +1,94 @@
+import os
+import shutil
+import stat
+import sys
+import time
+
+from checksum import file_digest
+from transfer_daemon import QuiescenceTracker, TransferManifest, plan_batches, transfer_ready
+
+# stands in for rsync where it is not installed: copies the --files-from list, honouring --remove-source-files
+STUB_RSYNC = '''import os, shutil, sys
+args = [arg for arg in sys.argv[1:] if not arg.startswith("-")]
+options = [arg for arg in sys.argv[1:] if arg.startswith("-")]
+files_from = [arg for arg in options if arg.startswith("--files-from=")][0][len("--files-from="):]
+source, dest = args
+with open(files_from) as f_in:
+    relpaths = [relpath for relpath in f_in.read().split("\\0") if relpath]
+for relpath in relpaths:
+    target = os.path.join(dest, relpath)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(os.path.join(source, relpath), target)
+    if "--remove-source-files" in options:
+        os.remove(os.path.join(source, relpath))
+'''
+
+
+def rsync_command(tmp_path):
+    if shutil.which("rsync"):
+        return "rsync"
+    stub = tmp_path / "rsync"
+    stub.write_text("#!%s\n%s" % (sys.executable, STUB_RSYNC))
+    stub.chmod(stub.stat().st_mode | stat.S_IXUSR)
+    return str(stub)
+
+
+def write(path, size, mtime):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(os.urandom(size))
+    os.utime(path, (mtime, mtime))
+
+
+def test_files_are_ready_once_they_stop_changing(tmp_path):
+    now = time.time()
+    write(tmp_path / "old.pod5", 10, now - 700)
+    write(tmp_path / "run" / "writing.pod5", 10, now - 5)
+    tracker = QuiescenceTracker(str(tmp_path), settle_seconds=600)
+    assert [relpath for relpath, size, mtime in tracker.scan(now)] == ["old.pod5"]
+
+    # a file that changes is timed from when the change was seen, even with an old mtime
+    write(tmp_path / "old.pod5", 20, now - 650)
+    assert tracker.scan(now + 60) == []
+    # the untouched file settles 600 s after its mtime, the changed one 600 s after the change was seen
+    assert [relpath for relpath, size, mtime in tracker.scan(now + 600)] == [os.path.join("run", "writing.pod5")]
+    assert sorted(relpath for relpath, size, mtime in tracker.scan(now + 660)) == ["old.pod5", os.path.join("run", "writing.pod5")]
+
+
+def test_batches_are_size_balanced_and_cover_every_file():
+    files = [("f%d" % i, size, 0.0) for i, size in enumerate([90, 80, 40, 30, 20, 10, 10, 10, 5, 5])]
+    batches = plan_batches(files, workers=4, batch_bytes=1000)
+    assert len(batches) == 4
+    assert sorted(f for batch in batches for f in batch) == sorted(files)
+    sizes = [sum(size for relpath, size, mtime in batch) for batch in batches]
+    assert max(sizes) - min(sizes) <= 90
+    # batch_bytes caps a batch below the per worker share
+    assert len(plan_batches(files, workers=2, batch_bytes=50)) == 6
+    assert plan_batches([], workers=4, batch_bytes=1000) == []
+
+
+def test_settled_files_are_moved_to_a_local_destination(tmp_path):
+    source = tmp_path / "source"
+    dest = tmp_path / "dest"
+    now = time.time()
+    for i in range(6):
+        write(source / "pod5" / ("%d.pod5" % i), 1000 * (i + 1), now - 3600)
+    write(source / "pod5" / "open.pod5", 500, now)
+    digests = dict((path.name, file_digest(str(path))) for path in (source / "pod5").iterdir())
+
+    for verify in (False, True):
+        manifest = TransferManifest(str(tmp_path / ("manifest.%s.tsv" % verify)))
+        ready = QuiescenceTracker(str(source), settle_seconds=600).scan(now)
+        assert len(ready) == 6
+        results = transfer_ready(str(source), str(dest), ready, manifest, workers=3, rsync=rsync_command(tmp_path),
+                                 remove_source_files=True, verify=verify)
+        assert all(result.exit_status == 0 and not result.mismatched for result in results)
+        # only the file still being written is left
+        assert os.listdir(str(source / "pod5")) == ["open.pod5"]
+        assert sorted(manifest.entries) == sorted(relpath for relpath, size, mtime in ready)
+        for name in digests:
+            if name != "open.pod5":
+                assert file_digest(str(dest / "pod5" / name)) == digests[name]
+                assert os.path.getmtime(str(dest / "pod5" / name)) == now - 3600
+        # put the sources back for the verified run
+        for relpath, size, mtime in ready:
+            shutil.copy2(str(dest / relpath), str(source / relpath))
@@ -0,0 +1,155 @@
+"""
+Bounded, array backed yield time series with automatic downsampling.
+
+A TimeSeriesBuffer keeps its samples in a fixed number of tiers. Tier 0 holds
+the most recent raw samples; when a tier is full its oldest entries are
+folded, bucket_size at a time, into one (time, min, max, mean) entry of the
+next tier. Memory use is fixed when the buffer is created, and every append
+is O(number of tiers) no matter how long the run has been going.
+
+Each tier is a ring buffer stored twice over in a 2 * capacity array, so the
+live window is always one contiguous slice and view() can hand out a NumPy
+view without copying.
+
+Example usage might be:
+
+    store = TimeSeriesStore()
+    store.append("total", seq_time, total_yield)
+    times, values = store["total"].history()
+    plt.plot(times / 60, values / 1e9)
+"""
+
+import numpy as np
+
+# columns of a tier row
+TIME, MIN, MAX, MEAN = range(4)
+
+
+class _Tier(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros((2 * capacity, 4))
+        self.start = 0
+        self.size = 0
+
+    def push(self, row):
+        """Append a row, returning the evicted oldest row when the tier was full."""
+        evicted = None
+        if self.size == self.capacity:
+            evicted = self.data[self.start].copy()
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+        i = (self.start + self.size) % self.capacity
+        self.data[i] = row
+        self.data[i + self.capacity] = row
+        self.size += 1
+        return evicted
+
+    def view(self):
+        return self.data[self.start:self.start + self.size]
+
+
+class _Bucket(object):
+    """Running min/max/mean of the rows folded into one downsampled entry."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.time_sum = 0.0
+        self.value_sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, row):
+        # every row folded into a bucket of a given tier covers the same number of samples
+        self.count += 1
+        self.time_sum += row[TIME]
+        self.value_sum += row[MEAN]
+        self.min = min(self.min, row[MIN])
+        self.max = max(self.max, row[MAX])
+
+    def row(self):
+        return (self.time_sum / self.count, self.min, self.max, self.value_sum / self.count)
+
+
+class TimeSeriesBuffer(object):
+    def __init__(self, capacity=512, bucket_size=8, tiers=4):
+        """
+        Args:
+            capacity: entries kept per tier.
+            bucket_size: entries of a tier folded into one entry of the next.
+            tiers: number of tiers; entries evicted from the last tier are dropped.
+        """
+        self.bucket_size = bucket_size
+        self._tiers = [_Tier(capacity) for _ in range(tiers)]
+        self._buckets = [_Bucket() for _ in range(tiers - 1)]
+        self.last_time = None
+        self.last_value = None
+
+    def __len__(self):
+        return sum(tier.size for tier in self._tiers)
+
+    def append(self, t, value):
+        self.last_time = t
+        self.last_value = value
+        row = (t, value, value, value)
+        for level, tier in enumerate(self._tiers):
+            evicted = tier.push(row)
+            if evicted is None or level == len(self._buckets):
+                return
+            bucket = self._buckets[level]
+            bucket.add(evicted)
+            if bucket.count < self.bucket_size:
+                return
+            row = bucket.row()
+            bucket.clear()
+
+    def view(self, tier=0):
+        """Zero-copy (n, 4) array of (time, min, max, mean) rows of one tier, oldest first."""
+        return self._tiers[tier].view()
+
+    def history(self, column=MEAN):
+        """Whole series, oldest first, as (times, values) arrays.
+
+        Coarse tiers come before fine ones, each followed by the partly
+        filled bucket of rows evicted from the next finer tier, so there is
+        no gap where the tiers meet. The result is bounded by
+        tiers * (capacity + 1) rows whatever the length of the run.
+        """
+        views = []
+        for level in reversed(range(len(self._tiers))):
+            # rows evicted from this tier but not yet folded into the next are only in its bucket
+            if level < len(self._buckets) and self._buckets[level].count:
+                views.append(np.array([self._buckets[level].row()]))
+            if self._tiers[level].size:
+                views.append(self._tiers[level].view())
+        if not views:
+            return np.empty(0), np.empty(0)
+        if len(views) == 1:
+            return views[0][:, TIME], views[0][:, column]
+        rows = np.concatenate(views)
+        return rows[:, TIME], rows[:, column]
+
+
+class TimeSeriesStore(object):
+    """A TimeSeriesBuffer per key, e.g. one per position plus one for the total."""
+
+    def __init__(self, **buffer_args):
+        self._buffer_args = buffer_args
+        self._series = {}
+
+    def __getitem__(self, key):
+        if key not in self._series:
+            self._series[key] = TimeSeriesBuffer(**self._buffer_args)
+        return self._series[key]
+
+    def __contains__(self, key):
+        return key in self._series
+
+    def keys(self):
+        return self._series.keys()
+
+    def append(self, key, t, value):
+        self[key].append(t, value)
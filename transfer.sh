@@ -2,11 +2,9 @@ source_dir="/data/RUSHAD_P12"
 #dest_dir="$scg:/oak/stanford/groups/smontgom/tannerj/RUSH_AD/promethion_data"
 dest_dir="$scg:/oak/stanford/groups/smontgom/tannerj/RUSH_AD/promethion_data/RUSHAD_P12"
 
-# find every files that hasn't been modified in past 30 min (ensures files are quiescent)
-# transfers them to destination and deletes them on source
-find $source_dir -cmin +30 -printf %P\\0 \
-    | rsync -rlvtW --files-from=- --from0 --remove-source-files $source_dir $dest_dir
+# moves every file that hasn't been modified in past 30 min (ensures files are quiescent)
+# to destination with 4 parallel rsyncs and deletes them on source once their sha256 matches the copy.
+# drop --once to keep running and move files as soon as each one settles
+python "$(dirname "$0")/transfer_daemon.py" --source $source_dir --dest $dest_dir --settle_seconds 1800 --workers 4 --once
 
 #rsync -rlvtW $source_dir $dest_dir
-
-
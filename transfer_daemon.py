@@ -0,0 +1,332 @@
+"""
+Move finished sequencing data off the sequencer with several rsync streams.
+
+Every scan_interval seconds the source tree is scanned and each file's size
+and mtime are compared with the previous scan. A file is ready to move once
+it has gone settle_seconds without changing, so a finished pod5 can leave
+within minutes instead of waiting for a blanket 30 minutes after the last
+write anywhere. Ready files are split into size-balanced batches, the
+batches are copied by parallel rsync workers, and every file moved is
+appended to a manifest. A restarted daemon then knows what has already gone.
+
+Unless --no_verify is given, every copy is checked against a digest of its
+source. To a local destination the daemon copies the files itself, hashing
+each one as it is read, so the source is read once and the copy once. To a
+host:path destination the source is hashed while rsync runs and the copy is
+hashed with the coreutils sum tool over ssh. A source file is only deleted
+once its copy matches, and its digest is kept in the manifest.
+
+Example usage might be:
+
+    python transfer_daemon.py --source /data/RUSHAD_P12 \
+        --dest $scg:/oak/stanford/groups/smontgom/tannerj/RUSH_AD/promethion_data/RUSHAD_P12 \
+        --workers 4 --settle_seconds 600
+
+    python transfer_daemon.py --source /tmp/src --dest /tmp/dst --once --settle_seconds 0
+"""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from job_planner import plan_shards
+from checksum import copy_file_digest, digest_files, remote_digests, split_remote, DEFAULT_ALGORITHM, DEFAULT_WORKERS as DEFAULT_HASH_WORKERS
+
+DEFAULT_SETTLE_SECONDS = 1800
+DEFAULT_SCAN_INTERVAL = 300
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_GB = 50
+
+
+class FileState(NamedTuple):
+    size: int
+    mtime: float
+    # when this size and mtime were first seen
+    seen_at: float
+
+
+class BatchResult(NamedTuple):
+    # (relative path, size, mtime) of the files copied, and verified when verifying
+    moved: list
+    # files whose destination copy did not match the source
+    mismatched: list
+    exit_status: int
+    stderr: str
+    copy_seconds: float
+    digests: dict
+    hashed_bytes: int
+    hash_seconds: float
+
+
+class TransferManifest(object):
+    """Append-only TSV of relative path, size, mtime, transfer time and digest for every file moved."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f_in:
+                for line in f_in:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) >= 3:
+                        self.entries[fields[0]] = (int(fields[1]), float(fields[2]))
+
+    def __contains__(self, item):
+        """item is (relative path, size, mtime)."""
+        return self.entries.get(item[0]) == (item[1], item[2])
+
+    def add(self, files, transferred_at=None, digests=None):
+        """Record (relative path, size, mtime) files as moved, with their digest when they were verified."""
+        if transferred_at is None:
+            transferred_at = time.time()
+        digests = digests or {}
+        with open(self.path, 'a') as out:
+            for relpath, size, mtime in files:
+                out.write("%s\t%d\t%r\t%.0f\t%s\n" % (relpath, size, mtime, transferred_at, digests.get(relpath, "")))
+            out.flush()
+            os.fsync(out.fileno())
+        for relpath, size, mtime in files:
+            self.entries[relpath] = (size, mtime)
+
+
+class QuiescenceTracker(object):
+    def __init__(self, source, settle_seconds=DEFAULT_SETTLE_SECONDS):
+        self.source = source
+        self.settle_seconds = settle_seconds
+        self.files = {}
+
+    def _walk(self):
+        stack = [self.source]
+        while stack:
+            directory = stack.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+
+    def scan(self, now=None):
+        """Rescan the source, returns (relative path, size, mtime) of every file that has settled."""
+        if now is None:
+            now = time.time()
+        files = {}
+        ready = []
+        for entry in self._walk():
+            stat = entry.stat(follow_symlinks=False)
+            relpath = os.path.relpath(entry.path, self.source)
+            previous = self.files.get(relpath)
+            if previous is not None and (previous.size, previous.mtime) == (stat.st_size, stat.st_mtime):
+                state = previous
+            else:
+                state = FileState(stat.st_size, stat.st_mtime, now)
+            files[relpath] = state
+            # a file seen for the first time is judged by its mtime alone, a changed one by when we saw the change
+            settled_since = state.mtime if previous is None else max(state.mtime, state.seen_at)
+            if now - settled_since >= self.settle_seconds:
+                ready.append((relpath, state.size, state.mtime))
+        # files that disappeared (moved or deleted) are forgotten
+        self.files = files
+        return ready
+
+
+def plan_batches(files, workers, batch_bytes):
+    """Split (relative path, size, mtime) files into size-balanced batches, at least one per worker."""
+    total = sum(size for relpath, size, mtime in files)
+    if not files:
+        return []
+    shard_bytes = min(batch_bytes, max(1, total // max(1, workers)))
+    by_path = dict((relpath, (relpath, size, mtime)) for relpath, size, mtime in files)
+    shards = plan_shards([(relpath, size) for relpath, size, mtime in files], shard_bytes)
+    return [[by_path[relpath] for relpath in shard] for shard in shards if shard]
+
+
+def transfer_batch(source, dest, batch, rsync="rsync", remove_source_files=True, verify=True,
+                   algorithm=DEFAULT_ALGORITHM, hash_workers=DEFAULT_HASH_WORKERS):
+    """Copy one batch, verifying each file unless verify is False.
+
+    A verified copy to a local destination is made here rather than by rsync: each file
+    is hashed as it is copied, then the copies are hashed, so each side is read once.
+    Otherwise the batch goes through rsync --files-from, and when verifying the source
+    files are hashed while rsync runs and the copies are hashed after it. Up to
+    hash_workers files are copied or hashed at a time. A source file is only removed
+    once its copy matches.
+
+    Returns:
+        BatchResult.
+    """
+    host, dest_dir = split_remote(dest)
+    if verify and host is None:
+        return _copy_verified(source, dest_dir, batch, remove_source_files, algorithm, hash_workers)
+
+    relpaths = [relpath for relpath, size, mtime in batch]
+    hashed_bytes = 0
+    source_hashing = None
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        if verify:
+            # hashed alongside the copy, rsync reads the same files so they share the page cache
+            source_hashing = pool.submit(digest_files, [os.path.join(source, relpath) for relpath in relpaths],
+                                         algorithm, hash_workers)
+        with tempfile.NamedTemporaryFile('w', suffix='.files', delete=False) as files_from:
+            files_from.write('\0'.join(relpaths))
+        command = [rsync, "-rltW", "--from0", "--files-from=" + files_from.name]
+        if verify:
+            # copy even if a mismatched copy with the same size and mtime is already there
+            command.append("--ignore-times")
+        elif remove_source_files:
+            command.append("--remove-source-files")
+        command += [source.rstrip('/') + '/', dest]
+        start = time.time()
+        try:
+            process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        finally:
+            os.remove(files_from.name)
+        copy_seconds = time.time() - start
+        hash_seconds = 0.0
+        source_digests = {}
+        if source_hashing is not None:
+            source_digests, hash_seconds = source_hashing.result()
+            source_digests = dict((os.path.relpath(path, source), digest) for path, digest in source_digests.items())
+            hashed_bytes += sum(size for relpath, size, mtime in batch)
+    if process.returncode != 0 or not verify:
+        return BatchResult(batch if process.returncode == 0 else [], [], process.returncode, process.stderr,
+                           copy_seconds, {}, hashed_bytes, hash_seconds)
+
+    start = time.time()
+    dest_digests = remote_digests(host, dest_dir, relpaths, algorithm)
+    hash_seconds += time.time() - start
+    hashed_bytes += sum(size for relpath, size, mtime in batch)
+    moved, mismatched = _remove_verified(source, batch, source_digests, dest_digests, remove_source_files)
+    return BatchResult(moved, mismatched, 0, process.stderr, copy_seconds, source_digests, hashed_bytes, hash_seconds)
+
+
+def _copy_verified(source, dest_dir, batch, remove_source_files, algorithm, hash_workers):
+    """Copy a batch to a local directory, hashing each source file as it is copied."""
+    workers = max(1, min(hash_workers, len(batch)))
+
+    def copy(relpath):
+        target = os.path.join(dest_dir, relpath)
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            return relpath, copy_file_digest(os.path.join(source, relpath), target, algorithm), None
+        except OSError as e:
+            return relpath, None, "%s: %s" % (relpath, e)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        copied = list(pool.map(copy, [relpath for relpath, size, mtime in batch]))
+    copy_seconds = time.time() - start
+    source_digests = dict((relpath, digest) for relpath, digest, error in copied if digest is not None)
+    errors = [error for relpath, digest, error in copied if error is not None]
+
+    dest_digests, hash_seconds = digest_files([os.path.join(dest_dir, relpath) for relpath in source_digests],
+                                              algorithm, workers)
+    dest_digests = dict((os.path.relpath(path, dest_dir), digest) for path, digest in dest_digests.items())
+    hashed_bytes = 2 * sum(size for relpath, size, mtime in batch if relpath in source_digests)
+    copied_files = [f for f in batch if f[0] in source_digests]
+    moved, mismatched = _remove_verified(source, copied_files, source_digests, dest_digests, remove_source_files)
+    # files that could not be copied stay in the source and are not in the manifest, so the next scan retries them
+    return BatchResult(moved, mismatched, 1 if errors else 0, "\n".join(errors), copy_seconds, source_digests,
+                       hashed_bytes, hash_seconds)
+
+
+def _remove_verified(source, batch, source_digests, dest_digests, remove_source_files):
+    """Returns: (files whose copy matches, removed from the source if asked, files whose copy does not)."""
+    moved = []
+    mismatched = []
+    for f in batch:
+        relpath = f[0]
+        if relpath in source_digests and dest_digests.get(relpath) == source_digests[relpath]:
+            moved.append(f)
+            if remove_source_files:
+                os.remove(os.path.join(source, relpath))
+        else:
+            mismatched.append(f)
+    return moved, mismatched
+
+
+def transfer_ready(source, dest, ready, manifest, workers=DEFAULT_WORKERS, batch_bytes=DEFAULT_BATCH_GB * 1e9,
+                   rsync="rsync", remove_source_files=True, verify=True, algorithm=DEFAULT_ALGORITHM,
+                   hash_workers=DEFAULT_HASH_WORKERS):
+    """Move the ready files not in the manifest yet.
+
+    Returns:
+        List of BatchResult, one per batch.
+    """
+    pending = [f for f in ready if f not in manifest]
+    batches = plan_batches(pending, workers, int(batch_bytes))
+    results = []
+    if not batches:
+        return results
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(transfer_batch, source, dest, batch, rsync, remove_source_files, verify, algorithm,
+                               hash_workers)
+                   for batch in batches]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            if result.exit_status != 0:
+                # a failed rsync moves nothing, a failed local copy still moves the files it verified
+                print("copy of a batch failed with exit status %d:\n%s" % (result.exit_status, result.stderr.strip()))
+            for relpath, size, mtime in result.mismatched:
+                print("Checksum mismatch for %s, source kept and will be copied again" % relpath)
+            manifest.add(result.moved, digests=result.digests)
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Move quiescent sequencing files to a destination with parallel rsync.")
+    parser.add_argument("--source", required=True, help="directory to move files out of")
+    parser.add_argument("--dest", required=True, help="rsync destination, local path or host:path")
+    parser.add_argument("--manifest", default=None, help="TSV of files already moved [default <source>.transfer_manifest.tsv]")
+    parser.add_argument("--settle_seconds", type=float, default=DEFAULT_SETTLE_SECONDS, help="seconds a file must go unchanged before it is moved [default %d]" % DEFAULT_SETTLE_SECONDS)
+    parser.add_argument("--scan_interval", type=float, default=DEFAULT_SCAN_INTERVAL, help="seconds between scans of the source [default %d]" % DEFAULT_SCAN_INTERVAL)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="rsync processes run in parallel [default %d]" % DEFAULT_WORKERS)
+    parser.add_argument("--batch_gb", type=float, default=DEFAULT_BATCH_GB, help="max gigabytes per rsync batch [default %d]" % DEFAULT_BATCH_GB)
+    parser.add_argument("--rsync", default="rsync", help="rsync executable, used for host:path destinations and with --no_verify [default rsync on PATH]")
+    parser.add_argument("--keep_source", default=False, action="store_true", help="copy only, do not remove source files once transferred")
+    parser.add_argument("--no_verify", default=False, action="store_true", help="trust rsync and skip hashing the source and destination copies")
+    parser.add_argument("--hash_workers", type=int, default=DEFAULT_HASH_WORKERS, help="files copied or hashed in parallel within a batch when verifying [default %d]" % DEFAULT_HASH_WORKERS)
+    parser.add_argument("--algorithm", default=DEFAULT_ALGORITHM, help="digest used to verify copies, needs the matching *sum tool on a remote destination [default %s]" % DEFAULT_ALGORITHM)
+    parser.add_argument("--once", default=False, action="store_true", help="move what is ready now and exit instead of running as a daemon")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    manifest = TransferManifest(args.manifest or args.source.rstrip('/') + '.transfer_manifest.tsv')
+    tracker = QuiescenceTracker(args.source, args.settle_seconds)
+    print("%d files already in the manifest" % len(manifest.entries))
+    while True:
+        start = time.time()
+        ready = tracker.scan(start)
+        results = transfer_ready(
+            args.source, args.dest, ready, manifest, args.workers, args.batch_gb * 1e9,
+            args.rsync, not args.keep_source, not args.no_verify, args.algorithm, args.hash_workers)
+        seconds = time.time() - start
+        if results:
+            files = sum(len(result.moved) for result in results)
+            moved_bytes = sum(size for result in results for relpath, size, mtime in result.moved)
+            copied_bytes = sum(size for result in results for relpath, size, mtime in result.moved + result.mismatched)
+            failed = sum(1 for result in results if result.exit_status != 0)
+            mismatched = sum(len(result.mismatched) for result in results)
+            print("%s moved %d files, %.2f GB in %.0f s (%.3f GB/s), %d failed batches, %d checksum mismatches, %d files waiting to settle" % (
+                time.strftime("%Y-%m-%d %H:%M:%S"), files, moved_bytes / 1e9, seconds,
+                moved_bytes / 1e9 / max(seconds, 1e-9), failed, mismatched, len(tracker.files) - len(ready)))
+            # per worker rates, so hashing can be sized against the copy
+            copy_seconds = sum(result.copy_seconds for result in results)
+            hash_seconds = sum(result.hash_seconds for result in results)
+            if hash_seconds > 0 and copy_seconds > 0:
+                print("    per worker: copy %.3f GB/s, verification %.3f GB/s" % (
+                    copied_bytes / 1e9 / copy_seconds, sum(result.hashed_bytes for result in results) / 1e9 / hash_seconds))
+        if args.once:
+            return
+        time.sleep(max(0, args.scan_interval - seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Incremental yield rate forecasting for time to target estimates.
+
+A rate taken from the last two yield samples swings wildly: it drops to zero
+during a mux scan and jumps when MinKNOW catches up on its estimate. The
+YieldForecaster instead keeps an exponentially weighted mean and variance of
+the per-interval yield rate, weighted by interval length with a half-life in
+seconds, which acts as a sliding window over the recent yield curve. Every
+sample is an O(1) update, so a forecaster per flow cell plus one for the
+aggregate stays cheap with hundreds of positions.
+
+Example usage might be:
+
+    forecaster = YieldForecaster(half_life=1800)
+    forecaster.add(time.time(), current_yield)
+    forecast = forecaster.predict_crossing(target_yield)
+    if forecast is not None:
+        print("%.1f minutes to target (%.1f - %.1f)" % (forecast.seconds / 60, forecast.earliest / 60, forecast.latest / 60))
+"""
+
+import math
+from typing import NamedTuple
+
+DEFAULT_HALF_LIFE = 1800
+
+
+class Forecast(NamedTuple):
+    seconds: float
+    earliest: float
+    latest: float
+    rate: float
+
+
+class YieldForecaster(object):
+    def __init__(self, half_life=DEFAULT_HALF_LIFE, z=1.96):
+        """
+        Args:
+            half_life: seconds after which a rate sample counts half as much.
+            z: width of the confidence band in standard errors.
+        """
+        self.half_life = half_life
+        self.z = z
+        self.reset()
+
+    def reset(self):
+        self.last_time = None
+        self.last_yield = None
+        self.samples = 0
+        self._weight = 0.0
+        self._weight_sq = 0.0
+        self._mean = 0.0
+        self._sum_sq = 0.0
+
+    def add(self, t, current_yield):
+        """Add a (time in seconds, yield in bases) sample."""
+        if self.last_time is not None and current_yield < self.last_yield:
+            # yield went backwards, a new acquisition started on this position
+            self.reset()
+        if self.last_time is None or t <= self.last_time:
+            self.last_time = t
+            self.last_yield = current_yield
+            return
+
+        dt = t - self.last_time
+        rate = (current_yield - self.last_yield) / dt
+        decay = 0.5 ** (dt / self.half_life)
+        self._weight *= decay
+        self._weight_sq *= decay * decay
+        self._sum_sq *= decay
+
+        # weighted incremental mean/variance (West 1979), weight is the interval length
+        self._weight += dt
+        self._weight_sq += dt * dt
+        delta = rate - self._mean
+        self._mean += delta * dt / self._weight
+        self._sum_sq += dt * delta * (rate - self._mean)
+
+        self.samples += 1
+        self.last_time = t
+        self.last_yield = current_yield
+
+    def state(self):
+        """JSON serialisable state, restored with restore()."""
+        return {
+            "last_time": self.last_time,
+            "last_yield": self.last_yield,
+            "samples": self.samples,
+            "weight": self._weight,
+            "weight_sq": self._weight_sq,
+            "mean": self._mean,
+            "sum_sq": self._sum_sq,
+        }
+
+    def restore(self, state):
+        self.last_time = state["last_time"]
+        self.last_yield = state["last_yield"]
+        self.samples = state["samples"]
+        self._weight = state["weight"]
+        self._weight_sq = state["weight_sq"]
+        self._mean = state["mean"]
+        self._sum_sq = state["sum_sq"]
+
+    @property
+    def rate(self):
+        """Smoothed yield rate in bases per second, None until two samples have been seen."""
+        return self._mean if self.samples else None
+
+    @property
+    def rate_stderr(self):
+        if self.samples < 2:
+            return None
+        # effective number of samples under the decayed weights
+        n_eff = self._weight * self._weight / self._weight_sq
+        variance = max(0.0, self._sum_sq / self._weight)
+        return math.sqrt(variance / n_eff)
+
+    def predict_crossing(self, target_yield):
+        """Predict how long until the yield reaches target_yield.
+
+        Returns:
+            Forecast with the seconds to target from the last sample and a
+            confidence band (earliest, latest); latest is inf when the lower rate
+            bound is not positive. None if no positive rate has been seen yet.
+        """
+        rate = self.rate
+        if rate is None or rate <= 0:
+            return None
+        remaining = max(0.0, target_yield - self.last_yield)
+        stderr = self.rate_stderr or 0.0
+        upper_rate = rate + self.z * stderr
+        lower_rate = rate - self.z * stderr
+        latest = remaining / lower_rate if lower_rate > 0 else float("inf")
+        return Forecast(remaining / rate, remaining / upper_rate, latest, rate)